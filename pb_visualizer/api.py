@@ -1,12 +1,11 @@
+from collections import Counter
 from collections.abc import Iterable
 import datetime
-import json
 import random
 from django.core.files.storage import FileSystemStorage
+import numpy as np
 from pb_visualizer.management.commands.add_election import add_election
-from pb_visualizer.management.commands.compute_election_properties import compute_election_properties
-from pb_visualizer.management.commands.compute_rule_result_properties import compute_rule_result_properties
-from pb_visualizer.management.commands.compute_rule_results import compute_rule_results
+from pb_visualizer.management.commands.compute_all import compute_all
 from pb_visualizer.management.commands.remove_old_user_elections import remove_old_user_elections
 
 
@@ -25,10 +24,12 @@ from django.db.models import (
     Max,
     Count,
 )
-from django.db.models.functions import Cast, Floor, Ln
+from django.db.models.functions import Cast, Coalesce, Floor, Ln
 
 from rest_framework import status
+from rest_framework.relations import PKOnlyObject, RelatedField
 from pb_visualizer.management.commands.utils import ApiExcepetion
+from pb_visualizer.rule_property_cube import CELL_FIELDS, annotate_cells, cube_cell_filter, rule_property_cube_is_fresh
 
 import logging
 logger = logging.getLogger('django')
@@ -153,41 +154,67 @@ def get_election_details(
                 serialized list of all given election properties
     """
     election_query_set = filter_elections(**filters, ballot_type=ballot_type, database=database)
-    election_details_collection = {}
 
     properties = get_filterable_election_property_list(
         property_short_names=property_short_names,
         ballot_type=ballot_type,
         database=database
     )
-
-    for election_obj in election_query_set:
-        election_dict = ElectionSerializer(election_obj).data
-        election_details = {}
-
-        # first we get all the properties that are fields of the election model
-        for property in properties["data"]:
-            if property["short_name"] in Election.public_fields:
-                election_details[property["short_name"]] = election_dict[
-                    property["short_name"]
-                ]
-
-        # then we get all the properties that are ElectionMetadata
-        data_props_query = ElectionDataProperty.objects.using(database).all().filter(
-            election=election_obj,
-            metadata__short_name__in=[p["short_name"] for p in properties["data"]],
-        )
-        for data_prop_obj in data_props_query:
-            election_details[data_prop_obj.metadata.short_name] = data_prop_obj.value
-
+    field_names = [p["short_name"] for p in properties["data"] if p["short_name"] in Election.public_fields]
+    metadata_short_names = [p["short_name"] for p in properties["data"] if p["short_name"] not in Election.public_fields]
+    property_columns = ElectionPropertyRow.property_columns()
+    row_short_names = [short_name for short_name in metadata_short_names if short_name in property_columns]
+    other_short_names = [short_name for short_name in metadata_short_names if short_name not in property_columns]
+
+    # first we get all the properties that are fields of the election model, serialized as ElectionSerializer
+    # does, with the ElectionMetadata having a column in the ElectionPropertyRow table
+    serializer_fields = ElectionSerializer().fields
+    election_details_collection = {}
+    election_names = {}
+    election_values_query = election_query_set.values(
+        *dict.fromkeys(["id", "name", *field_names]),
+        **{short_name: F("property_row__" + short_name) for short_name in row_short_names},
+    )
+    for election_values in election_values_query:
+        election_names[election_values["id"]] = election_values["name"]
+        election_details = {
+            field_name: _serialize_field_value(serializer_fields[field_name], election_values[field_name])
+            for field_name in field_names
+        }
+        for short_name in row_short_names:
+            # the properties that were not computed for the election are left out
+            if election_values[short_name] is not None:
+                election_details[short_name] = election_values[short_name]
+        election_details_collection[election_values["name"]] = election_details
+
+    # then we get the other ElectionMetadata, in one query for all the elections
+    if other_short_names:
+        data_props_query = ElectionDataProperty.objects.using(database).filter(
+            election__in=election_query_set.values("id"),
+            metadata_id__in=other_short_names,
+        ).values_list("election_id", "metadata_id", "value")
+        for election_id, short_name, value in data_props_query:
+            election_details_collection[election_names[election_id]][short_name] = value
+
+    for election_details in election_details_collection.values():
         election_details["user_submitted"] = (database == "user_submitted")
 
-        election_details_collection[election_obj.name] = election_details
-
     # TODO: also send metadata of properties or remove properties
     return {"data": election_details_collection, "metadata": properties["data"]} 
 
 
+def _serialize_field_value(field, value):
+    """
+    Serializes the value of an Election field read with values() as the field of ElectionSerializer does,
+    a foreign key being serialized from its primary key.
+    """
+    if value is None:
+        return None
+    if isinstance(field, RelatedField):
+        return field.to_representation(PKOnlyObject(pk=value))
+    return field.to_representation(value)
+
+
 def get_project_list(
     election_name: str,
     database: str = "default"
@@ -406,7 +433,9 @@ def get_rule_result_average_data_properties(
     property_short_names: Iterable[str],
     election_filters: dict = {},
     include_incomplete_elections: bool = False,
-    database: str = "default"
+    database: str = "default",
+    with_spread: bool = False,
+    quantiles: Iterable[float] = (0.1, 0.25, 0.75, 0.9),
 ) -> dict[str]:
     """
     Returns for each given rule and rule result property, the average value of that property for the result of that rule.
@@ -422,6 +451,10 @@ def get_rule_result_average_data_properties(
             additional filters for the elections considered, see filter_elections method for details 
         database: str = "default"
             name of the database to work on
+        with_spread: bool = False
+            whether to also return the spread of the list properties around their average
+        quantiles: Iterable[float] = (0.1, 0.25, 0.75, 0.9)
+            the quantiles returned with the spread
     
     Returns
     -------
@@ -432,7 +465,33 @@ def get_rule_result_average_data_properties(
             "metadata":
                 "num_elections":
                     the number of election over which the average was taken
+            "spread": (only if with_spread)
+                dictionary containing the rule abbreviations as key and a dictionary as value,
+                containing the short names of the list properties and a dictionary with their
+                entrywise standard deviation "std" and their entrywise "quantiles", by quantile
     """
+    inner_types = dict(
+        RuleResultMetadata.objects.using(database)
+        .filter(short_name__in=property_short_names)
+        .values_list("short_name", "inner_type")
+    )
+    scalar_props = [prop for prop in property_short_names if inner_types.get(prop) in ["float", "int"]]
+    list_props = [prop for prop in property_short_names if inner_types.get(prop) == "list[float]"]
+
+    # the quantiles are computed from the values themselves
+    if not with_spread:
+        cube_averages = _rule_result_average_data_properties_from_cube(
+            rule_abbr_list,
+            property_short_names,
+            scalar_props,
+            list_props,
+            election_filters,
+            include_incomplete_elections,
+            database,
+        )
+        if cube_averages is not None:
+            return cube_averages
+
     election_query_set = filter_elections(**election_filters, database=database)
     if not include_incomplete_elections:
         election_query_set = filter_elections_by_rule_properties(
@@ -442,56 +501,161 @@ def get_rule_result_average_data_properties(
             database=database
         )
     rule_result_data_property_query_set = RuleResultDataProperty.objects.using(database).all().filter(
-        rule_result__election__in=election_query_set
+        rule_result__election__in=election_query_set,
+        rule_result__rule__abbreviation__in=rule_abbr_list,
     )
 
+    # the scalar properties are averaged by the database in one grouped query
+    scalar_averages = {
+        (row["rule_result__rule"], row["metadata"]): row["avg"]
+        for row in rule_result_data_property_query_set.filter(metadata__in=scalar_props)
+        .values("rule_result__rule", "metadata")
+        .annotate(avg=Avg(Coalesce("float_value", Cast("value", FloatField()))))
+    }
+    # the list properties are fetched in one query and averaged with numpy, the packed arrays of a
+    # rule and property being decoded at once into one row per election. The rows without typed
+    # values are packed from their text value.
+    arrays = {}
+    for rule, prop_name, array_value, untyped_value in rule_result_data_property_query_set.filter(
+        metadata__in=list_props
+    ).values_list("rule_result__rule", "metadata", "array_value", RuleResultDataProperty.untyped_value()):
+        if array_value is None and untyped_value is not None:
+            array_value = RuleResultDataProperty.typed_values(untyped_value)["array_value"]
+        if array_value is not None:
+            arrays.setdefault((rule, prop_name), []).append(array_value)
+
+    quantiles = list(quantiles)
     data_dict = {}
+    spread_dict = {}
     for rule in rule_abbr_list:
         data_dict[rule] = {}
-        for prop_name in property_short_names:
-            rule_result_metadata_obj = RuleResultMetadata.objects.using(database).get(
-                short_name=prop_name
-            )
-            if (
-                rule_result_metadata_obj.inner_type == "float"
-                or rule_result_metadata_obj.inner_type == "int"
-            ):
-                data_dict[rule][prop_name] = (
-                    rule_result_data_property_query_set.filter(
-                        rule_result__rule__abbreviation=rule,
-                        metadata__short_name=prop_name,
-                    )
-                    .annotate(value_as_float=Cast("value", FloatField()))
-                    .aggregate(Avg("value_as_float"))["value_as_float__avg"]
-                )
+        spread_dict[rule] = {}
+        for prop_name in scalar_props:
+            data_dict[rule][prop_name] = scalar_averages.get((rule, prop_name))
+        for prop_name in list_props:
+            prop_arrays = arrays.get((rule, prop_name), [])
+            if len(prop_arrays) > 0:
+                # the arrays of another length than the most common one have no entrywise average with
+                # the others and are skipped, the longest length winning the ties
+                lengths = Counter(len(array_value) for array_value in prop_arrays)
+                length = max(lengths, key=lambda length: (lengths[length], length))
+                prop_arrays = [array_value for array_value in prop_arrays if len(array_value) == length]
+                values = np.frombuffer(b"".join(prop_arrays), dtype="<f8").reshape(len(prop_arrays), length // 8)
+                data_dict[rule][prop_name] = values.mean(axis=0).tolist()
+                if with_spread:
+                    spread_dict[rule][prop_name] = {
+                        "std": values.std(axis=0).tolist(),
+                        "quantiles": dict(
+                            zip(map(str, quantiles), np.quantile(values, quantiles, axis=0).tolist())
+                        ),
+                    }
+            else:
+                data_dict[rule][prop_name] = []
+                if with_spread:
+                    spread_dict[rule][prop_name] = {"std": [], "quantiles": {str(q): [] for q in quantiles}}
+    result = {"data": data_dict, "meta_data": {"num_elections": len(election_query_set)}}
+    if with_spread:
+        result["spread"] = spread_dict
+    return result
+
+
+def _rule_result_average_data_properties_from_cube(
+    rule_abbr_list: Iterable[str],
+    property_short_names: Iterable[str],
+    scalar_props: list[str],
+    list_props: list[str],
+    election_filters: dict,
+    include_incomplete_elections: bool,
+    database: str = "default"
+) -> dict | None:
+    """
+    Returns the result of get_rule_result_average_data_properties computed from the RulePropertyAggregate
+    cube, or None if it cannot be: if the filters do not align with the dimensions of the cube, if some
+    cell has both complete and incomplete elections, or if the cube is not up to date with the rule
+    result properties.
+    """
+    cell_filter = cube_cell_filter(election_filters)
+    # the cube only knows about the rule results through their properties
+    if cell_filter is None or (rule_abbr_list and not property_short_names and not include_incomplete_elections):
+        return None
+    # the cells of some stored properties are not refreshed yet, see mark_rule_property_cells_stale
+    if not rule_property_cube_is_fresh(cell_filter, list(rule_abbr_list), database):
+        return None
+
+    cell_num_elections = {
+        tuple(cell): num_elections
+        for *cell, num_elections in annotate_cells(Election.objects.using(database).all())
+        .filter(cell_filter)
+        .values_list(*CELL_FIELDS)
+        .annotate(num_elections=Count("id"))
+    }
+    aggregates = [
+        (tuple(cell), rule, prop, count, num_values, value_sum, vector_sum)
+        for *cell, rule, prop, count, num_values, value_sum, vector_sum in RulePropertyAggregate.objects.using(
+            database
+        )
+        .filter(cell_filter, rule__in=rule_abbr_list, metadata__in=property_short_names)
+        .values_list(*CELL_FIELDS, "rule", "metadata", "count", "num_values", "sum", "vector_sum")
+    ]
 
-            elif rule_result_metadata_obj.inner_type == "list[float]":
-                prop_list = []
-                for (
-                    rule_result_data_property
-                ) in rule_result_data_property_query_set.filter(
-                    rule_result__rule__abbreviation=rule, metadata__short_name=prop_name
-                ).all():
-                    prop_list.append(json.loads(rule_result_data_property.value))
-
-                if len(prop_list) > 0:
-                    avg_props = [0 for i in range(len(prop_list[0]))]
-                    for prop in prop_list:
-                        for i in range(len(prop)):
-                            avg_props[i] += prop[i]
-                    for i in range(len(avg_props)):
-                        avg_props[i] /= len(prop_list)
-                    data_dict[rule][prop_name] = avg_props
-                else:
-                    data_dict[rule][prop_name] = []
-    return {"data": data_dict, "meta_data": {"num_elections": len(election_query_set)}}
+    # an election is complete when it has all the properties for all the rules, the cells whose
+    # elections are all complete are included and the ones whose elections all miss one are not
+    included_cells = set(cell_num_elections)
+    if not include_incomplete_elections:
+        num_pairs = len(set(rule_abbr_list)) * len(set(property_short_names))
+        present_pairs, complete_pairs = {}, {}
+        for cell, _, _, count, *_ in aggregates:
+            if count > 0:
+                present_pairs[cell] = present_pairs.get(cell, 0) + 1
+            if count == cell_num_elections.get(cell):
+                complete_pairs[cell] = complete_pairs.get(cell, 0) + 1
+        for cell in cell_num_elections:
+            if present_pairs.get(cell, 0) < num_pairs:
+                included_cells.remove(cell)
+            elif complete_pairs.get(cell, 0) < num_pairs:
+                return None
+
+    num_values = {}
+    sums = {}
+    list_prop_set = set(list_props)
+    for cell, rule, prop, count, cell_num_values, value_sum, vector_sum in aggregates:
+        if cell in included_cells and cell_num_values > 0:
+            if prop in list_prop_set:
+                # the arrays of different lengths, in a cell or across cells, are averaged from the
+                # properties, skipping the ones of another length than the most common one
+                if vector_sum is None:
+                    return None
+                value = np.frombuffer(vector_sum, dtype="<f8")
+                if (rule, prop) in sums and len(sums[(rule, prop)]) != len(value):
+                    return None
+            else:
+                value = value_sum
+            num_values[(rule, prop)] = num_values.get((rule, prop), 0) + cell_num_values
+            sums[(rule, prop)] = sums[(rule, prop)] + value if (rule, prop) in sums else value
+
+    data_dict = {}
+    for rule in rule_abbr_list:
+        data_dict[rule] = {}
+        for prop_name in scalar_props:
+            if (rule, prop_name) in num_values:
+                data_dict[rule][prop_name] = sums[(rule, prop_name)] / num_values[(rule, prop_name)]
+            else:
+                data_dict[rule][prop_name] = None
+        for prop_name in list_props:
+            if (rule, prop_name) in num_values:
+                data_dict[rule][prop_name] = (sums[(rule, prop_name)] / num_values[(rule, prop_name)]).tolist()
+            else:
+                data_dict[rule][prop_name] = []
+    num_elections = sum(cell_num_elections[cell] for cell in included_cells)
+    return {"data": data_dict, "meta_data": {"num_elections": num_elections}}
 
 
 def get_satisfaction_histogram(
     rule_abbr_list: Iterable[str],
     election_filters: dict = {},
     include_incomplete_elections: bool = False,
-    database: str = "default"
+    database: str = "default",
+    with_spread: bool = False,
 ) -> dict[str, list[float]]:
     """
     Returns for each given rule, the satisfaction histogram for the result of that rule. The bins are [0.0,0.0], (0.0,0.05], ..., (0.95,1.0].
@@ -505,13 +669,16 @@ def get_satisfaction_histogram(
             additional filters for the elections considered, see filter_elections method for details 
         database: str = "default"
             name of the database to work on
+        with_spread: bool = False
+            whether to also return the spread of the histograms of the elections
     
     Returns
     -------
         dict
             "data":
                 dictionary containing the rule abbreviations as key and a dictionary as value,
-                containing "hist_data" (pabutools satisfaction_histogram result) and "avg" (average satisfaction)
+                containing "hist_data" (pabutools satisfaction_histogram result) and "avg" (average satisfaction),
+                and if with_spread "hist_std" and "hist_quantiles", see get_rule_result_average_data_properties
             "metadata":
                 "num_elections":
                     the number of election over which the average was taken
@@ -521,7 +688,8 @@ def get_satisfaction_histogram(
         ["agg_nrmcost_sat", "avg_nrmcost_sat"],
         election_filters=election_filters,
         include_incomplete_elections=include_incomplete_elections,
-        database=database
+        database=database,
+        with_spread=with_spread,
     )
     data_dict["data"] = {
         rule: {
@@ -530,6 +698,11 @@ def get_satisfaction_histogram(
         }
         for rule in data_dict["data"]
     }
+    if with_spread:
+        spread_dict = data_dict.pop("spread")
+        for rule in data_dict["data"]:
+            data_dict["data"][rule]["hist_std"] = spread_dict[rule]["agg_nrmcost_sat"]["std"]
+            data_dict["data"][rule]["hist_quantiles"] = spread_dict[rule]["agg_nrmcost_sat"]["quantiles"]
     return data_dict
 
 
@@ -587,8 +760,25 @@ def get_election_property_histogram(
     election_meta_data_obj = ElectionMetadata.objects.using(database).filter(
         short_name=election_property_short_name
     )
-    # if property is ElectionMetadata
-    if election_meta_data_obj.exists():
+    # if property is ElectionMetadata with a column in the ElectionPropertyRow table
+    if election_property_short_name in ElectionPropertyRow.property_columns():
+        hist_data = histogram_data_from_query_set_and_field(
+            query_set=ElectionPropertyRow.objects.using(database).filter(
+                election__in=election_query_set,
+                **{election_property_short_name + "__isnull": False},
+            ),
+            field_name=election_property_short_name,
+            by_category={
+                "field_name": "election__ballot_type__name",
+                "categories": ballot_type_names,
+            }
+            if by_ballot_type
+            else None,
+            num_bins=num_bins,
+            log_scale=log_scale,
+        )
+    # if property is another ElectionMetadata
+    elif election_meta_data_obj.exists():
         election_data_property_query = (
             ElectionDataProperty.objects.using(database).all()
             .filter(
@@ -742,9 +932,9 @@ def histogram_data_from_query_set_and_field(
         )
 
     # defining the counting formulas for counting the number of objects annotated with each bin id
-    counters = {str(i): Count("id", filter=Q(hist_bin=i)) for i in range(num_bins - 1)}
+    counters = {str(i): Count("pk", filter=Q(hist_bin=i)) for i in range(num_bins - 1)}
     counters[str(num_bins - 1)] = Count(
-        "id", filter=Q(hist_bin__in=[num_bins - 1, num_bins])
+        "pk", filter=Q(hist_bin__in=[num_bins - 1, num_bins])
     )  # last bin should be closed interval
 
     # finally annotating the objects using the annotation formula and counting them using the counting formulas
@@ -950,7 +1140,7 @@ def _filter_elections_by_model_field(
             election_query_set = election_query_set.filter(
                 **{
                     election_property
-                    + "__gte": datetime.date(election_property_filter["min"])
+                    + "__gte": datetime.date.fromisoformat(election_property_filter["min"])
                 }
             )
         if (
@@ -960,7 +1150,7 @@ def _filter_elections_by_model_field(
             election_query_set = election_query_set.filter(
                 **{
                     election_property
-                    + "__lte": datetime.date(election_property_filter["max"])
+                    + "__lte": datetime.date.fromisoformat(election_property_filter["max"])
                 }
             )
     elif type == "bool":
@@ -1018,6 +1208,18 @@ def _filter_elections_by_metadata(
     election_property_filter
 ) -> QuerySet:
     # no type check, because all election meta properties are numbers
+    if election_property in ElectionPropertyRow.property_columns():
+        # one indexed column of the ElectionPropertyRow table, joined once for all the filters
+        if "min" in election_property_filter and election_property_filter["min"] != None:
+            election_query_set = election_query_set.filter(
+                **{"property_row__" + election_property + "__gte": election_property_filter["min"]}
+            )
+        if "max" in election_property_filter and election_property_filter["max"] != None:
+            election_query_set = election_query_set.filter(
+                **{"property_row__" + election_property + "__lte": election_property_filter["max"]}
+            )
+        return election_query_set
+
     if "min" in election_property_filter and election_property_filter["min"] != None:
         election_query_set = election_query_set.filter(
             data_properties__metadata__short_name=election_property,
@@ -1080,15 +1282,7 @@ def handle_file_upload(pb_file):
             },
             verbosity=3
         )
-        compute_election_properties(
-            [election_obj.name],
-            exact=False,
-            override=True,
-            use_db=True,
-            database="user_submitted",
-            verbosity=3
-        )
-        compute_rule_results(
+        compute_all(
             [election_obj.name],
             rule_list=rule_lists[election_obj.ballot_type.name],
             exact=False,
@@ -1097,14 +1291,6 @@ def handle_file_upload(pb_file):
             database="user_submitted",
             verbosity=3,
         )
-        compute_rule_result_properties(
-            [election_obj.name],
-            exact=False,
-            override=True,
-            use_db=True,
-            database="user_submitted",
-            verbosity=3,
-        )
     except Exception as e:
         raise ApiExcepetion(str(e), status_code=status.HTTP_406_NOT_ACCEPTABLE)
     finally:
@@ -0,0 +1,189 @@
+from array import array
+
+import numpy as np
+from pabutools.election import AbstractProfile, Instance
+
+from pb_visualizer.pabulib import ballot_preferences, iter_pabulib_votes, read_pabulib_instance
+
+# this module is imported by the worker processes computing the rules before django is set up, so
+# the models are imported inside the functions
+
+
+class CompactProfile:
+    """
+    Array-backed version of an election for float computations. The projects are numbered from 0
+    and their costs are the vector costs. The ballots are stored as a CSR voter x project matrix:
+    voter i gives the preference strengths data[indptr[i]:indptr[i + 1]] to the projects
+    indices[indptr[i]:indptr[i + 1]], sorted from the most to the least preferred. The strengths are
+    float64 like the costs, so that the points and scores are not rounded. For approval ballots data
+    is None, every strength being 1.
+    """
+
+    def __init__(
+        self,
+        ballot_type: str,
+        project_names: list[str],
+        costs: np.ndarray,
+        budget_limit: float,
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        data: np.ndarray | None = None,
+    ):
+        self.ballot_type = ballot_type
+        self.project_names = project_names
+        self.costs = np.asarray(costs, dtype=np.float64)
+        self.budget_limit = float(budget_limit)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.data = None if data is None else np.asarray(data, dtype=np.float64)
+        self._voter_index = None
+
+    def __getstate__(self):
+        # the voter index is derived from indptr, it is not worth storing
+        return {**self.__dict__, "_voter_index": None}
+
+    @property
+    def num_voters(self) -> int:
+        return len(self.indptr) - 1
+
+    @property
+    def num_projects(self) -> int:
+        return len(self.costs)
+
+    @property
+    def strengths(self) -> np.ndarray:
+        """The preference strength of every entry, ones for approval ballots."""
+        if self.data is None:
+            return np.ones(len(self.indices), dtype=np.float64)
+        return self.data
+
+    @property
+    def voter_index(self) -> np.ndarray:
+        """The voter of every entry, computed once."""
+        if self._voter_index is None:
+            self._voter_index = np.repeat(
+                np.arange(self.num_voters, dtype=np.int32), np.diff(self.indptr)
+            )
+        return self._voter_index
+
+    def ballot_lengths(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    def voter_sums(self, entry_values: np.ndarray) -> np.ndarray:
+        """Sums values given for every entry of the matrix per voter."""
+        return np.bincount(self.voter_index, weights=entry_values, minlength=self.num_voters)
+
+    def project_sums(self, entry_values: np.ndarray | None = None) -> np.ndarray:
+        """Sums values given for every entry of the matrix (the strengths by default) per project."""
+        if entry_values is None:
+            entry_values = self.data
+        return np.bincount(self.indices, weights=entry_values, minlength=self.num_projects)
+
+    @classmethod
+    def from_rows(cls, ballot_type: str, project_names: list[str], costs, budget_limit, ballots):
+        """
+        Builds the profile from an iterable of ballots, each one a list of (project number, strength)
+        pairs sorted from the most to the least preferred.
+        """
+        # typed arrays keep the memory per vote small while the profile is read
+        indptr, indices, data = array("q", [0]), array("i"), array("d")
+        for ballot in ballots:
+            for project_index, strength in ballot:
+                indices.append(project_index)
+                data.append(strength)
+            indptr.append(len(indices))
+        return cls(
+            ballot_type,
+            project_names,
+            costs,
+            budget_limit,
+            np.frombuffer(indptr, dtype=np.int64),
+            np.frombuffer(indices, dtype=np.int32),
+            None if ballot_type == "approval" else np.frombuffer(data, dtype=np.float64),
+        )
+
+    @classmethod
+    def from_file(cls, file_path: str, ballot_type: str):
+        """Reads a pabulib file vote by vote, without building the pabutools profile."""
+        instance = read_pabulib_instance(file_path)
+        project_names = [project.name for project in instance]
+        project_numbers = {name: index for index, name in enumerate(project_names)}
+
+        def ballots():
+            for voter_row in iter_pabulib_votes(file_path):
+                preferences = ballot_preferences(voter_row, ballot_type)
+                for project in preferences:
+                    if project not in project_numbers:
+                        raise ValueError(f"Invalid pb file. A voter votes for the unknown project {project}.")
+                yield sorted(
+                    ((project_numbers[project], strength) for project, strength in preferences.items()),
+                    key=lambda entry: -entry[1],
+                )
+
+        return cls.from_rows(
+            ballot_type,
+            project_names,
+            [float(project.cost) for project in instance],
+            float(instance.budget_limit),
+            ballots(),
+        )
+
+    @classmethod
+    def from_pabutools(cls, instance: Instance, profile: AbstractProfile, ballot_type: str):
+        """Converts a pabutools instance and profile, multiprofiles are expanded."""
+        project_names = [project.name for project in instance]
+        project_numbers = {name: index for index, name in enumerate(project_names)}
+
+        def ballots():
+            for ballot in profile:
+                if ballot_type == "approval":
+                    entries = [(project_numbers[project.name], 1) for project in ballot]
+                elif ballot_type == "ordinal":
+                    entries = [(project_numbers[project.name], len(ballot) - i) for i, project in enumerate(ballot)]
+                else:
+                    entries = sorted(
+                        ((project_numbers[project.name], float(ballot[project])) for project in ballot),
+                        key=lambda entry: -entry[1],
+                    )
+                for _ in range(profile.multiplicity(ballot)):
+                    yield entries
+
+        return cls.from_rows(
+            ballot_type,
+            project_names,
+            [float(project.cost) for project in instance],
+            float(instance.budget_limit),
+            ballots(),
+        )
+
+    @classmethod
+    def from_election(cls, election: "Election"):
+        """Reads an election from the database with a constant number of queries."""
+        from pb_visualizer.models import PreferenceInfo
+
+        database = election._state.db or "default"
+        project_rows = list(election.projects.order_by("id").values_list("id", "project_id", "cost"))
+        project_pks = np.array([row[0] for row in project_rows], dtype=np.int64)
+        voter_pks = np.fromiter(election.voters.order_by("id").values_list("id", flat=True), dtype=np.int64)
+        # one row (voter, project, strength) per preference, the primary keys are exact in float64
+        preferences = np.array(
+            list(
+                PreferenceInfo.objects.using(database)
+                .filter(voter__election=election)
+                .order_by("voter_id", "-preference_strength", "id")
+                .values_list("voter_id", "project_id", "preference_strength")
+            ),
+            dtype=np.float64,
+        ).reshape(-1, 3)
+        voter_ids = preferences[:, 0].astype(np.int64)
+        # the projects and the voters are both sorted by primary key, so their numbers are found by bisection
+        indptr = np.searchsorted(voter_ids, voter_pks, side="left")
+        return cls(
+            election.ballot_type_id,
+            [row[1] for row in project_rows],
+            [float(row[2]) for row in project_rows],
+            float(election.budget),
+            np.append(indptr, len(voter_ids)),
+            np.searchsorted(project_pks, preferences[:, 1].astype(np.int64)),
+            None if election.ballot_type_id == "approval" else preferences[:, 2],
+        )
@@ -0,0 +1,149 @@
+import glob
+import os
+import pickle
+import tempfile
+import time
+
+import pabutools.fractions as fractions
+from django.conf import settings
+from pabutools.election import Instance, AbstractProfile
+
+import pb_visualizer
+from pb_visualizer.compact_profile import CompactProfile
+from pb_visualizer.models import Election
+
+
+# the age in seconds after which a temporary file is left by a writer that did not finish
+_TMP_FILE_MAX_AGE = 3600
+
+
+def cache_dir_path() -> str:
+    """Returns the folder of the parsed elections, PARSED_ELECTION_CACHE_DIR if it is set."""
+    return getattr(
+        settings,
+        "PARSED_ELECTION_CACHE_DIR",
+        os.path.join(os.path.dirname(pb_visualizer.__file__), "cache", "elections"),
+    )
+
+
+def _cache_file_prefix(election_id: int, database: str) -> str:
+    return os.path.join(cache_dir_path(), f"{database}_{election_id}_")
+
+
+def _cache_file_path(election_obj: Election, kind: str) -> str | None:
+    """
+    Returns the path of the cached election. It depends on the hash of the file, so that a
+    re-imported election is parsed again, and on the kind of representation, which for the
+    pabutools objects is their fraction mode.
+    """
+    if not election_obj.file_hash:
+        return None
+    database = election_obj._state.db or "default"
+    return _cache_file_prefix(election_obj.id, database) + f"{election_obj.file_hash}_{kind}.pickle"
+
+
+def _load(election_obj: Election, kind: str):
+    file_path = _cache_file_path(election_obj, kind)
+    if file_path is None or not os.path.exists(file_path):
+        return None
+    with open(file_path, "rb") as file:
+        return pickle.load(file)
+
+
+def _store(election_obj: Election, kind: str, content):
+    file_path = _cache_file_path(election_obj, kind)
+    if file_path is None:
+        return
+    # the versions parsed from another file are outdated
+    prefix = _cache_file_prefix(election_obj.id, election_obj._state.db or "default")
+    for outdated_file_path in glob.glob(glob.escape(prefix) + "*.pickle"):
+        if not outdated_file_path.startswith(prefix + election_obj.file_hash):
+            try:
+                os.remove(outdated_file_path)
+            except FileNotFoundError:
+                # removed by another process storing the election
+                pass
+    # the temporary files of the writers killed before their replace, the recent ones may still be written
+    for tmp_file_path in glob.glob(glob.escape(prefix) + "*.tmp"):
+        try:
+            if time.time() - os.path.getmtime(tmp_file_path) > _TMP_FILE_MAX_AGE:
+                os.remove(tmp_file_path)
+        except FileNotFoundError:
+            pass
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    # each writer has its own temporary file, the complete file replaces the entry at once even when
+    # several processes store the same election
+    file_descriptor, tmp_file_path = tempfile.mkstemp(
+        dir=os.path.dirname(file_path), prefix=os.path.basename(prefix), suffix=".tmp"
+    )
+    replaced = False
+    try:
+        with os.fdopen(file_descriptor, "wb") as file:
+            pickle.dump(content, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file_path, file_path)
+        replaced = True
+    finally:
+        if not replaced:
+            try:
+                os.remove(tmp_file_path)
+            except FileNotFoundError:
+                pass
+
+
+def _dump_profile(profile: AbstractProfile) -> tuple:
+    # profiles are lists or counters whose items are validated with attributes restored after
+    # them by pickle, so their state is stored separately
+    items = list(profile.items()) if isinstance(profile, dict) else list(profile)
+    return type(profile), profile.__dict__, items
+
+
+def _load_profile(profile_class, state: dict, items: list) -> AbstractProfile:
+    profile = profile_class.__new__(profile_class)
+    profile.__dict__.update(state)
+    if isinstance(profile, dict):
+        dict.update(profile, items)
+    else:
+        list.extend(profile, items)
+    return profile
+
+
+def load_parsed_election(election_obj: Election) -> tuple[Instance, AbstractProfile] | None:
+    """Returns the cached Instance and Profile of the election, None if they are not cached."""
+    content = _load(election_obj, fractions.FRACTION)
+    if content is None:
+        return None
+    instance, profile_state = content
+    return instance, _load_profile(*profile_state)
+
+
+def store_parsed_election(election_obj: Election, instance: Instance, profile: AbstractProfile):
+    """Caches the Instance and Profile of the election, replacing the outdated versions."""
+    # the instance and the ballots are dumped together so that they share the project objects
+    _store(election_obj, fractions.FRACTION, (instance, _dump_profile(profile)))
+
+
+# the kind of the cached CompactProfile, changed with its representation so that the outdated versions
+# are not read
+COMPACT_KIND = "compact64"
+
+
+def load_compact_profile(election_obj: Election) -> CompactProfile | None:
+    """Returns the cached CompactProfile of the election, None if it is not cached."""
+    return _load(election_obj, COMPACT_KIND)
+
+
+def store_compact_profile(election_obj: Election, compact_profile: CompactProfile):
+    """Caches the CompactProfile of the election, replacing the outdated versions."""
+    _store(election_obj, COMPACT_KIND, compact_profile)
+
+
+def clear_parsed_elections(election_ids: list[int], database: str = "default"):
+    """Removes the cached versions of the elections."""
+    for election_id in election_ids:
+        for file_path in glob.glob(glob.escape(_cache_file_prefix(election_id, database)) + "*.pickle"):
+            os.remove(file_path)
+        for file_path in glob.glob(glob.escape(_cache_file_prefix(election_id, database)) + "*.tmp"):
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,80 @@
+import hashlib
+import os
+import shutil
+
+from django.conf import settings
+
+import pb_visualizer
+
+# the raw files are kept in a hidden folder of the data folder, which collectstatic ignores
+STORE_DIR_NAME = ".store"
+
+
+def data_dir_path() -> str:
+    """Returns the path of the data folder of the app static files."""
+    return os.path.join(os.path.dirname(pb_visualizer.__file__), "static", "data")
+
+
+def file_hash(file_path: str, chunk_size: int = 1 << 20) -> str:
+    """Returns the sha256 hex digest of the content of the file."""
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _link_or_copy(source: str, target: str, link: bool = True):
+    """
+    Puts source at target with a hard link, or a copy if link is False or the two paths are not on
+    the same file system. An existing target is replaced atomically.
+    """
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_target = target + ".tmp"
+    if os.path.lexists(tmp_target):
+        os.remove(tmp_target)
+    linked = False
+    if link:
+        try:
+            os.link(source, tmp_target)
+            linked = True
+        except OSError:
+            pass
+    if not linked:
+        shutil.copyfile(source, tmp_target)
+    os.replace(tmp_target, target)
+
+
+def _is_published(source: str, source_hash: str, target: str) -> bool:
+    """Checks whether target already holds the content of source."""
+    if not os.path.exists(target):
+        return False
+    if os.path.samefile(source, target):
+        return True
+    return os.path.getsize(source) == os.path.getsize(target) and file_hash(target) == source_hash
+
+
+def store_file(file_path: str, file_name: str, verbosity: int = 1, content_hash: str = None) -> str:
+    """
+    Stores a .pb file once in the content-addressed store, under its hash, and publishes it as
+    data/file_name in the app static folder and, if set, in STATIC_ROOT. Only what changed is
+    written, so there is no need to run collectstatic after adding an election.
+    The hash of the file is computed unless content_hash is given. Returns the hash of the file.
+    """
+    if not content_hash:
+        content_hash = file_hash(file_path)
+    stored_path = os.path.join(data_dir_path(), STORE_DIR_NAME, content_hash + ".pb")
+    if not os.path.exists(stored_path):
+        # the input file is copied, linking it would let later edits of it change the stored content
+        _link_or_copy(file_path, stored_path, link=False)
+
+    publish_paths = [os.path.join(data_dir_path(), file_name)]
+    if getattr(settings, "STATIC_ROOT", None):
+        publish_paths.append(os.path.join(settings.STATIC_ROOT, "data", file_name))
+    for publish_path in publish_paths:
+        if not _is_published(stored_path, content_hash, publish_path):
+            if verbosity > 1:
+                print(f"publishing {publish_path}")
+            _link_or_copy(stored_path, publish_path)
+
+    return content_hash
@@ -0,0 +1,58 @@
+import hashlib
+import json
+from importlib.metadata import version
+
+import pabutools.fractions as fractions
+
+from pb_visualizer.models import Election, RuleResult
+from pb_visualizer.pabutools import rule_mapping
+
+PABUTOOLS_VERSION = version("pabutools")
+
+
+def _stable_value(value):
+    """Converts the rule definitions of rule_mapping to JSON values that do not depend on the process."""
+    if isinstance(value, dict):
+        return {str(key): _stable_value(item) for key, item in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        return [_stable_value(item) for item in value]
+    if isinstance(value, (bool, int, float, str)) or value is None:
+        return value
+    if hasattr(value, "__qualname__"):
+        return f"{value.__module__}.{value.__qualname__}"
+    return repr(value)
+
+
+def _hash(inputs: dict) -> str:
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def rule_result_fingerprint(election_obj: Election, rule: str) -> str:
+    """
+    The fingerprint of the inputs of a rule result: the file of the election, the definition of the
+    rule in rule_mapping with its parameters, the version of pabutools and the fraction mode in use.
+    """
+    return _hash(
+        {
+            "file_hash": election_obj.file_hash,
+            "rule": rule,
+            "definition": _stable_value(rule_mapping(election_obj.budget).get(rule)),
+            "pabutools": PABUTOOLS_VERSION,
+            "fraction": fractions.FRACTION,
+        }
+    )
+
+
+def rule_result_property_fingerprint(rule_result_obj: RuleResult, rule_property: str) -> str:
+    """
+    The fingerprint of the inputs of a rule result property: the fingerprint of the rule result, the
+    property, the version of pabutools and the fraction mode in use, which decides how it is computed.
+    """
+    return _hash(
+        {
+            "rule_result": rule_result_obj.fingerprint,
+            "property": rule_property,
+            "pabutools": PABUTOOLS_VERSION,
+            "fraction": fractions.FRACTION,
+        }
+    )
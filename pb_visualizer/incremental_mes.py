@@ -0,0 +1,149 @@
+from copy import copy, deepcopy
+
+from pabutools.election import AbstractApprovalProfile, AbstractProfile, Instance
+from pabutools.fractions import frac
+from pabutools.rules import BudgetAllocation, greedy_utilitarian_welfare
+from pabutools.rules.mes.mes_rule import MESProject, MESVoter, mes_inner_algo
+from pabutools.tiebreaking import lexico_tie_breaking
+
+MES_VARIANT_SUFFIXES = {"_uncompleted": "uncompleted", "_greedy": "greedy"}
+
+
+def mes_variant(rule: str) -> tuple[str, str] | None:
+    """
+    Splits the abbreviation of a MES rule of rule_mapping into its satisfaction and its variant:
+    "uncompleted", "greedy" or "exhaustion" (the completion by budget increase). Returns None for
+    the other rules.
+    """
+    if not rule.startswith("mes_"):
+        return None
+    for suffix, variant in MES_VARIANT_SUFFIXES.items():
+        if rule.endswith(suffix):
+            return rule[len("mes_"):-len(suffix)], variant
+    return rule[len("mes_"):], "exhaustion"
+
+
+class IncrementalMES:
+    """
+    Runs the resolute Method of Equal Shares of pabutools on an election for several budget limits.
+    The satisfaction of every supporter of every project is computed once, each run only resets the
+    budgets of the voters, as the iterated variant of method_of_equal_shares_scheme does.
+    """
+
+    def __init__(self, instance: Instance, profile: AbstractProfile, sat_class):
+        self.instance = instance
+        self.profile = profile
+        sat_profile = profile.as_sat_profile(sat_class=sat_class)
+        binary_sat = isinstance(profile, AbstractApprovalProfile)
+
+        self.voters = [
+            MESVoter(index, sat.ballot, sat, 0, sat_profile.multiplicity(sat))
+            for index, sat in enumerate(sat_profile)
+        ]
+        self.projects = set()
+        self.initial_budget_allocation = BudgetAllocation()
+        for p in instance:
+            mes_p = MESProject(p)
+            total_sat = 0
+            for i, v in enumerate(self.voters):
+                indiv_sat = v.sat.sat_project(p)
+                if indiv_sat > 0:
+                    total_sat += v.total_sat_project(p)
+                    mes_p.supporter_indices.append(i)
+                    if binary_sat:
+                        mes_p.unique_sat_supporter = indiv_sat
+                    else:
+                        mes_p.sat_supporter_map[v] = indiv_sat
+            if total_sat > 0:
+                if p.cost > 0:
+                    mes_p.total_sat = total_sat
+                    afford = frac(p.cost, total_sat)
+                    mes_p.initial_affordability = afford
+                    mes_p.affordability = afford
+                    self.projects.add(mes_p)
+                else:
+                    self.initial_budget_allocation.append(p)
+
+    def run(self, budget_limit) -> BudgetAllocation:
+        """The outcome of method_of_equal_shares with the given budget limit."""
+        if self.profile.num_ballots() == 0:
+            return BudgetAllocation()
+        budget_per_voter = frac(budget_limit, self.profile.num_ballots())
+        for voter in self.voters:
+            voter.budget = budget_per_voter
+        for p in self.projects:
+            p.affordability = p.initial_affordability
+        all_budget_allocations = []
+        mes_inner_algo(
+            self.instance,
+            self.profile,
+            self.voters,
+            copy(self.projects),
+            lexico_tie_breaking,
+            deepcopy(self.initial_budget_allocation),
+            all_budget_allocations,
+            True,
+            None,
+            False,
+            False,
+        )
+        return all_budget_allocations[0]
+
+    def run_budget_steps(self, budget_step, first_outcome: BudgetAllocation | None = None) -> BudgetAllocation:
+        """
+        The outcome of exhaustion_by_budget_increase over MES: the budget limit is increased by
+        budget_step until the outcome is exhaustive or infeasible. Every step is run, as pabutools
+        does, since the exhaustiveness and the feasibility of the outcome are not monotone in the
+        budget limit: a binary search or a start from a later step could stop at another step. What
+        is saved is the setup of every run, and the first one whose outcome can be given.
+        """
+        budget_limit = self.instance.budget_limit
+        # the step of rule_mapping is a float, which cannot be added to exact fractions
+        budget_step = frac(budget_step)
+        budget_bound = self.instance.budget_limit * (self.profile.num_ballots() + 1)
+        previous_outcome = BudgetAllocation()
+        outcome = first_outcome
+        while budget_limit <= budget_bound:
+            if outcome is None:
+                outcome = self.run(budget_limit)
+            if not self.instance.is_feasible(outcome):
+                return previous_outcome
+            if self.instance.is_exhaustive(outcome):
+                return outcome
+            budget_limit += budget_step
+            previous_outcome = outcome
+            outcome = None
+        return previous_outcome
+
+
+def _greedy_completion(instance: Instance, profile: AbstractProfile, outcome: BudgetAllocation, greedy_params: dict):
+    # as completion_by_rule_combination, an exhaustive outcome is not completed
+    if instance.is_exhaustive(outcome):
+        return outcome
+    return greedy_utilitarian_welfare(instance, profile, initial_budget_allocation=outcome, **greedy_params)
+
+
+def run_mes_variants(instance: Instance, profile: AbstractProfile, rule_definitions: dict, rules: list[str]) -> dict:
+    """
+    Computes the given MES rules of rule_mapping sharing the same satisfaction, rule_definitions
+    being rule_mapping. The MES outcome for the actual budget is computed once, it is the
+    uncompleted outcome, the start of the greedy completion and the first step of the budget
+    increase. Returns the outcome of every rule.
+    """
+    variants = {mes_variant(rule)[1]: rule for rule in rules}
+    sat = mes_variant(rules[0])[0]
+    sat_class = rule_definitions[f"mes_{sat}_uncompleted"]["params"]["sat_class"]
+    mes = IncrementalMES(instance, profile, sat_class)
+    mes_outcome = mes.run(instance.budget_limit)
+
+    res = {}
+    if "uncompleted" in variants:
+        res[variants["uncompleted"]] = mes_outcome
+    if "greedy" in variants:
+        greedy_params = rule_definitions[variants["greedy"]]["params"]["rule_params"][1]
+        res[variants["greedy"]] = _greedy_completion(instance, profile, mes_outcome, greedy_params)
+    if "exhaustion" in variants:
+        exhaustion_params, greedy_params = rule_definitions[variants["exhaustion"]]["params"]["rule_params"]
+        outcome = mes.run_budget_steps(exhaustion_params["budget_step"], mes_outcome)
+        res[variants["exhaustion"]] = _greedy_completion(instance, profile, outcome, greedy_params)
+    return res
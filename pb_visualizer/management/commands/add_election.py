@@ -1,19 +1,29 @@
 import datetime
+import multiprocessing
 import os
-import shutil
 import traceback
 import random
- 
+from collections import deque
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+
+import django
 from django.core import management
 from django.contrib.staticfiles import finders
 from django.core.management.base import BaseCommand
+from django.db import connections, transaction
 from django.db.models import Max
 from django.utils import timezone
-from pabutools.election import Instance, Profile
-from pabutools.election.pabulib import parse_pabulib
+from pabutools.election import Instance
 
 import pb_visualizer
+from pb_visualizer.election_cache import clear_parsed_elections
+from pb_visualizer.file_store import file_hash, store_file
+from pb_visualizer.management.commands.utils import delete_rule_results, refresh_election_property_rows
 from pb_visualizer.models import *
+from pb_visualizer.pabulib import ballot_preferences, iter_pabulib_votes, read_pabulib_instance
 
 # here we can add multiple aliases for each of the vote types, rules and genders
 ballot_type_mapping = {
@@ -35,6 +45,9 @@ gender_mapping = {
     GENDER_UNKNOWN: ["", "\\n", "unknown"],
 }
 
+# the number of voter batches a worker of iter_prepared_elections sends ahead of the writer
+STREAMED_BATCHES = 2
+
 
 def raise_missing_data_exception(type, key, additional_info=""):
     raise Exception(
@@ -71,6 +84,7 @@ def collect_election_info(
     has_neighborhoods: bool,
     file_name: str,
     file_size: int,
+    file_hash: str = "",
     randomize_name: bool = False,
     verbosity: int = 1,
 ):
@@ -81,7 +95,8 @@ def collect_election_info(
     election_info = instance_pabutools.meta
 
     election_defaults["num_projects"] = num_projects
-    election_defaults["num_votes"] = num_votes
+    if num_votes is not None:
+        election_defaults["num_votes"] = num_votes
 
     for key in election_info:
         # first the simple fields
@@ -114,7 +129,7 @@ def collect_election_info(
             election_meta_data[key] = election_info[key]
 
         elif key in ["num_projects", "num_votes"]:
-            if election_defaults[key] != int(election_info[key]):
+            if key in election_defaults and election_defaults[key] != int(election_info[key]):
                 if verbosity > 0:
                     print(
                         "warning: "
@@ -185,6 +200,7 @@ def collect_election_info(
     election_defaults["has_neighborhoods"] = has_neighborhoods
     election_defaults["file_name"] = file_name
     election_defaults["file_size"] = file_size
+    election_defaults["file_hash"] = file_hash
 
     election_defaults["is_trivial"] = instance_pabutools.is_trivial()
 
@@ -277,101 +293,316 @@ def collect_projects_info(instance_pabutools: Instance, verbosity: int = 1):
     }
 
 
-def collect_voters_info(
-    profile_pabutools: Profile, ballot_type: str, verbosity: int = 1
+def collect_voter_info(
+    voter_row: dict, ballot_type: str, unknown_keys: list, verbosity: int = 1
 ):
-    voters_defaults = {}
-    voters_foreign_keys = {}
-    # containers for the voting methods model objects
-    voting_methods_set = set()
-    neighborhoods_set = set()
+    voter_defaults = {}
+    voter_foreign_keys = {}
+
+    # add info of the votes
+    voter_foreign_keys["votes"] = ballot_preferences(voter_row, ballot_type)
+
+    # add info of voters
+    for key in voter_row:
+        if key == "voter_id":
+            voter_defaults[key] = voter_row[key]
+        elif key == "age":
+            if voter_row[key] != "":
+                voter_defaults[key] = voter_row[key]
+        elif key == "sex":
+            for gender in gender_mapping:
+                if voter_row[key].lower() in gender_mapping[gender]:
+                    voter_defaults["gender"] = gender
+                    break
+            else:
+                raise Exception(
+                    "Invalid pb file. The gender should be one of the following: {}. I was given {}".format(
+                        str(
+                            [
+                                gender + ": " + str(gender_mapping[gender])
+                                for gender in gender_mapping
+                            ]
+                        ),
+                        voter_row[key].lower(),
+                    )
+                )
+
+        elif key in ["voting_method", "neighborhood"]:
+            voter_foreign_keys[key] = voter_row[key]
+
+        else:
+            if key not in unknown_keys and key not in ["vote", "points"]:
+                unknown_keys.append(key)
+                if verbosity > 0:
+                    print("ignoring unknown key for voter data: ", key)
 
+    for field in Voter._meta.get_fields():
+        if (
+            not field.auto_created
+            and not field.blank
+            and not field.has_default()
+            and field.name not in voter_defaults
+            and field.name not in voter_foreign_keys
+        ):
+            if field.name not in ["election", "votes"]:
+                raise_missing_data_exception("vote", field.name)
+
+    return voter_defaults, voter_foreign_keys
+
+
+def iter_voters_info(voter_rows: Iterable[dict], ballot_type: str, verbosity: int = 1):
+    """Translates the voter rows of a pabulib file into (voter_defaults, voter_foreign_keys) pairs, lazily."""
     unknown_keys = []
-    # we iterate through the keys of the file and translate them for our Voter objects
-
-    for profile in profile_pabutools:
-        voter_defaults = {}
-        voter_foreign_keys = {}
-        voter_info = profile.meta
-
-        # add info of the votes
-        voter_foreign_keys["votes"] = {}
-        for index, project in enumerate(profile):
-            if ballot_type == "approval":
-                voter_foreign_keys["votes"][project] = 1
-            if ballot_type == "ordinal":
-                voter_foreign_keys["votes"][project] = len(profile) - index
-            if ballot_type in ["cumulative", "cardinal"]:
-                voter_foreign_keys["votes"][project] = profile[project]
-
-        # add info of voters
-        for key in voter_info:
-            if key == "voter_id":
-                voter_defaults[key] = voter_info[key]
-            elif key == "age":
-                if voter_info[key] != "":
-                    voter_defaults[key] = voter_info[key]
-            elif key == "sex":
-                for gender in gender_mapping:
-                    if voter_info[key].lower() in gender_mapping[gender]:
-                        voter_defaults["gender"] = gender
-                        break
-                else:
-                    raise Exception(
-                        "Invalid pb file. The gender should be one of the following: {}. I was given {}".format(
-                            str(
-                                [
-                                    gender + ": " + str(gender_mapping[gender])
-                                    for gender in gender_mapping
-                                ]
-                            ),
-                            voter_info[key].lower(),
-                        )
-                    )
+    for voter_row in voter_rows:
+        yield collect_voter_info(voter_row, ballot_type, unknown_keys, verbosity)
+
+
+def _chunks(iterable, size):
+    """Yields successive lists of at most size elements of the iterable."""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def _bulk_create_named(model_class, election_obj, names, database):
+    """Creates one object of model_class per name for the election, returns them indexed by name."""
+    objs = {name: model_class(election=election_obj, name=name) for name in names}
+    model_class.objects.using(database).bulk_create(objs.values())
+    _fetch_missing_ids(objs.values(), model_class, "name", election_obj, database)
+    return objs
+
+
+def _get_or_create_named(model_class, election_obj, objs, name, database):
+    """Returns the object of model_class with the given name from objs, creating it if needed."""
+    if name not in objs:
+        objs[name] = model_class.objects.using(database).create(election=election_obj, name=name)
+    return objs[name]
+
+
+def _fetch_missing_ids(objs, model_class, key_field, election_obj, database):
+    """
+    Sets the primary keys of freshly bulk-created objects on backends that cannot return them
+    from the insert statement, using one query on the election-unique key_field.
+    """
+    if connections[database].features.can_return_rows_from_bulk_insert:
+        return
+    ids = dict(
+        model_class.objects.using(database)
+        .filter(election=election_obj, **{key_field + "__in": [getattr(obj, key_field) for obj in objs]})
+        .values_list(key_field, "id")
+    )
+    for obj in objs:
+        obj.id = ids[getattr(obj, key_field)]
+
+
+# fields compared to decide whether an existing project or voter has to be updated
+PROJECT_FIELDS = ["cost", "name", "description"]
+VOTER_FIELDS = ["age", "gender", "voting_method", "neighborhood"]
+
+
+def _differs(obj, row: dict, field_names: list) -> bool:
+    """Checks whether the unsaved obj differs from the database row (as returned by values()) on the given fields."""
+    for field_name in field_names:
+        field = obj._meta.get_field(field_name)
+        if field.to_python(getattr(obj, field.attname)) != field.to_python(row[field_name]):
+            return True
+    return False
+
+
+def _delete_ids(model_class, ids, database, batch_size=1000):
+    """Deletes the objects of model_class with the given primary keys, batch_size at a time."""
+    for ids_batch in _chunks(ids, batch_size):
+        model_class.objects.using(database).filter(id__in=ids_batch).delete()
+
+
+def _sync_named(model_class, election_obj, names, database):
+    """
+    Makes the objects of model_class of the election match the given names, creating the missing
+    ones and removing the others. Returns them indexed by name.
+    """
+    objs = {obj.name: obj for obj in model_class.objects.using(database).filter(election=election_obj)}
+    _delete_ids(model_class, [obj.id for name, obj in objs.items() if name not in names], database)
+    objs = {name: obj for name, obj in objs.items() if name in names}
+    objs.update(_bulk_create_named(model_class, election_obj, set(names) - set(objs), database))
+    return objs
+
+
+def _sync_links(through_model, election_obj, related_field, links, database, batch_size):
+    """
+    Makes the rows of the project M2M through_model of the election match links, a set of
+    (project id, related id) pairs, by adding and removing only the rows that differ.
+    """
+    existing_links = {
+        (project_id, related_id): link_id
+        for link_id, project_id, related_id in through_model.objects.using(database)
+        .filter(project__election=election_obj)
+        .values_list("id", "project_id", related_field + "_id")
+    }
+    _delete_ids(
+        through_model, [link_id for link, link_id in existing_links.items() if link not in links], database, batch_size
+    )
+    through_model.objects.using(database).bulk_create(
+        [
+            through_model(**{"project_id": project_id, related_field + "_id": related_id})
+            for project_id, related_id in links
+            if (project_id, related_id) not in existing_links
+        ],
+        batch_size=batch_size,
+    )
 
-            elif key == "voting_method":
-                voting_methods_set.add(voter_info[key])
-                voter_foreign_keys[key] = voter_info[key]
 
-            elif key == "neighborhood":
-                neighborhoods_set.add(voter_info[key])
-                voter_foreign_keys[key] = voter_info[key]
+def _write_projects(election_obj, projects_info, database, batch_size):
+    """
+    Writes the projects of the election with their categories and targets, only adding, updating
+    and removing what differs from the database. Returns the project objects indexed by project id.
+    """
+    projects_defaults = projects_info["projects_defaults"]
+    categories_obj = _sync_named(Category, election_obj, projects_info["categories_set"], database)
+    targets_obj = _sync_named(Target, election_obj, projects_info["targets_set"], database)
+
+    existing_projects = {
+        row["project_id"]: row
+        for row in Project.objects.using(database)
+        .filter(election=election_obj)
+        .values("id", "project_id", *PROJECT_FIELDS)
+    }
+    _delete_ids(
+        Project,
+        [row["id"] for project_id, row in existing_projects.items() if project_id not in projects_defaults],
+        database,
+        batch_size,
+    )
 
+    projects_obj = {}
+    for project_ids in _chunks(projects_defaults, batch_size):
+        new_project_objs, changed_project_objs = [], []
+        for project_id in project_ids:
+            project_obj = Project(election=election_obj, **projects_defaults[project_id])
+            if project_id in existing_projects:
+                project_obj.id = existing_projects[project_id]["id"]
+                if _differs(project_obj, existing_projects[project_id], PROJECT_FIELDS):
+                    changed_project_objs.append(project_obj)
             else:
-                if key not in unknown_keys and key != "vote":
-                    unknown_keys.append(key)
-                    if verbosity > 0:
-                        print("ignoring unknown key for voter data: ", key)
-
-        voters_defaults[voter_info["voter_id"]] = voter_defaults
-        voters_foreign_keys[voter_info["voter_id"]] = voter_foreign_keys
+                new_project_objs.append(project_obj)
+            projects_obj[project_id] = project_obj
+        Project.objects.using(database).bulk_create(new_project_objs)
+        _fetch_missing_ids(new_project_objs, Project, "project_id", election_obj, database)
+        Project.objects.using(database).bulk_update(changed_project_objs, PROJECT_FIELDS)
+
+    category_links, target_links = set(), set()
+    for project_id, project_obj in projects_obj.items():
+        project_foreign_keys = projects_info["projects_foreign_keys"][project_id]
+        for category in project_foreign_keys.get("categories", []):
+            category_links.add((project_obj.id, categories_obj[category].id))
+        for target in project_foreign_keys.get("targets", []):
+            target_links.add((project_obj.id, targets_obj[target].id))
+    _sync_links(Project.categories.through, election_obj, "category", category_links, database, batch_size)
+    _sync_links(Project.targets.through, election_obj, "target", target_links, database, batch_size)
+
+    return projects_obj
+
+
+def _write_voters(election_obj, voters_info, projects_obj, database, size_limits, batch_size, verbosity):
+    """
+    Writes the voters of the election and their preferences batch by batch, only adding, updating
+    and removing what differs from the database. Returns the number of voters.
+    """
+    voting_methods_obj = {obj.name: obj for obj in VotingMethod.objects.using(database).filter(election=election_obj)}
+    neighborhoods_obj = {obj.name: obj for obj in Neighborhood.objects.using(database).filter(election=election_obj)}
+    # the voters of the database that have not been met in the file yet
+    remaining_voter_ids = dict(
+        Voter.objects.using(database).filter(election=election_obj).values_list("voter_id", "id")
+    )
 
-        for field in Voter._meta.get_fields():
-            if (
-                not field.auto_created
-                and not field.blank
-                and not field.has_default()
-                and field.name not in voters_defaults[voter_info["voter_id"]]
-                and field.name not in voters_foreign_keys[voter_info["voter_id"]]
+    # only one batch is kept in memory
+    num_votes = 0
+    for voters_batch in voters_info:
+        voter_objs = []
+        for voter_defaults, voter_foreign_keys in voters_batch:
+            if "voting_method" in voter_foreign_keys:
+                voter_defaults["voting_method"] = _get_or_create_named(
+                    VotingMethod, election_obj, voting_methods_obj, voter_foreign_keys["voting_method"], database
+                )
+            if "neighborhood" in voter_foreign_keys:
+                voter_defaults["neighborhood"] = _get_or_create_named(
+                    Neighborhood, election_obj, neighborhoods_obj, voter_foreign_keys["neighborhood"], database
+                )
+            voter_obj = Voter(election=election_obj, **voter_defaults)
+            voter_obj.id = remaining_voter_ids.pop(voter_obj.voter_id, None)
+            voter_objs.append(voter_obj)
+
+        # the voters of the batch already in the database, with their preferences
+        existing_ids = [voter_obj.id for voter_obj in voter_objs if voter_obj.id is not None]
+        existing_voters, existing_preferences = {}, {}
+        if existing_ids:
+            existing_voters = {
+                row["id"]: row
+                for row in Voter.objects.using(database).filter(id__in=existing_ids).values("id", *VOTER_FIELDS)
+            }
+            for voter_id, project_id, preference_strength in (
+                PreferenceInfo.objects.using(database)
+                .filter(voter_id__in=existing_ids)
+                .values_list("voter_id", "project_id", "preference_strength")
             ):
-                if field.name not in ["election", "votes"]:
-                    raise_missing_data_exception("vote", field.name)
+                existing_preferences.setdefault(voter_id, {})[project_id] = preference_strength
+
+        new_voter_objs = [voter_obj for voter_obj in voter_objs if voter_obj.id is None]
+        Voter.objects.using(database).bulk_create(new_voter_objs)
+        _fetch_missing_ids(new_voter_objs, Voter, "voter_id", election_obj, database)
+        Voter.objects.using(database).bulk_update(
+            [
+                voter_obj
+                for voter_obj in voter_objs
+                if voter_obj.id in existing_voters and _differs(voter_obj, existing_voters[voter_obj.id], VOTER_FIELDS)
+            ],
+            VOTER_FIELDS,
+        )
 
-    return {
-        "voters_defaults": voters_defaults,
-        "voters_foreign_keys": voters_foreign_keys,
-        "voting_methods_set": voting_methods_set,
-        "neighborhoods_set": neighborhoods_set,
-    }
+        pref_info_objs, outdated_voter_ids = [], []
+        for (_, voter_foreign_keys), voter_obj in zip(voters_batch, voter_objs):
+            votes = voter_foreign_keys["votes"]
+            for project in votes:
+                if project not in projects_obj:
+                    raise Exception(
+                        f"Invalid pb file. Voter {voter_obj.voter_id} votes for the unknown project {project}."
+                    )
+            preferences = {projects_obj[project].id: float(votes[project]) for project in votes}
+            if voter_obj.id in existing_voters:
+                if preferences == existing_preferences.get(voter_obj.id, {}):
+                    continue
+                outdated_voter_ids.append(voter_obj.id)
+            pref_info_objs.extend(
+                PreferenceInfo(voter_id=voter_obj.id, project_id=project_id, preference_strength=preference_strength)
+                for project_id, preference_strength in preferences.items()
+            )
+        PreferenceInfo.objects.using(database).filter(voter_id__in=outdated_voter_ids).delete()
+        PreferenceInfo.objects.using(database).bulk_create(pref_info_objs, batch_size=batch_size)
 
+        num_votes += len(voter_objs)
+        if "votes" in size_limits and num_votes > size_limits["votes"]:
+            raise ValueError(f"Size limit exceeded. Current limits: {size_limits}")
+        if verbosity > 1:
+            print(f"{num_votes} voters written", end="\r")
 
-def add_election(file_path: str, override: bool, database: str = 'default', size_limits: dict = {}, verbosity: int = 1) -> str:
-    # We read and parse the file
-    # size_limits can contain keys "votes" and/or "projects" with an integer.
-    # If the number of voters/projects exceeds this number an exception will be raised. 
+    # the voters that are not in the file anymore are removed, and the voting methods and
+    # neighborhoods nobody uses with them
+    _delete_ids(Voter, list(remaining_voter_ids.values()), database, batch_size)
+    VotingMethod.objects.using(database).filter(election=election_obj, voters__isnull=True).delete()
+    Neighborhood.objects.using(database).filter(election=election_obj, voters__isnull=True).delete()
+
+    return num_votes
+
+
+def prepare_election(file_path: str, randomize_name: bool = False, verbosity: int = 1) -> dict:
+    """
+    Parses a .pb file and collects everything needed to write the election, without touching the
+    database. The voters are not read yet, "voters_info" lazily goes through the votes of the file.
+    """
     if verbosity > 1:
         print("parsing file...")
-    instance_pabutools, profile_pabutools = parse_pabulib(file_path)
+    # only the META and PROJECTS sections are parsed here, the votes are streamed from the file
+    # while the voters are written to the database
+    instance_pabutools = read_pabulib_instance(file_path)
     ballot_type = instance_pabutools.meta["vote_type"]
     if ballot_type == None:
         raise_missing_data_exception("election", "vote_type")
@@ -381,20 +612,132 @@ def add_election(file_path: str, override: bool, database: str = 'default', size
     # We construct the defaults dictionary for each model object we want to create
     # the foreign_keys dicts hold the ids of referenced objects
     projects_info = collect_projects_info(instance_pabutools, verbosity)
-    voters_info = collect_voters_info(profile_pabutools, ballot_type, verbosity)
+    # the voter related fields are only known once all votes have been read, they are updated at the end
     election_info = collect_election_info(
         instance_pabutools,
         len(projects_info["projects_defaults"]),
-        len(voters_info["voters_defaults"]),
+        None,
         len(projects_info["categories_set"]) > 0,
         len(projects_info["targets_set"]) > 0,
-        len(voters_info["voting_methods_set"]) > 0,
-        len(voters_info["neighborhoods_set"]) > 0,
+        False,
+        False,
         os.path.basename(file_path),
         os.path.getsize(file_path),
-        randomize_name = (database=="user_submitted"),
+        file_hash(file_path),
+        randomize_name = randomize_name,
         verbosity = verbosity,
     )
+    voters_info = iter_voters_info(
+        iter_pabulib_votes(file_path), election_info["foreign_keys"]["ballot_type"], verbosity
+    )
+    return {
+        "file_path": file_path,
+        "projects_info": projects_info,
+        "election_info": election_info,
+        "voters_info": voters_info,
+        "declared_num_votes": instance_pabutools.meta.get("num_votes"),
+    }
+
+
+def stream_election_batches(
+    queue, file_path: str, randomize_name: bool = False, batch_size: int = 1000, verbosity: int = 1
+):
+    """
+    Same as prepare_election, run by a worker process: the prepared election without its voters is put
+    in the queue, then the voters in batches of batch_size as they are read, then None, also when the
+    file cannot be parsed. A bounded queue keeps only a few batches of the file in memory.
+    """
+    try:
+        prepared_election = prepare_election(file_path, randomize_name, verbosity)
+        voters_info = prepared_election.pop("voters_info")
+        queue.put(prepared_election)
+        for voters_batch in _chunks(voters_info, batch_size):
+            queue.put(voters_batch)
+    finally:
+        queue.put(None)
+
+
+class StreamedElection:
+    """
+    An election prepared by a worker of iter_prepared_elections with stream_election_batches, read
+    from its queue. get returns what write_election expects, its voter batches being read while they
+    are written, and raises the exception met by the worker.
+    """
+
+    def __init__(self, future, queue):
+        self.future = future
+        self.queue = queue
+        self.done = False
+
+    def _next(self):
+        item = self.queue.get()
+        if item is None:
+            self.done = True
+            # raises the exception of the worker, if any
+            self.future.result()
+        return item
+
+    def _voter_batches(self):
+        while (voters_batch := self._next()) is not None:
+            yield voters_batch
+
+    def get(self) -> dict:
+        prepared_election = self._next()
+        prepared_election["voter_batches"] = self._voter_batches()
+        return prepared_election
+
+    def drain(self):
+        """Reads what the writer left in the queue, so that the worker can finish."""
+        while not self.done:
+            if self.queue.get() is None:
+                self.done = True
+
+
+def add_election(
+    file_path: str,
+    override: bool,
+    database: str = 'default',
+    size_limits: dict = {},
+    batch_size: int = 1000,
+    verbosity: int = 1,
+) -> Election:
+    # We read and parse the file
+    # size_limits can contain keys "votes" and/or "projects" with an integer.
+    # If the number of voters/projects exceeds this number an exception will be raised. 
+    # The objects are written with bulk inserts of at most batch_size rows, in one transaction per election.
+    prepared_election = prepare_election(
+        file_path, randomize_name=(database=="user_submitted"), verbosity=verbosity
+    )
+    return write_election(prepared_election, override, database, size_limits, batch_size, verbosity)
+
+
+def write_election(
+    prepared_election: dict,
+    override: bool,
+    database: str = 'default',
+    size_limits: dict = {},
+    batch_size: int = 1000,
+    verbosity: int = 1,
+) -> Election:
+    # Writes an election returned by prepare_election or StreamedElection.get to the database.
+    # If the election already exists, only the differences with the file are applied to it.
+    file_path = prepared_election["file_path"]
+    projects_info = prepared_election["projects_info"]
+    election_info = prepared_election["election_info"]
+    # voters already cut in batches by stream_election_batches are written as they are
+    if "voter_batches" in prepared_election:
+        voters_info = prepared_election["voter_batches"]
+    else:
+        voters_info = _chunks(prepared_election["voters_info"], batch_size)
+
+    election_obj = Election.objects.using(database).filter(name=election_info["defaults"]["name"]).first()
+    if election_obj is not None:
+        if election_obj.file_hash and election_obj.file_hash == election_info["defaults"]["file_hash"]:
+            if verbosity > 0:
+                print(f"election {election_obj.name} is unchanged, skipping")
+            return election_obj
+        if not override:
+            raise Exception(f"Election with name {election_info['defaults']['name']} already exists")
 
     if verbosity > 1:
         print("collecting references...")
@@ -404,157 +747,141 @@ def add_election(file_path: str, override: bool, database: str = 'default', size
     rule_obj = Rule.objects.using(database).get(abbreviation=election_info["foreign_keys"]["rule"])
     election_info["defaults"]["rule"] = rule_obj
 
-    # check size limits if provided
-    if "votes" in size_limits:
-        if election_info["defaults"]["num_votes"] > size_limits["votes"]:
-            raise ValueError(f"Size limit exceeded. Current limits: {size_limits}")
+    # check size limits if provided, the number of votes is checked while reading them
     if "projects" in size_limits:
         if election_info["defaults"]["num_projects"] > size_limits["projects"]:
             raise ValueError(f"Size limit exceeded. Current limits: {size_limits}")
 
-    # create election object
-    election_query = Election.objects.using(database).filter(name=election_info["defaults"]["name"])
-    if election_query.exists():
-        if override:
+    with transaction.atomic(using=database):
+        # create or update election object
+        if election_obj is None:
             if verbosity > 1:
-                print("removing existing election...")
-            election_query.delete()
+                print("creating election object {}".format(election_info["defaults"]["name"]))
+            election_obj = Election.objects.using(database).create(**election_info["defaults"])
         else:
-            raise Exception(f"Election with name {election_info['defaults']['name']} already exists")
-
-    if verbosity > 1:
-        print("creating election object {}".format(election_info["defaults"]["name"]))
-    election_obj = Election.objects.using(database).create(**election_info["defaults"])
-
-    # create election data properties
-    for metadata in election_info["meta_data"]:
-        election_metadata_obj = ElectionMetadata.objects.using(database).get(short_name=metadata)
-        if (
-            election_info["defaults"]["ballot_type"]
-            in election_metadata_obj.applies_to.all()
-        ):
-            ElectionDataProperty.objects.using(database).create(
-                election=election_obj,
-                metadata=election_metadata_obj,
-                value=election_info["meta_data"][metadata],
-            )
-        else:
-            if verbosity > 0:
-                print(
-                    "Ignoring field "
-                    + metadata
-                    + " for vote type "
-                    + election_info["defaults"]["ballot_type"].name
+            if verbosity > 1:
+                print("updating existing election...")
+            # everything computed from the previous file is outdated, the rule results are deleted
+            # first for their aggregates to be removed from the cell of the previous election
+            delete_rule_results(RuleResult.objects.filter(election=election_obj), database)
+            for field, value in election_info["defaults"].items():
+                setattr(election_obj, field, value)
+            election_obj.save(using=database)
+            clear_parsed_elections([election_obj.id], database)
+            ElectionDataProperty.objects.using(database).filter(election=election_obj).delete()
+
+        # create election data properties
+        applying_metadata = set(
+            ElectionMetadata.objects.using(database)
+            .filter(applies_to=election_info["defaults"]["ballot_type"])
+            .values_list("short_name", flat=True)
+        )
+        data_property_objs = []
+        for metadata in election_info["meta_data"]:
+            if metadata in applying_metadata:
+                data_property_objs.append(
+                    ElectionDataProperty(
+                        election=election_obj,
+                        metadata_id=metadata,
+                        value=election_info["meta_data"][metadata],
+                    )
                 )
+            else:
+                if verbosity > 0:
+                    print(
+                        "Ignoring field "
+                        + metadata
+                        + " for vote type "
+                        + election_info["defaults"]["ballot_type"].name
+                    )
+        ElectionDataProperty.objects.using(database).bulk_create(data_property_objs)
+        refresh_election_property_rows([election_obj.id], database)
 
-    # create containers for all created objects and fill them
-    categories_obj, targets_obj, voting_methods_obj, neighborhoods_obj, projects_obj = (
-        {},
-        {},
-        {},
-        {},
-        {},
-    )
+        if verbosity > 1:
+            print("writing project objects...")
+        projects_obj = _write_projects(election_obj, projects_info, database, batch_size)
 
-    for category in projects_info["categories_set"]:
-        categories_obj[category] = Category.objects.using(database).create(
-            election=election_obj, name=category
+        if verbosity > 1:
+            print("writing voter objects...")
+        num_votes = _write_voters(
+            election_obj, voters_info, projects_obj, database, size_limits, batch_size, verbosity
         )
-    for target in projects_info["targets_set"]:
-        targets_obj[target] = Target.objects.using(database).create(election=election_obj, name=target)
-    for voting_method in voters_info["voting_methods_set"]:
-        voting_methods_obj[voting_method] = VotingMethod.objects.using(database).create(
-            election=election_obj, name=voting_method
-        )
-    for neighborhood in voters_info["neighborhoods_set"]:
-        neighborhoods_obj[neighborhood] = Neighborhood.objects.using(database).create(
-            election=election_obj, name=neighborhood
-        )
-    if verbosity > 1:
-        print("creating project objects...")
-    # create project objects
-    for index, project_id in enumerate(projects_info["projects_defaults"]):
-        # if verbosity > 1: print(str(index) + "/" + str(len(projects_defaults)), end="\r")
-        project_obj = Project.objects.using(database).create(
-            election=election_obj, **projects_info["projects_defaults"][project_id]
-        )
-
-        if "categories" in projects_info["projects_foreign_keys"][project_id]:
-            project_obj.categories.set(
-                [
-                    categories_obj[category]
-                    for category in projects_info["projects_foreign_keys"][project_id][
-                        "categories"
-                    ]
-                ]
-            )
-
-        if "targets" in projects_info["projects_foreign_keys"][project_id]:
-            project_obj.targets.set(
-                [
-                    targets_obj[target]
-                    for target in projects_info["projects_foreign_keys"][project_id][
-                        "targets"
-                    ]
-                ]
-            )
 
-        projects_obj[project_id] = project_obj
+        # now that all votes have been read, we can fill in the voter related fields
+        declared_num_votes = prepared_election["declared_num_votes"]
+        if declared_num_votes is not None and int(declared_num_votes) != num_votes:
+            if verbosity > 0:
+                print("warning: num_votes does not match the actual number in the file, ignoring the field")
+        election_obj.num_votes = num_votes
+        election_obj.has_voting_methods = VotingMethod.objects.using(database).filter(election=election_obj).exists()
+        election_obj.has_neighborhoods = Neighborhood.objects.using(database).filter(election=election_obj).exists()
+        election_obj.save(using=database, update_fields=["num_votes", "has_voting_methods", "has_neighborhoods"])
 
-    if verbosity > 1:
-        print("creating voter objects...")
-    # create voter objects
-    voters_objs = []
-    pref_info_objs = []
-    if verbosity > 1:
-        print("~ 0 %  ", end="\r")
-    for voter_id in voters_info["voters_defaults"]:
-        if "voting_method" in voters_info["voters_foreign_keys"][voter_id]:
-            voters_info["voters_defaults"][voter_id][
-                "voting_method"
-            ] = voting_methods_obj[
-                voters_info["voters_foreign_keys"][voter_id]["voting_method"]
-            ]
+    # Finally, store the file and publish it with the static files
+    store_file(file_path, os.path.basename(file_path), verbosity, content_hash=election_obj.file_hash)
 
-        if "neighborhood" in voters_info["voters_foreign_keys"][voter_id]:
-            voters_info["voters_defaults"][voter_id][
-                "neighborhood"
-            ] = neighborhoods_obj[
-                voters_info["voters_foreign_keys"][voter_id]["neighborhood"]
-            ]
+    return election_obj
 
-        voter_obj = Voter.objects.using(database).create(
-            election=election_obj, **voters_info["voters_defaults"][voter_id]
-        )
-        voters_objs.append(voter_obj)
+def find_unchanged_files(file_paths: list, database: str = "default") -> set:
+    """Returns the files whose content is the same as when their election was imported, using one query."""
+    stored_hashes = dict(
+        Election.objects.using(database)
+        .filter(file_name__in=[os.path.basename(file_path) for file_path in file_paths])
+        .exclude(file_hash="")
+        .values_list("file_name", "file_hash")
+    )
+    return {
+        file_path
+        for file_path in file_paths
+        if os.path.basename(file_path) in stored_hashes
+        and stored_hashes[os.path.basename(file_path)] == file_hash(file_path)
+    }
 
-    if verbosity > 1:
-        print("~10 %  ", end="\r")
-
-    pref_info_objs = []
-    for index, voter_id in enumerate(voters_info["voters_defaults"]):
-        for project in voters_info["voters_foreign_keys"][voter_id]["votes"]:
-            pref_info_objs.append(
-                PreferenceInfo(
-                    voter_id=voters_objs[index].id,
-                    project=projects_obj[project],
-                    preference_strength=voters_info["voters_foreign_keys"][voter_id][
-                        "votes"
-                    ][project],
-                )
-            )
-    if verbosity > 1:
-        print("~50 %  ", end="\r")
-    PreferenceInfo.objects.using(database).bulk_create(pref_info_objs)
 
-    # Finally, move the file to the static folder
-    data_dir_path = os.path.join(
-        os.path.dirname(pb_visualizer.__file__), "static", "data"
-    )
-    os.makedirs(data_dir_path, exist_ok=True)
-    shutil.copyfile(file_path, os.path.join(data_dir_path, os.path.basename(file_path)))
+def iter_prepared_elections(
+    file_paths: list, jobs: int = 1, randomize_name: bool = False, batch_size: int = 1000, verbosity: int = 1
+):
+    """
+    Yields (file_path, get_prepared_election) for every file, in order. Calling get_prepared_election
+    returns what write_election expects, or raises the exception met while parsing the file.
+    With jobs > 1 the files are parsed ahead of the writer in a pool of jobs processes, each sending
+    the voters of its file in batches through a queue of STREAMED_BATCHES batches, see
+    stream_election_batches. The writer then holds one batch at a time, and the queues at most
+    jobs * STREAMED_BATCHES batches, whatever the size of the files.
+    """
+    if jobs <= 1:
+        for file_path in file_paths:
+            yield file_path, partial(prepare_election, file_path, randomize_name, verbosity)
+        return
+
+    # the workers are spawned rather than forked so that they do not share the database connections,
+    # the queues are served by a manager process and closed first, which stops the workers still
+    # blocked on a full queue if the writer stops
+    spawn_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=jobs, mp_context=spawn_context, initializer=django.setup
+    ) as executor, spawn_context.Manager() as manager:
+        # one election per worker is parsed ahead of the writer, the others are submitted as it goes,
+        # the pool running the elections in order so that the one being written always has a worker
+        file_paths = iter(file_paths)
+        pending = deque()
+
+        def submit_next():
+            file_path = next(file_paths, None)
+            if file_path is not None:
+                queue = manager.Queue(maxsize=STREAMED_BATCHES)
+                future = executor.submit(stream_election_batches, queue, file_path, randomize_name, batch_size, verbosity)
+                pending.append((file_path, StreamedElection(future, queue)))
+
+        for _ in range(jobs):
+            submit_next()
+        while pending:
+            file_path, streamed_election = pending.popleft()
+            yield file_path, streamed_election.get
+            # the voters of an election that was skipped or failed to be written are still sent
+            streamed_election.drain()
+            submit_next()
 
-    return election_obj
 
 class Command(BaseCommand):
     help = "Add .pb file to database"
@@ -574,7 +901,7 @@ class Command(BaseCommand):
             type=bool,
             const=True,
             default=False,
-            help="override existing elections",
+            help="override existing elections, only the differences with the file are written",
         )
         parser.add_argument(
             "--rm",
@@ -587,6 +914,25 @@ class Command(BaseCommand):
             default="default",
             help="name of the database to save the election in",
         )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="number of voters written to the database per bulk insert",
+        )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=1,
+            help="number of processes parsing the files in parallel, the database is written by the main process. "
+            "The votes are sent to it in batches, a few batches per process being held in memory",
+        )
+        parser.add_argument(
+            "--collectstatic",
+            action="store_true",
+            help="runs collectstatic at the end, the added files are published without it",
+        )
 
     def handle(self, *args, **options):
         if not options["d"] and not options["f"]:
@@ -663,49 +1009,66 @@ class Command(BaseCommand):
             # Starting the real stuff
             log.append("<p>Adding datasets</p>\n<ul>\n")
             start_time = timezone.now()
-            for i, file_path in enumerate(options["f"]):
-                # We only consider pb files
-                if os.path.splitext(file_path)[1] == ".pb":
-                    # Let's work on the dataset
-                    file_name = os.path.basename(file_path)
-                    if options["verbosity"] > 0:
-                        print(
-                            "Adding dataset {} ({}/{}) to database {}".format(
-                                str(file_name), str(i + 1), str(len(options["f"])), options["database"]
-                            )
-                        )
-                    log.append("\n\t<li>Dataset " + str(file_name) + "... ")
-                    try:
-                        # Actually adding the election
-                        add_election(
-                            file_path=file_path,
-                            override=options["override"],
-                            database=options["database"],
-                            verbosity=options["verbosity"],
-                        )
-                        if options["rm"]:
-                            os.remove(file_path)
-                        log.append(" ... done.</li>\n")
-                    except Exception as e:
-                        # If something happened, we log it and move on
-                        log.append(
-                            "</li>\n</ul>\n<p><strong>"
-                            + str(e)
-                            + "<br>\n"
-                            + str(traceback.format_exc())
-                            + "	</strong></p>\n<ul>"
+            pb_files = [file_path for file_path in options["f"] if os.path.splitext(file_path)[1] == ".pb"]
+            # Files that did not change since their last import are not parsed again
+            unchanged_files = find_unchanged_files(pb_files, options["database"])
+            for file_path in unchanged_files:
+                if options["verbosity"] > 0:
+                    print("Skipping unchanged dataset {}".format(os.path.basename(file_path)))
+                log.append("\n\t<li>Dataset " + os.path.basename(file_path) + " ... unchanged.</li>\n")
+                if options["rm"]:
+                    os.remove(file_path)
+            pb_files = [file_path for file_path in pb_files if file_path not in unchanged_files]
+            prepared_elections = iter_prepared_elections(
+                pb_files,
+                jobs=options["jobs"],
+                randomize_name=(options["database"] == "user_submitted"),
+                batch_size=options["batch_size"],
+                verbosity=options["verbosity"],
+            )
+            for i, (file_path, get_prepared_election) in enumerate(prepared_elections):
+                # Let's work on the dataset
+                file_name = os.path.basename(file_path)
+                if options["verbosity"] > 0:
+                    print(
+                        "Adding dataset {} ({}/{}) to database {}".format(
+                            str(file_name), str(i + 1), str(len(pb_files)), options["database"]
                         )
-                        print(traceback.format_exc())
-                        print(f"error: {e}")
+                    )
+                log.append("\n\t<li>Dataset " + str(file_name) + "... ")
+                try:
+                    # Actually adding the election
+                    write_election(
+                        get_prepared_election(),
+                        override=options["override"],
+                        database=options["database"],
+                        batch_size=options["batch_size"],
+                        verbosity=options["verbosity"],
+                    )
+                    if options["rm"]:
+                        os.remove(file_path)
+                    log.append(" ... done.</li>\n")
+                except Exception as e:
+                    # If something happened, we log it and move on
+                    log.append(
+                        "</li>\n</ul>\n<p><strong>"
+                        + str(e)
+                        + "<br>\n"
+                        + str(traceback.format_exc())
+                        + "	</strong></p>\n<ul>"
+                    )
+                    print(traceback.format_exc())
+                    print(f"error: {e}")
 
             # Finalizing the log
             log.append("</ul>\n<p>The datasets have been successfully added in ")
             log.append(str((timezone.now() - start_time).total_seconds() / 60))
             log.append(" minutes.</p>")
 
-            # Collecting the statics once everything has been done
-            print("Finished, collecting statics")
-            management.call_command("collectstatic", no_input=False)
+            # The files are already published, collecting all the statics is only done on demand
+            if options["collectstatic"]:
+                print("Finished, collecting statics")
+                management.call_command("collectstatic", no_input=False)
         except Exception as e:
             # If anything happened during the execution, we log it and move on
             log.append(
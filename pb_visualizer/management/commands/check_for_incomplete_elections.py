@@ -1,18 +1,21 @@
 from django.core.management.base import BaseCommand
+from django.db.models import Count
 
 from pb_visualizer.models import *
+from pb_visualizer.management.commands.utils import delete_elections
 
 
 def check_for_incomplete_elections(delete=False, database="default"):
     print("searching for incomplete elections...")
-    election_query = Election.objects.using(database).all()
+    election_query = Election.objects.using(database).annotate(num_voters=Count("voters"))
+    incomplete_election_ids = []
     for e in election_query:
-        num_voters = Voter.objects.using(database).filter(election=e).count()
-        if (e.num_votes != num_voters):
-            print(f"incomplete election: id: {e.id}, name: {e.name}, num_votes: {e.num_votes}, number of voters: {num_voters}")
-            if delete:
-                print(f"removing election")
-                e.delete()
+        if (e.num_votes != e.num_voters):
+            print(f"incomplete election: id: {e.id}, name: {e.name}, num_votes: {e.num_votes}, number of voters: {e.num_voters}")
+            incomplete_election_ids.append(e.id)
+    if delete and incomplete_election_ids:
+        print(f"removing {len(incomplete_election_ids)} elections")
+        delete_elections(Election.objects.filter(id__in=incomplete_election_ids), database=database)
                 
     print("done")
 
@@ -0,0 +1,432 @@
+from collections.abc import Iterable
+
+import pabutools.fractions as fractions
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from pb_visualizer.management.commands.compute_election_properties import (
+    applying_election_properties,
+    election_data_properties,
+)
+from pb_visualizer.management.commands.compute_rule_result_properties import (
+    applying_rule_properties,
+    computed_rule_result_properties,
+    rule_properties_to_compute,
+    rule_result_data_properties,
+)
+from pb_visualizer.management.commands.compute_rule_results import (
+    bundle_rule_tasks,
+    iter_rule_results,
+    iter_rule_tasks,
+    schedule_rule_tasks,
+    write_failed_tasks,
+    write_rule_results,
+)
+from pb_visualizer.management.commands.utils import (
+    ComputationRegistry,
+    ElectionParserCache,
+    bulk_upsert,
+    print_if_verbose,
+    refresh_election_property_rows,
+)
+from pb_visualizer.models import *
+from pb_visualizer.near_ties import NEAR_TIE_TOLERANCE
+from pb_visualizer.rule_property_cube import (
+    mark_rule_property_cells_stale,
+    refresh_rule_property_cube,
+    refresh_stale_rule_property_cells,
+)
+from pb_visualizer.run_journal import RunJournal
+
+
+def compute_election_nodes(
+    election_parser,
+    rule_list: list[str] | None,
+    rule_property_list: Iterable[str] | None,
+    recomputed_rules: set,
+    registry: ComputationRegistry,
+    exact: bool = False,
+    override: bool = False,
+    database: str = "default",
+    verbosity=1,
+    stale_only: bool = False,
+):
+    """
+    Computes the missing election properties of the election and the missing properties of its rule
+    results that are not recomputed in the run, everything with override. With stale_only, the stale
+    properties of the rule results are computed again too. Returns the rules whose properties were
+    stored, their cells of the cube being marked stale for them, see mark_rule_property_cells_stale.
+    """
+    election_obj = election_parser.get_election_obj()
+    computed_properties = set()
+    if not override:
+        computed_properties = set(
+            ElectionDataProperty.objects.using(database).filter(election=election_obj).values_list("metadata_id", flat=True)
+        )
+    election_properties = [
+        election_property
+        for election_property in applying_election_properties(election_obj, registry)
+        if election_property not in computed_properties
+    ]
+    bulk_upsert(
+        ElectionDataProperty,
+        election_data_properties(election_parser, election_properties, exact),
+        ["election", "metadata"],
+        ["value"],
+        database,
+    )
+    if election_properties:
+        refresh_election_property_rows([election_obj.id], database)
+
+    rule_result_query = RuleResult.objects.using(database).filter(election=election_obj).exclude(rule_id__in=recomputed_rules)
+    if rule_list is not None:
+        rule_result_query = rule_result_query.filter(rule_id__in=rule_list)
+    computed_properties = {}
+    if not override:
+        computed_properties = computed_rule_result_properties(election_obj, database)
+    rule_properties = applying_rule_properties(election_obj, rule_property_list, registry)
+    data_property_objs = []
+    for rule_result_object in rule_result_query:
+        data_property_objs.extend(
+            rule_result_data_properties(
+                election_parser,
+                rule_result_object,
+                rule_properties_to_compute(rule_result_object, rule_properties, computed_properties, stale_only),
+                exact,
+                verbosity,
+            )
+        )
+    if not data_property_objs:
+        return set()
+    with transaction.atomic(using=database):
+        bulk_upsert(
+            RuleResultDataProperty,
+            data_property_objs,
+            ["rule_result", "metadata"],
+            ["value", "fingerprint", *RuleResultDataProperty.TYPED_FIELDS],
+            database,
+        )
+        rules = {obj.rule_result.rule_id for obj in data_property_objs}
+        mark_rule_property_cells_stale([election_obj.id], database, list(rules))
+    return rules
+
+
+def write_rule_result_node(
+    election_parser,
+    rule_obj: Rule,
+    project_names: list[str],
+    rule_properties: list[str],
+    project_ids: dict,
+    exact: bool = False,
+    database: str = "default",
+    verbosity=1,
+):
+    """
+    Stores a rule result with its properties in one transaction. The properties of the previous
+    result, computed for other selected projects, are replaced. The cells of the cube are marked stale
+    for the rule, see mark_rule_property_cells_stale.
+    """
+    election_obj = election_parser.get_election_obj()
+    with transaction.atomic(using=database):
+        write_rule_results([(election_obj, rule_obj, project_names)], database, project_ids)
+        rule_result_object = RuleResult.objects.using(database).get(election=election_obj, rule=rule_obj)
+        RuleResultDataProperty.objects.using(database).filter(rule_result=rule_result_object).delete()
+        RuleResultDataProperty.objects.using(database).bulk_create(
+            rule_result_data_properties(election_parser, rule_result_object, rule_properties, exact, verbosity)
+        )
+        mark_rule_property_cells_stale([election_obj.id], database, [rule_obj.abbreviation])
+
+
+def compute_all(
+    election_names: list[str] | None = None,
+    rule_list: list[str] | None = None,
+    rule_property_list: Iterable[str] | None = None,
+    exact: bool = False,
+    override: bool = False,
+    use_db: bool = False,
+    database: str = "default",
+    verbosity=1,
+    workers: int = 1,
+    timeout: float | None = None,
+    memory_limit: int | None = None,
+    failed_tasks_file: str | None = None,
+    stale_only: bool = False,
+    resume: str | None = None,
+    journal: bool = False,
+    exact_ties: float | None = None,
+) -> list:
+    """
+    Computes the election properties, the rule results and the rule result properties of the
+    elections in one pass. The computations of an election form a DAG: its properties, its rule
+    results and, depending on every rule result, the properties of the result. Only the missing
+    nodes and the nodes depending on a recomputed one are computed, everything with override, and
+    with stale_only the nodes computed from other inputs than the current ones too. Every
+    node is stored as soon as it is computed, and every election is parsed once when the rules run
+    in this process. Returns the failed rule tasks, see compute_rule_results.
+    The run is recorded in a RunJournal if journal is True, as the command does, and can then be
+    resumed with the id of the run as resume, and exact_ties runs again exactly the rules depending
+    on a near tie, see compute_rule_results.
+    """
+    run_journal = None
+    if resume is not None:
+        run_journal = RunJournal.open(resume)
+        options = run_journal.options
+        rule_list, rule_property_list = options["rule_list"], options["rule_property_list"]
+        exact, override, use_db, database = options["exact"], options["override"], options["use_db"], options["database"]
+        stale_only, exact_ties = options["stale_only"], options.get("exact_ties")
+        print_if_verbose(f"Resuming the run {resume}", 1, verbosity, persist=True)
+    if not exact:
+        fractions.FRACTION = "float"
+    election_query = Election.objects.using(database).all()
+    if resume is not None:
+        election_query = election_query.filter(id__in=run_journal.options["election_ids"])
+    elif election_names is not None:
+        election_query = election_query.filter(name__in=election_names)
+    elections = list(election_query)
+    registry = ComputationRegistry(database)
+    election_parsers = ElectionParserCache(use_db, verbosity=10000 if verbosity > 1 else 0)
+
+    if resume is not None:
+        tasks = run_journal.remaining_tasks(database)
+    else:
+        tasks = schedule_rule_tasks(
+            bundle_rule_tasks(iter_rule_tasks(elections, rule_list, override, database, registry, stale_only)),
+            group_by_election=workers <= 1,
+        )
+        if journal:
+            options = {
+                "election_ids": [election_obj.id for election_obj in elections],
+                "rule_list": rule_list,
+                "rule_property_list": None if rule_property_list is None else list(rule_property_list),
+                "exact": exact,
+                "override": override,
+                "use_db": use_db,
+                "database": database,
+                "stale_only": stale_only,
+                "exact_ties": exact_ties,
+            }
+            run_journal = RunJournal.create("compute_all", options, tasks)
+            print_if_verbose(f"Run {run_journal.run_id}, resume it with --resume {run_journal.run_id}", 1, verbosity, persist=True)
+    recomputed_rules = {}
+    for election_obj, rule_objs in tasks:
+        recomputed_rules.setdefault(election_obj.id, set()).update(rule_obj.abbreviation for rule_obj in rule_objs)
+    print_if_verbose(
+        f"{len(elections)} elections, {sum(len(rules) for rules in recomputed_rules.values())} rule results to compute",
+        1,
+        verbosity,
+        persist=True,
+    )
+
+    # the cells left stale by a previous run that did not finish are refreshed first, the cells of an
+    # election are then refreshed once, when its nodes are all stored, for the rules whose properties
+    # were written
+    stale_cells = refresh_stale_rule_property_cells(database)
+    if stale_cells:
+        print_if_verbose(f"Refreshed {stale_cells} stale cells of the rule property cube", 1, verbosity, persist=True)
+    remaining_results, cube_rules = {}, {}
+    for election_obj, rule_objs in tasks:
+        remaining_results[election_obj.id] = remaining_results.get(election_obj.id, 0) + len(rule_objs)
+
+    def add_cube_writes(election_obj, rules):
+        if rules:
+            cube_rules.setdefault(election_obj.id, set()).update(rules)
+
+    def refresh_election_cube(election_obj):
+        if election_obj.id in cube_rules:
+            refresh_rule_property_cube([election_obj.id], database, rule_ids=list(cube_rules.pop(election_obj.id)))
+
+    def compute_election(election_obj):
+        if run_journal is not None and election_obj.id in run_journal.completed_elections:
+            return
+        print_if_verbose(f"Computing the properties of {election_obj.name}", 1, verbosity)
+        rules = compute_election_nodes(
+            election_parsers.get(election_obj),
+            rule_list,
+            rule_property_list,
+            recomputed_rules.get(election_obj.id, set()),
+            registry,
+            exact,
+            override,
+            database,
+            verbosity,
+            stale_only,
+        )
+        add_cube_writes(election_obj, rules)
+        if run_journal is not None:
+            run_journal.record_election_done(election_obj)
+
+    # the nodes of an election not depending on its rules are computed with its first rule result,
+    # while the election is parsed
+    computed_elections, failed_tasks, project_ids = set(), [], {}
+    for election_obj, rule_obj, outcome, seconds in iter_rule_results(
+        tasks, exact, use_db, workers, timeout, memory_limit, database, verbosity, election_parsers, exact_ties
+    ):
+        if election_obj.id not in computed_elections:
+            compute_election(election_obj)
+            computed_elections.add(election_obj.id)
+        remaining_results[election_obj.id] -= 1
+        if isinstance(outcome, Exception):
+            print_if_verbose(
+                f"{rule_obj.abbreviation} failed for {election_obj.name}: {outcome}", 1, verbosity, persist=True
+            )
+            failed_tasks.append((election_obj, rule_obj, outcome))
+            if run_journal is not None:
+                run_journal.record_failed(election_obj, rule_obj, outcome, seconds)
+        else:
+            write_rule_result_node(
+                election_parsers.get(election_obj),
+                rule_obj,
+                outcome,
+                applying_rule_properties(election_obj, rule_property_list, registry),
+                project_ids,
+                exact,
+                database,
+                verbosity,
+            )
+            add_cube_writes(election_obj, [rule_obj.abbreviation])
+            if run_journal is not None:
+                run_journal.record_done([(election_obj, rule_obj, seconds)])
+        if remaining_results[election_obj.id] == 0:
+            refresh_election_cube(election_obj)
+    for election_obj in elections:
+        if election_obj.id not in computed_elections:
+            compute_election(election_obj)
+            refresh_election_cube(election_obj)
+    if run_journal is not None:
+        run_journal.record_finished()
+
+    if failed_tasks:
+        print_if_verbose(f"{len(failed_tasks)} rule results failed", 0, verbosity, persist=True)
+        if failed_tasks_file is not None:
+            write_failed_tasks(failed_tasks_file, failed_tasks)
+    return failed_tasks
+
+
+class Command(BaseCommand):
+    help = "computes the election properties, the rule results and their properties that are missing in one pass"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-e",
+            "--election_names",
+            nargs="*",
+            type=str,
+            default=None,
+            help="Give a list of election names for which you want to compute everything.",
+        )
+        parser.add_argument(
+            "-r",
+            "--rules",
+            nargs="*",
+            type=str,
+            default=None,
+            help="Give a list of rules for which you want to the results. Discard option to compute all rules, "
+            "no parameter to skip the rule computation.",
+        )
+        parser.add_argument(
+            "-p",
+            "--rule_properties",
+            nargs="*",
+            type=str,
+            default=None,
+            help="Give a list of rule properties which you want to compute. Discard option to compute all properties, no parameter to skip the property computation",
+        )
+        parser.add_argument(
+            "--exact",
+            nargs="?",
+            type=bool,
+            const=True,
+            default=False,
+            help="Use exact fractions instead of floats for computing results.",
+        )
+        parser.add_argument(
+            "-o",
+            "--override",
+            nargs="?",
+            type=bool,
+            const=True,
+            default=False,
+            help="Override everything that was already computed.",
+        )
+        parser.add_argument(
+            "--usedb",
+            nargs="?",
+            type=bool,
+            const=True,
+            default=False,
+            help="Use the databse for recovering an election (if present), or the file stored in the static folder ("
+            "default).",
+        )
+        parser.add_argument(
+            "--database",
+            type=str,
+            default="default",
+            help="name of the database to compute on",
+        )
+        parser.add_argument(
+            "-w",
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes computing the rules in parallel.",
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            default=None,
+            help="Maximum number of seconds a rule can run on an election, the rules running longer are skipped.",
+        )
+        parser.add_argument(
+            "--memory-limit",
+            type=int,
+            default=None,
+            help="Maximum memory in megabytes of a worker process, only applied with --workers > 1.",
+        )
+        parser.add_argument(
+            "--failed-tasks",
+            type=str,
+            default=None,
+            help="Specify a file to write the rule results that ran out of time or memory.",
+        )
+        parser.add_argument(
+            "--stale-only",
+            action="store_true",
+            help="Also compute again the rule results and properties computed from other inputs (election file, "
+            "rule parameters, pabutools version or fraction mode) than the current ones.",
+        )
+        parser.add_argument(
+            "--exact-ties",
+            nargs="?",
+            type=float,
+            const=NEAR_TIE_TOLERANCE,
+            default=None,
+            help="Compute the rules with floats and compute again with exact fractions the rules whose outcome "
+            f"depends on two values closer than the given relative tolerance ({NEAR_TIE_TOLERANCE} by default).",
+        )
+        parser.add_argument(
+            "--resume",
+            type=str,
+            default=None,
+            help="Give the id of a run that was stopped to compute what it did not store, the failed rule results "
+            "included, with the options of the run. The limits (--timeout, --memory-limit, --workers) can be changed.",
+        )
+
+    def handle(self, *args, **options):
+        compute_all(
+            election_names=options["election_names"],
+            rule_list=options["rules"],
+            rule_property_list=options["rule_properties"],
+            exact=options["exact"],
+            override=options["override"],
+            use_db=options["usedb"],
+            database=options["database"],
+            verbosity=options["verbosity"],
+            workers=options["workers"],
+            timeout=options["timeout"],
+            memory_limit=options["memory_limit"],
+            failed_tasks_file=options["failed_tasks"],
+            stale_only=options["stale_only"],
+            resume=options["resume"],
+            journal=True,
+            exact_ties=options["exact_ties"],
+        )
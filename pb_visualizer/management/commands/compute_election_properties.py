@@ -1,17 +1,61 @@
 import pabutools.fractions as fractions
 from django.core.management.base import BaseCommand
 from pb_visualizer.management.commands.utils import (
+    ComputationRegistry,
     LazyElectionParser,
-    exists_in_database,
+    bulk_upsert,
     print_if_verbose,
+    refresh_election_property_rows,
 )
 from pb_visualizer.models import *
 from pb_visualizer.pabutools import (
+    compact_instance_property_mapping,
+    compact_profile_property_mapping,
     instance_property_mapping,
     profile_property_mapping,
 )
 
 
+def instance_property_value(election_parser: LazyElectionParser, instance_property: str, exact: bool):
+    # in float mode, the properties are computed on the compact profile
+    if exact:
+        instance, profile = election_parser.get_parsed_election()
+        return instance_property_mapping[instance_property](instance)
+    return compact_instance_property_mapping[instance_property](election_parser.get_compact_profile())
+
+
+def profile_property_value(election_parser: LazyElectionParser, profile_property: str, exact: bool):
+    if exact:
+        instance, profile = election_parser.get_parsed_election()
+        return profile_property_mapping[profile_property](instance, profile)
+    return compact_profile_property_mapping[profile_property](election_parser.get_compact_profile())
+
+
+def applying_election_properties(election_obj: Election, registry: ComputationRegistry) -> list[str]:
+    """The instance then the profile properties applying to the election."""
+    return [
+        election_property
+        for election_property in [*instance_property_mapping, *profile_property_mapping]
+        if registry.applies_to_election(ElectionMetadata, election_property, election_obj)
+    ]
+
+
+def election_data_properties(
+    election_parser: LazyElectionParser, election_properties: list[str], exact: bool
+) -> list[ElectionDataProperty]:
+    """Computes the given properties of the election, as unsaved ElectionDataProperty objects."""
+    data_property_objs = []
+    for election_property in election_properties:
+        if election_property in instance_property_mapping:
+            value = instance_property_value(election_parser, election_property, exact)
+        else:
+            value = profile_property_value(election_parser, election_property, exact)
+        data_property_objs.append(
+            ElectionDataProperty(election=election_parser.get_election_obj(), metadata_id=election_property, value=value)
+        )
+    return data_property_objs
+
+
 def compute_election_properties(
     election_names: list[str]|None = None,
     exact: bool = False,
@@ -26,6 +70,7 @@ def compute_election_properties(
     if not exact:
         fractions.FRACTION = "float"
     n_elections = len(election_query)
+    registry = ComputationRegistry(database)
     for index, election_obj in enumerate(election_query):
         print_if_verbose(
             f"Computing instance and profile properties of election {index + 1}/{n_elections}: {election_obj.name}",
@@ -34,42 +79,27 @@ def compute_election_properties(
             persist=True,
         )
         election_parser = LazyElectionParser(election_obj, use_db, 10000)
-
-        # we first compute the instance properties
-        for instance_property in instance_property_mapping:
-            metadata_obj = ElectionMetadata.objects.using(database).get(short_name=instance_property)
-            if metadata_obj.applies_to_election(election_obj):
-                unique_filters = {"election": election_obj, "metadata": metadata_obj}
-                if override or not exists_in_database(
-                    ElectionDataProperty, database, **unique_filters
-                ):
-                    instance, profile = election_parser.get_parsed_election()
-                    ElectionDataProperty.objects.using(database).update_or_create(
-                        **unique_filters,
-                        defaults={
-                            "value": instance_property_mapping[instance_property](
-                                instance
-                            )
-                        },
-                    )
-
-        # we now compute the profile properties
-        for profile_property in profile_property_mapping:
-            metadata_obj = ElectionMetadata.objects.using(database).get(short_name=profile_property)
-            if metadata_obj.applies_to_election(election_obj):
-                unique_filters = {"election": election_obj, "metadata": metadata_obj}
-                if override or not exists_in_database(
-                    ElectionDataProperty, database, **unique_filters
-                ):
-                    instance, profile = election_parser.get_parsed_election()
-                    ElectionDataProperty.objects.using(database).update_or_create(
-                        **unique_filters,
-                        defaults={
-                            "value": profile_property_mapping[profile_property](
-                                instance, profile
-                            )
-                        },
-                    )
+        computed_properties = set()
+        if not override:
+            computed_properties = set(
+                ElectionDataProperty.objects.using(database)
+                .filter(election=election_obj)
+                .values_list("metadata_id", flat=True)
+            )
+        election_properties = [
+            election_property
+            for election_property in applying_election_properties(election_obj, registry)
+            if election_property not in computed_properties
+        ]
+        bulk_upsert(
+            ElectionDataProperty,
+            election_data_properties(election_parser, election_properties, exact),
+            ["election", "metadata"],
+            ["value"],
+            database,
+        )
+        if election_properties:
+            refresh_election_property_rows([election_obj.id], database)
 
 
 def export_election_properties(
@@ -88,6 +118,8 @@ def export_election_properties(
         fractions.FRACTION = "float"
     n_elections = len(election_query)
 
+    registry = ComputationRegistry(database)
+
     headers = ["election_name", "property_short_name", "value"]
     with open(export_file, "w") as f:
         f.write(";".join(headers) + "\n")
@@ -103,21 +135,15 @@ def export_election_properties(
 
         # we first compute the instance properties
         for instance_property in instance_property_mapping:
-            metadata_obj = ElectionMetadata.objects.using(database).get(short_name=instance_property)
-            if metadata_obj.applies_to_election(election_obj):
-                instance, profile = election_parser.get_parsed_election()
-                prop_value = instance_property_mapping[instance_property](instance)
+            if registry.applies_to_election(ElectionMetadata, instance_property, election_obj):
+                prop_value = instance_property_value(election_parser, instance_property, exact)
                 with open(export_file, "a") as f:
                     f.write(f'"{election_obj.name}";{instance_property};{prop_value}\n')
 
         # we now compute the profile properties
         for profile_property in profile_property_mapping:
-            metadata_obj = ElectionMetadata.objects.using(database).get(short_name=profile_property)
-            if metadata_obj.applies_to_election(election_obj):
-                instance, profile = election_parser.get_parsed_election()
-                prop_value = profile_property_mapping[profile_property](
-                    instance, profile
-                )
+            if registry.applies_to_election(ElectionMetadata, profile_property, election_obj):
+                prop_value = profile_property_value(election_parser, profile_property, exact)
                 with open(export_file, "a") as f:
                     f.write(f'"{election_obj.name}";{profile_property};{prop_value}\n')
 
@@ -2,17 +2,117 @@ from collections.abc import Iterable
 
 import pabutools.fractions as fractions
 from django.core.management.base import BaseCommand
+from django.db import transaction
 
 from pb_visualizer.management.commands.utils import (
+    ComputationRegistry,
+    LazyBudgetAllocation,
     LazyElectionParser,
-    exists_in_database,
+    bulk_upsert,
     print_if_verbose,
 )
+from pb_visualizer.fingerprints import rule_result_property_fingerprint
 from pb_visualizer.models import *
 from pb_visualizer.pabutools import (
-    project_object_to_pabutools,
+    compact_rule_result_property_mapping,
     rule_result_property_mapping,
 )
+from pb_visualizer.rule_property_cube import refresh_rule_property_cube
+
+
+def rule_result_property_value(
+    election_parser: LazyElectionParser,
+    budget_allocation: LazyBudgetAllocation,
+    rule_property: str,
+    exact: bool,
+):
+    # in float mode, the properties are derived from the satisfaction vectors of the compact profile
+    if exact or rule_property not in compact_rule_result_property_mapping:
+        instance, profile = election_parser.get_parsed_election()
+        return rule_result_property_mapping[rule_property](
+            instance, profile, budget_allocation.get_budget_allocation()
+        )
+    return compact_rule_result_property_mapping[rule_property](
+        budget_allocation.get_allocation_satisfaction()
+    )
+
+
+def applying_rule_properties(
+    election_obj: Election,
+    rule_property_list: Iterable[str] | None,
+    registry: ComputationRegistry,
+) -> list[str]:
+    """The properties of rule_result_property_mapping to compute for the election."""
+    return [
+        property
+        for property in rule_result_property_mapping
+        if (rule_property_list is None or property in rule_property_list)
+        and registry.applies_to_election(RuleResultMetadata, property, election_obj)
+    ]
+
+
+def computed_rule_result_properties(election_obj: Election, database: str = "default") -> dict:
+    """The fingerprints of the properties computed for the rule results of the election, by (rule result id, property)."""
+    return {
+        (rule_result_id, metadata_id): fingerprint
+        for rule_result_id, metadata_id, fingerprint in RuleResultDataProperty.objects.using(database)
+        .filter(rule_result__election=election_obj)
+        .values_list("rule_result_id", "metadata_id", "fingerprint")
+    }
+
+
+def rule_properties_to_compute(
+    rule_result_object: RuleResult, rule_properties: list[str], computed_properties: dict, stale_only: bool = False
+) -> list[str]:
+    """
+    The properties missing for the rule result, see computed_rule_result_properties. With stale_only,
+    also the ones computed from other inputs than the current ones, see rule_result_property_fingerprint.
+    """
+    return [
+        property
+        for property in rule_properties
+        if (rule_result_object.id, property) not in computed_properties
+        or (
+            stale_only
+            and computed_properties[(rule_result_object.id, property)]
+            != rule_result_property_fingerprint(rule_result_object, property)
+        )
+    ]
+
+
+def rule_result_data_properties(
+    election_parser: LazyElectionParser,
+    rule_result_object: RuleResult,
+    rule_properties: list[str],
+    exact: bool,
+    verbosity=1,
+) -> list[RuleResultDataProperty]:
+    """
+    Computes the given properties of the rule result, as unsaved RuleResultDataProperty objects.
+    The properties that cannot be computed are reported and skipped.
+    """
+    budget_allocation = LazyBudgetAllocation(election_parser, rule_result_object)
+    data_property_objs = []
+    for property in rule_properties:
+        print_if_verbose(
+            "Computing {}.".format(property), 3, verbosity
+        )
+        try:
+            value = str(rule_result_property_value(
+                election_parser, budget_allocation, property, exact
+            ))
+            data_property_objs.append(
+                RuleResultDataProperty(
+                    rule_result=rule_result_object,
+                    metadata_id=property,
+                    value=value,
+                    fingerprint=rule_result_property_fingerprint(rule_result_object, property),
+                    **RuleResultDataProperty.typed_values(value),
+                )
+            )
+        except Exception as e:
+            print(e)
+    return data_property_objs
 
 
 def compute_rule_result_properties(
@@ -23,6 +123,7 @@ def compute_rule_result_properties(
     use_db: bool = False,
     database: str = "default",
     verbosity=1,
+    stale_only: bool = False,
 ):
     election_query = Election.objects.using(database).all()
     if election_names is not None:
@@ -30,6 +131,7 @@ def compute_rule_result_properties(
     if not exact:
         fractions.FRACTION = "float"
     n_elections = len(election_query)
+    registry = ComputationRegistry(database)
     for index, election_obj in enumerate(election_query):
         print_if_verbose(
             f"Computing rule result properties of election {index + 1}/{n_elections}: {election_obj.name} "
@@ -40,43 +142,43 @@ def compute_rule_result_properties(
         )
         election_parser = LazyElectionParser(election_obj, use_db, 10000)
         election_obj = election_parser.get_election_obj()
+        rule_properties = applying_rule_properties(election_obj, rule_property_list, registry)
 
+        computed_properties = {}
+        if not override:
+            computed_properties = computed_rule_result_properties(election_obj, database)
+        data_property_objs = []
         for rule_result_object in RuleResult.objects.using(database).filter(election=election_obj):
             print_if_verbose(
                 "Computing properties for {} results.".format(
-                    rule_result_object.rule.abbreviation
+                    rule_result_object.rule_id
                 ),
                 2,
                 verbosity,
             )
-            budget_allocation = [
-                project_object_to_pabutools(project)
-                for project in rule_result_object.selected_projects.all()
-            ]
-
-            for property, prop_func in rule_result_property_mapping.items():
-                if rule_property_list == None or property in rule_property_list:
-                    metadata_obj = RuleResultMetadata.objects.using(database).get(short_name=property)
-                    if metadata_obj.applies_to_election(election_obj):
-                        unique_filters = {
-                            "rule_result": rule_result_object,
-                            "metadata": metadata_obj,
-                        }
-                        if override or not exists_in_database(
-                            RuleResultDataProperty, database, **unique_filters
-                        ):
-                            print_if_verbose(
-                                "Computing {}.".format(property), 3, verbosity
-                            )
-                            instance, profile = election_parser.get_parsed_election()
-                            try:
-                                value = prop_func(instance, profile, budget_allocation)
-                                RuleResultDataProperty.objects.using(database).update_or_create(
-                                    **unique_filters,
-                                    defaults={"value": str(value)},
-                                )
-                            except Exception as e:
-                                print(e)
+            data_property_objs.extend(
+                rule_result_data_properties(
+                    election_parser,
+                    rule_result_object,
+                    rule_properties_to_compute(rule_result_object, rule_properties, computed_properties, stale_only),
+                    exact,
+                    verbosity,
+                )
+            )
+        # the properties of an election are stored together, with one statement per batch, and its
+        # cells of the cube are refreshed in the same transaction
+        with transaction.atomic(using=database):
+            bulk_upsert(
+                RuleResultDataProperty,
+                data_property_objs,
+                ["rule_result", "metadata"],
+                ["value", "fingerprint", *RuleResultDataProperty.TYPED_FIELDS],
+                database,
+            )
+            if data_property_objs:
+                refresh_rule_property_cube(
+                    [election_obj.id], database, metadata_ids={obj.metadata_id for obj in data_property_objs}
+                )
 
 
 def export_rule_result_properties(
@@ -94,6 +196,8 @@ def export_rule_result_properties(
         fractions.FRACTION = "float"
     n_elections = len(election_query)
 
+    registry = ComputationRegistry(database)
+
     headers = ["election_name", "rule_abbreviation", "property_short_name", "value"]
     with open(f"{export_file}", "w") as f:
         f.write(";".join(headers) + "\n")
@@ -106,27 +210,24 @@ def export_rule_result_properties(
         election_parser = LazyElectionParser(election_obj, use_db, 10000)
         election_obj = election_parser.get_election_obj()
 
+        rule_properties = applying_rule_properties(election_obj, rule_property_list, registry)
+
         for rule_result_object in RuleResult.objects.using(database).filter(election=election_obj):
-            print(f"\tComputing properties for the result of {rule_result_object.rule.abbreviation}")
-            budget_allocation = [
-                project_object_to_pabutools(project)
-                for project in rule_result_object.selected_projects.all()
-            ]
-
-            for property, prop_func in rule_result_property_mapping.items():
-                if rule_property_list == None or property in rule_property_list:
-                    metadata_obj = RuleResultMetadata.objects.using(database).get(short_name=property)
-                    if metadata_obj.applies_to_election(election_obj):
-                        print(f"\t\tProperty: {property}")
-                        instance, profile = election_parser.get_parsed_election()
-                        try:
-                            value = prop_func(instance, profile, budget_allocation)
-                            with open(f"{export_file}", "a") as f:
-                                f.write(
-                                    f'"{election_obj.name}";{rule_result_object.rule.abbreviation};{property};{str(value)}\n'
-                                )
-                        except Exception as e:
-                            print(e)
+            print(f"\tComputing properties for the result of {rule_result_object.rule_id}")
+            budget_allocation = LazyBudgetAllocation(election_parser, rule_result_object)
+
+            for property in rule_properties:
+                print(f"\t\tProperty: {property}")
+                try:
+                    value = rule_result_property_value(
+                        election_parser, budget_allocation, property, exact
+                    )
+                    with open(f"{export_file}", "a") as f:
+                        f.write(
+                            f'"{election_obj.name}";{rule_result_object.rule_id};{property};{str(value)}\n'
+                        )
+                except Exception as e:
+                    print(e)
 
 
 class Command(BaseCommand):
@@ -189,6 +290,12 @@ class Command(BaseCommand):
             default="default",
             help="name of the database to compute on",
         )
+        parser.add_argument(
+            "--stale-only",
+            action="store_true",
+            help="Also compute again the properties computed from other inputs (rule result, pabutools version or "
+            "fraction mode) than the current ones.",
+        )
 
     def handle(self, *args, **options):
         if options["file"]:
@@ -208,5 +315,6 @@ class Command(BaseCommand):
                 override=options["override"],
                 verbosity=options["verbosity"],
                 use_db=options["usedb"],
-                database=options["database"]
+                database=options["database"],
+                stale_only=options["stale_only"],
             )
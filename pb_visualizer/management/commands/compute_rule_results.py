@@ -1,13 +1,349 @@
+import csv
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
 from django.core.management import BaseCommand
+from django.db import transaction
 from pabutools import fractions
 
 from pb_visualizer.management.commands.utils import (
+    ComputationRegistry,
+    ElectionParserCache,
     LazyElectionParser,
-    exists_in_database,
+    bulk_upsert,
     print_if_verbose
 )
+from pb_visualizer.fingerprints import rule_result_fingerprint
 from pb_visualizer.models import Election, Rule, RuleResult, Project
+from pb_visualizer.near_ties import NEAR_TIE_TOLERANCE
 from pb_visualizer.pabutools import rule_mapping
+from pb_visualizer.rule_computation import (
+    bundle_rules,
+    compute_rule_task,
+    estimate_rule_cost,
+    exact_election,
+    init_worker,
+    run_rules,
+    run_rules_with_exact_ties,
+    time_limit,
+)
+from pb_visualizer.run_journal import RunJournal
+
+
+def iter_rule_tasks(
+    election_query,
+    rule_list: list[str] | None = None,
+    override: bool = False,
+    database: str = "default",
+    registry: ComputationRegistry | None = None,
+    stale_only: bool = False,
+):
+    """
+    Yields the (election, rule) pairs to compute, grouped by election. The rules already computed
+    for an election are loaded with one query. With stale_only, the results computed from other
+    inputs than the current ones, see rule_result_fingerprint, are computed again too.
+    """
+    if registry is None:
+        registry = ComputationRegistry(database)
+    if rule_list is not None and len(rule_list) == 0:
+        return
+    rule_objs = registry.rules()
+    for election_obj in election_query:
+        computed_rules = {}
+        if not override:
+            computed_rules = dict(
+                RuleResult.objects.using(database).filter(election=election_obj).values_list("rule_id", "fingerprint")
+            )
+        for rule in rule_mapping(election_obj.budget):
+            if rule_list is None or rule in rule_list:
+                if rule in computed_rules and not (
+                    stale_only and computed_rules[rule] != rule_result_fingerprint(election_obj, rule)
+                ):
+                    continue
+                if rule in rule_objs and registry.applies_to_election(Rule, rule, election_obj):
+                    yield election_obj, rule_objs[rule]
+
+
+def read_rule_tasks(tasks_file: str, override: bool = False, database: str = "default", stale_only: bool = False):
+    """Yields the (election, rule) pairs listed in a file written by write_failed_tasks."""
+    with open(tasks_file, newline="") as f:
+        rows = list(csv.DictReader(f, delimiter=";"))
+    elections = {
+        election_obj.name: election_obj
+        for election_obj in Election.objects.using(database).filter(name__in={row["election_name"] for row in rows})
+    }
+    election_rules = {}
+    for row in rows:
+        if row["election_name"] in elections:
+            election_rules.setdefault(row["election_name"], []).append(row["rule_abbreviation"])
+    registry = ComputationRegistry(database)
+    for election_name, rule_list in election_rules.items():
+        yield from iter_rule_tasks([elections[election_name]], rule_list, override, database, registry, stale_only)
+
+
+def bundle_rule_tasks(tasks) -> list:
+    """Groups the (election, rule) tasks into (election, rules) tasks computed together, see bundle_rules."""
+    election_rules = {}
+    for election_obj, rule_obj in tasks:
+        election_rules.setdefault(election_obj, {})[rule_obj.abbreviation] = rule_obj
+    return [
+        (election_obj, [rule_objs[rule] for rule in bundle])
+        for election_obj, rule_objs in election_rules.items()
+        for bundle in bundle_rules(list(rule_objs))
+    ]
+
+
+def estimate_task_cost(task) -> float:
+    election_obj, rule_objs = task
+    return sum(
+        estimate_rule_cost(election_obj.num_votes, election_obj.num_projects, rule_obj.abbreviation)
+        for rule_obj in rule_objs
+    )
+
+
+def schedule_rule_tasks(tasks, group_by_election: bool = False) -> list:
+    """
+    Orders the (election, rules) tasks from the largest to the smallest estimated cost, so that the
+    long tasks do not end up running alone at the end. When grouped by election, the elections are
+    ordered by their largest task and their tasks are kept together, so that one process parses
+    every election once.
+    """
+    tasks = sorted(tasks, key=estimate_task_cost, reverse=True)
+    if group_by_election:
+        election_order = {}
+        for election_obj, _ in tasks:
+            election_order.setdefault(election_obj.id, len(election_order))
+        # the sort is stable, the tasks of an election stay ordered by cost
+        tasks.sort(key=lambda task: election_order[task[0].id])
+    return tasks
+
+
+def iter_rule_results(
+    tasks: list,
+    exact: bool = False,
+    use_db: bool = False,
+    workers: int = 1,
+    timeout: float | None = None,
+    memory_limit: int | None = None,
+    database: str = "default",
+    verbosity=1,
+    election_parsers: ElectionParserCache | None = None,
+    exact_ties: float | None = None,
+):
+    """
+    Yields (election, rule, outcome, seconds) for every rule of the (election, rules) tasks, the
+    outcome being the selected project names or the exception that stopped the rules of the task, a
+    RuleTimeout or a MemoryError when they ran out of time or memory, and seconds the time the rules
+    of the task took, None if it is unknown.
+    With workers > 1 the rules run in a pool of workers processes, each limited to memory_limit
+    megabytes, and the results are yielded as they complete. The parsed elections go to the workers
+    through the cache of parsed elections, filled once per election. The elections are parsed
+    through election_parsers, which the caller can share to reuse the parsed elections.
+    Giving exact_ties runs the rules in float mode with run_rules_with_exact_ties, exact_ties
+    being the tolerance of the near ties.
+    """
+    n_tasks = len(tasks)
+    if election_parsers is None:
+        election_parsers = ElectionParserCache(use_db, verbosity)
+
+    if exact:
+        exact_ties = None
+
+    def print_near_ties(election_obj, near_tie_rules):
+        if near_tie_rules:
+            print_if_verbose(
+                f"{', '.join(near_tie_rules)} computed again exactly for {election_obj.name}: near ties",
+                1,
+                verbosity,
+                persist=True,
+            )
+
+    def print_progress(index, election_obj, rule_objs):
+        rules = ", ".join(rule_obj.abbreviation for rule_obj in rule_objs)
+        print_if_verbose(
+            f"Computing rule results {index + 1}/{n_tasks}: {rules} for {election_obj.name} -- "
+            f"{election_obj.num_votes} voters and {election_obj.num_projects} projects",
+            1,
+            verbosity,
+        )
+
+    if workers <= 1:
+        for index, (election_obj, rule_objs) in enumerate(tasks):
+            election_parser = election_parsers.get(election_obj)
+            print_progress(index, election_obj, rule_objs)
+            rules = [rule_obj.abbreviation for rule_obj in rule_objs]
+            start = time.perf_counter()
+            try:
+                instance, profile = election_parser.get_parsed_election()
+                with time_limit(timeout):
+                    if exact_ties is None:
+                        outcomes = run_rules(
+                            instance, profile, election_obj.budget, rules, election_parser.get_compact_profile
+                        )
+                    else:
+                        outcomes, near_tie_rules = run_rules_with_exact_ties(
+                            instance,
+                            profile,
+                            election_obj.budget,
+                            rules,
+                            partial(exact_election, election_obj, use_db),
+                            election_parser.get_compact_profile,
+                            exact_ties,
+                        )
+                        print_near_ties(election_obj, near_tie_rules)
+            except Exception as e:
+                # a task failing, running out of time or memory or on an unreadable election, does
+                # not stop the others
+                outcomes = {rule_obj.abbreviation: e for rule_obj in rule_objs}
+            seconds = time.perf_counter() - start
+            for rule_obj in rule_objs:
+                yield election_obj, rule_obj, outcomes[rule_obj.abbreviation], seconds
+        return
+
+    def new_executor():
+        # the workers are spawned rather than forked so that they do not share the database connections
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(exact, memory_limit * 1024 * 1024 if memory_limit else None),
+        )
+
+    executor = new_executor()
+    remaining_tasks = iter(enumerate(tasks))
+    pending = {}
+    parsed_election_ids = set()
+
+    def submit_next():
+        nonlocal executor
+        index, task = next(remaining_tasks, (None, None))
+        if task is None:
+            return
+        election_obj, rule_objs = task
+        print_progress(index, election_obj, rule_objs)
+        args = (
+            compute_rule_task,
+            election_obj.id,
+            database,
+            use_db,
+            [rule_obj.abbreviation for rule_obj in rule_objs],
+            timeout,
+            exact_ties,
+        )
+        try:
+            if election_obj.id not in parsed_election_ids:
+                # parsing the election here stores it in the cache the workers read it from
+                election_parsers.get(election_obj).get_parsed_election()
+                parsed_election_ids.add(election_obj.id)
+            try:
+                future = executor.submit(*args)
+            except BrokenProcessPool:
+                # the pool broke before its failed tasks were collected
+                executor.shutdown(wait=False)
+                executor = new_executor()
+                future = executor.submit(*args)
+        except Exception as e:
+            # the task failed before reaching a worker, it is collected with the others
+            future = Future()
+            future.set_exception(e)
+        pending[future] = (task, executor)
+
+    try:
+        # at most 2 * workers tasks are queued, the others are submitted as the results come
+        for _ in range(2 * workers):
+            submit_next()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                (election_obj, rule_objs), task_executor = pending.pop(future)
+                try:
+                    outcomes, seconds, near_tie_rules = future.result()
+                    print_near_ties(election_obj, near_tie_rules)
+                except Exception as e:
+                    # a task failing, running out of time or memory, on an unreadable election or with
+                    # its worker, does not stop the others
+                    outcomes, seconds = {rule_obj.abbreviation: e for rule_obj in rule_objs}, None
+                    if isinstance(e, BrokenProcessPool) and task_executor is executor:
+                        # a worker died, the tasks of its pool fail and the next ones run in a new pool
+                        executor.shutdown(wait=False)
+                        executor = new_executor()
+                for rule_obj in rule_objs:
+                    yield election_obj, rule_obj, outcomes[rule_obj.abbreviation], seconds
+                submit_next()
+    finally:
+        executor.shutdown()
+
+
+def _project_ids(election_obj, project_ids: dict, database: str) -> dict:
+    # the database ids of the projects of the election, by project_id, loaded once per election
+    if election_obj.id not in project_ids:
+        project_ids[election_obj.id] = dict(
+            Project.objects.using(database).filter(election=election_obj).values_list("project_id", "id")
+        )
+    return project_ids[election_obj.id]
+
+
+def write_rule_results(results: list, database: str = "default", project_ids: dict | None = None):
+    """
+    Stores a batch of (election, rule, selected project names) in one transaction, with a constant
+    number of queries. The selected projects and the fingerprint of the results already stored are
+    replaced, the fingerprint being computed for the current fraction mode.
+    project_ids caches the project ids of the elections between batches, see _project_ids.
+    """
+    if not results:
+        return
+    if project_ids is None:
+        project_ids = {}
+    selected_projects_model = RuleResult.selected_projects.through
+    with transaction.atomic(using=database):
+        bulk_upsert(
+            RuleResult,
+            [
+                RuleResult(
+                    election=election_obj,
+                    rule=rule_obj,
+                    fingerprint=rule_result_fingerprint(election_obj, rule_obj.abbreviation),
+                )
+                for election_obj, rule_obj, _ in results
+            ],
+            ["election", "rule"],
+            ["fingerprint"],
+            database,
+        )
+        rule_result_ids = {
+            (election_id, rule_id): rule_result_id
+            for rule_result_id, election_id, rule_id in RuleResult.objects.using(database)
+            .filter(
+                election_id__in={election_obj.id for election_obj, _, _ in results},
+                rule_id__in={rule_obj.abbreviation for _, rule_obj, _ in results},
+            )
+            .values_list("id", "election_id", "rule_id")
+        }
+        # the query also returns the other results of the elections for the rules of the batch
+        batch_rule_result_ids, links = [], []
+        for election_obj, rule_obj, project_names in results:
+            rule_result_id = rule_result_ids[(election_obj.id, rule_obj.abbreviation)]
+            batch_rule_result_ids.append(rule_result_id)
+            election_project_ids = _project_ids(election_obj, project_ids, database)
+            links.extend(
+                selected_projects_model(ruleresult_id=rule_result_id, project_id=election_project_ids[name])
+                for name in project_names
+                if name in election_project_ids
+            )
+        selected_projects_model.objects.using(database).filter(ruleresult_id__in=batch_rule_result_ids).delete()
+        selected_projects_model.objects.using(database).bulk_create(links, batch_size=1000)
+
+
+def write_failed_tasks(failed_tasks_file: str, failed_tasks: list):
+    """Writes the (election, rule, error) of the failed tasks, to be retried with read_rule_tasks."""
+    with open(failed_tasks_file, "w", newline="") as f:
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow(["election_name", "rule_abbreviation", "reason"])
+        for election_obj, rule_obj, error in failed_tasks:
+            writer.writerow([election_obj.name, rule_obj.abbreviation, f"{type(error).__name__}: {error}"])
 
 
 def compute_rule_results(
@@ -18,53 +354,90 @@ def compute_rule_results(
     use_db: bool = False,
     database: str = "default",
     verbosity=1,
-):
-    election_query = Election.objects.using(database).all()
-    if election_names is not None:
-        election_query = election_query.filter(name__in=election_names)
+    workers: int = 1,
+    batch_size: int = 50,
+    timeout: float | None = None,
+    memory_limit: int | None = None,
+    failed_tasks_file: str | None = None,
+    retry_file: str | None = None,
+    stale_only: bool = False,
+    resume: str | None = None,
+    journal: bool = False,
+    exact_ties: float | None = None,
+) -> list:
+    """
+    Computes the rule results, the largest tasks first. The tasks running out of time or memory, or
+    failing otherwise, are skipped, written to failed_tasks_file if it is given, and returned.
+    Giving retry_file computes the tasks listed in it instead. With stale_only, the stale results
+    are computed again with the missing ones, see iter_rule_tasks.
+    The run is recorded in a RunJournal if journal is True, as the command does. Giving the id of a
+    previous run as resume continues it with its options, computing the tasks that were not stored,
+    the failed ones included, so that they can be given more time or memory.
+    Giving exact_ties without exact runs the rules with floats and runs again exactly the ones
+    depending on a near tie, see run_rules_with_exact_ties, exact_ties being the tolerance.
+    """
+    run_journal = None
+    if resume is not None:
+        run_journal = RunJournal.open(resume)
+        exact = run_journal.options["exact"]
+        use_db = run_journal.options["use_db"]
+        database = run_journal.options["database"]
+        exact_ties = run_journal.options.get("exact_ties")
+        print_if_verbose(f"Resuming the run {resume}", 1, verbosity, persist=True)
+    # the fraction mode is part of the fingerprints compared when planning the tasks
     if not exact:
         fractions.FRACTION = "float"
-    n_elections = len(election_query)
-    for index, election_obj in enumerate(election_query):
-        print_if_verbose(
-            f"Computing rule results of election {index + 1}/{n_elections}: {election_obj.name}\n"
-            f"{election_obj.num_votes} voters and {election_obj.num_projects} projects -- {election_obj.ballot_type.name}",
-            1,
-            verbosity,
-            persist=True,
-        )
-        election_parser = LazyElectionParser(election_obj, use_db, 10000)
+    if resume is not None:
+        tasks = run_journal.remaining_tasks(database)
+    else:
+        if retry_file is not None:
+            tasks = read_rule_tasks(retry_file, override, database, stale_only)
+        else:
+            election_query = Election.objects.using(database).all()
+            if election_names is not None:
+                election_query = election_query.filter(name__in=election_names)
+            tasks = iter_rule_tasks(election_query, rule_list, override, database, stale_only=stale_only)
+        tasks = schedule_rule_tasks(bundle_rule_tasks(tasks), group_by_election=workers <= 1)
+        if journal:
+            run_journal = RunJournal.create(
+                "compute_rule_results",
+                {"exact": exact, "use_db": use_db, "database": database, "exact_ties": exact_ties},
+                tasks,
+            )
+            print_if_verbose(f"Run {run_journal.run_id}, resume it with --resume {run_journal.run_id}", 1, verbosity, persist=True)
 
-        if rule_list is None or len(rule_list) > 0:
-            election_obj = election_parser.get_election_obj()
+    print_if_verbose(f"{sum(len(rule_objs) for _, rule_objs in tasks)} rule results to compute", 1, verbosity, persist=True)
+    results, failed_tasks, project_ids = [], [], {}
 
-            rules = rule_mapping(election_obj.budget)
-            for rule in rules:
-                if rule_list is None or rule in rule_list:
-                    rule_obj = Rule.objects.using(database).filter(abbreviation=rule)
-                    if rule_obj.exists():
-                        rule_obj = rule_obj.first()
-                        if rule_obj.applies_to_election(election_obj):
-                            unique_filters = {"election": election_obj, "rule": rule_obj}
-                            if override or not exists_in_database(
-                                RuleResult, database, **unique_filters
-                            ):
-                                print_if_verbose(f"\tComputing {rule}.", 2, verbosity)
-                                rule_result_obj, _ = RuleResult.objects.using(database).update_or_create(
-                                    **unique_filters
-                                )
-                                instance, profile = election_parser.get_parsed_election()
-                                pabutools_result = rules[rule]["func"](
-                                    instance, profile, **rules[rule]["params"]
-                                )
-                                rule_result_obj.selected_projects.set(
-                                    [
-                                        Project.objects.using(database).get(
-                                            election=election_obj, project_id=project.name
-                                        )
-                                        for project in pabutools_result
-                                    ]
-                                )
+    def write_results():
+        write_rule_results([result[:3] for result in results], database, project_ids)
+        if run_journal is not None:
+            run_journal.record_done([(election_obj, rule_obj, seconds) for election_obj, rule_obj, _, seconds in results])
+
+    for election_obj, rule_obj, outcome, seconds in iter_rule_results(
+        tasks, exact, use_db, workers, timeout, memory_limit, database, verbosity, exact_ties=exact_ties
+    ):
+        if isinstance(outcome, Exception):
+            print_if_verbose(
+                f"{rule_obj.abbreviation} failed for {election_obj.name}: {outcome}", 1, verbosity, persist=True
+            )
+            failed_tasks.append((election_obj, rule_obj, outcome))
+            if run_journal is not None:
+                run_journal.record_failed(election_obj, rule_obj, outcome, seconds)
+            continue
+        results.append((election_obj, rule_obj, outcome, seconds))
+        if len(results) >= batch_size:
+            write_results()
+            results = []
+    write_results()
+    if run_journal is not None:
+        run_journal.record_finished()
+
+    if failed_tasks:
+        print_if_verbose(f"{len(failed_tasks)} rule results failed", 0, verbosity, persist=True)
+        if failed_tasks_file is not None:
+            write_failed_tasks(failed_tasks_file, failed_tasks)
+    return failed_tasks
 
 
 def export_rule_results(
@@ -82,6 +455,8 @@ def export_rule_results(
         fractions.FRACTION = "float"
     n_elections = len(election_query)
 
+    registry = ComputationRegistry(database)
+
     headers = ["election_name", "rule_abbreviation", "outcome"]
     with open(export_file, "w") as f:
         f.write(";".join(headers) + "\n")
@@ -98,19 +473,16 @@ def export_rule_results(
             rules = rule_mapping(election_obj.budget)
             for rule in rules:
                 if rule_list is None or rule in rule_list:
-                    rule_obj = Rule.objects.using(database).filter(abbreviation=rule)
-                    if rule_obj.exists():
-                        rule_obj = rule_obj.first()
-                        if rule_obj.applies_to_election(election_obj):
-                            print(f"\tRunning {rule}...")
-                            instance, profile = election_parser.get_parsed_election()
-                            pabutools_result = rules[rule]["func"](
-                                instance, profile, **rules[rule]["params"]
-                            )
-                            with open(export_file, "a") as f:
-                                f.write(
-                                    f'"{election_obj.name}";{rule};"{"#%#%#".join(p.name for p in pabutools_result)}"\n'
-                            )
+                    if rule in registry.rules() and registry.applies_to_election(Rule, rule, election_obj):
+                        print(f"\tRunning {rule}...")
+                        instance, profile = election_parser.get_parsed_election()
+                        pabutools_result = rules[rule]["func"](
+                            instance, profile, **rules[rule]["params"]
+                        )
+                        with open(export_file, "a") as f:
+                            f.write(
+                                f'"{election_obj.name}";{rule};"{"#%#%#".join(p.name for p in pabutools_result)}"\n'
+                        )
 
 
 class Command(BaseCommand):
@@ -174,6 +546,65 @@ class Command(BaseCommand):
             default="default",
             help="name of the database to compute on",
         )
+        parser.add_argument(
+            "-w",
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes computing the rules in parallel.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=50,
+            help="Number of rule results written to the database in one transaction.",
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            default=None,
+            help="Maximum number of seconds a rule can run on an election, the rules running longer are skipped.",
+        )
+        parser.add_argument(
+            "--memory-limit",
+            type=int,
+            default=None,
+            help="Maximum memory in megabytes of a worker process, only applied with --workers > 1.",
+        )
+        parser.add_argument(
+            "--failed-tasks",
+            type=str,
+            default=None,
+            help="Specify a file to write the rule results that ran out of time or memory.",
+        )
+        parser.add_argument(
+            "--retry",
+            type=str,
+            default=None,
+            help="Compute the rule results listed in a file written with --failed-tasks instead.",
+        )
+        parser.add_argument(
+            "--stale-only",
+            action="store_true",
+            help="Also compute again the rule results computed from other inputs (election file, rule parameters, "
+            "pabutools version or fraction mode) than the current ones.",
+        )
+        parser.add_argument(
+            "--exact-ties",
+            nargs="?",
+            type=float,
+            const=NEAR_TIE_TOLERANCE,
+            default=None,
+            help="Compute the rules with floats and compute again with exact fractions the rules whose outcome "
+            f"depends on two values closer than the given relative tolerance ({NEAR_TIE_TOLERANCE} by default).",
+        )
+        parser.add_argument(
+            "--resume",
+            type=str,
+            default=None,
+            help="Give the id of a run that was stopped to compute what it did not store, the failed rule results "
+            "included, with the options of the run. The limits (--timeout, --memory-limit, --workers) can be changed.",
+        )
 
     def handle(self, *args, **options):
         if options["file"]:
@@ -193,5 +624,15 @@ class Command(BaseCommand):
                 override=options["override"],
                 verbosity=options["verbosity"],
                 use_db=options["usedb"],
-                database=options["database"]
+                database=options["database"],
+                workers=options["workers"],
+                batch_size=options["batch_size"],
+                timeout=options["timeout"],
+                memory_limit=options["memory_limit"],
+                failed_tasks_file=options["failed_tasks"],
+                retry_file=options["retry"],
+                stale_only=options["stale_only"],
+                resume=options["resume"],
+                journal=True,
+                exact_ties=options["exact_ties"],
             )
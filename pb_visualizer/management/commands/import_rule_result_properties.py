@@ -1,6 +1,7 @@
 import csv
 
 from django.core.management import BaseCommand
+from django.db import transaction
 
 from pb_visualizer.management.commands.utils import exists_in_database
 from pb_visualizer.models import (
@@ -10,9 +11,13 @@ from pb_visualizer.models import (
     RuleResultDataProperty,
     RuleResultMetadata,
 )
+from pb_visualizer.rule_property_cube import mark_rule_property_cells_stale, refresh_rule_property_cube
 
 
 def import_rule_results_properties(file_path, override, database="default"):
+    # the cells of the cube of the imported properties are refreshed once all are stored, they are
+    # marked stale with the first property of every rule result until then
+    imported_rule_results = set()
     with open(file_path, "r") as f:
         reader = csv.DictReader(f, delimiter=";")
         for row in reader:
@@ -34,9 +39,19 @@ def import_rule_results_properties(file_path, override, database="default"):
                 print(
                     f"Importing for {election_obj.name} -- {rule_obj.abbreviation} and {metadata_obj.name}"
                 )
-                RuleResultDataProperty.objects.using(database).update_or_create(
-                    **unique_filters, defaults={"value": row["value"]}
-                )
+                with transaction.atomic(using=database):
+                    RuleResultDataProperty.objects.using(database).update_or_create(
+                        **unique_filters,
+                        defaults={"value": row["value"]},
+                    )
+                    if (election_obj.id, rule_obj.abbreviation) not in imported_rule_results:
+                        mark_rule_property_cells_stale([election_obj.id], database, [rule_obj.abbreviation])
+                imported_rule_results.add((election_obj.id, rule_obj.abbreviation))
+    refresh_rule_property_cube(
+        list({election_id for election_id, _ in imported_rule_results}),
+        database,
+        rule_ids=list({rule_id for _, rule_id in imported_rule_results}),
+    )
 
 
 class Command(BaseCommand):
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+
+from pb_visualizer.management.commands.utils import print_if_verbose, refresh_election_property_rows
+from pb_visualizer.models import *
+
+
+def refresh_all_election_property_rows(
+    election_names: list[str] | None = None,
+    database: str = "default",
+    batch_size: int = 500,
+    verbosity=1,
+):
+    """Rebuilds the ElectionPropertyRow of the elections, all of them by default, batch_size at a time."""
+    election_query = Election.objects.using(database).all()
+    if election_names is not None:
+        election_query = election_query.filter(name__in=election_names)
+    election_ids = list(election_query.values_list("id", flat=True))
+    for start in range(0, len(election_ids), batch_size):
+        refresh_election_property_rows(election_ids[start:start + batch_size], database)
+    print_if_verbose(f"Refreshed the property rows of {len(election_ids)} elections", 1, verbosity, persist=True)
+
+
+class Command(BaseCommand):
+    help = "rebuilds the table of the election properties used by the api from the election data properties"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-e",
+            "--election_names",
+            nargs="*",
+            type=str,
+            default=None,
+            help="Give a list of election names for which you want to rebuild the row, all elections if not given.",
+        )
+        parser.add_argument(
+            "--database",
+            type=str,
+            default="default",
+            help="name of the database to work on",
+        )
+
+    def handle(self, *args, **options):
+        refresh_all_election_property_rows(
+            election_names=options["election_names"],
+            database=options["database"],
+            verbosity=options["verbosity"],
+        )
@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand
+
+from pb_visualizer.management.commands.utils import print_if_verbose
+from pb_visualizer.models import *
+from pb_visualizer.rule_property_cube import (
+    CELL_FIELDS,
+    annotate_cells,
+    refresh_rule_property_cube,
+)
+
+
+def refresh_all_rule_property_cube(
+    election_names: list[str] | None = None,
+    database: str = "default",
+    batch_size: int = 50,
+    verbosity=1,
+):
+    """
+    Rebuilds the RulePropertyAggregate objects of the cells of the elections, all of them by default,
+    batch_size cells at a time, with their stale marks, see mark_rule_property_cells_stale.
+    """
+    election_query = Election.objects.using(database).all()
+    if election_names is None:
+        # the api does not answer from the cube while it is rebuilt, the cells marked stale from now on
+        # are written after the rebuild reads them
+        RulePropertyCubeState.objects.using(database).update_or_create(id=1, defaults={"built": False})
+        StaleRulePropertyCell.objects.using(database).all().delete()
+        # the cells left without elections are removed too
+        RulePropertyAggregate.objects.using(database).all().delete()
+    else:
+        election_query = election_query.filter(name__in=election_names)
+    # one election per cell, the whole cell of an election is rebuilt
+    cell_elections = {}
+    for election_id, *cell in annotate_cells(election_query).values_list("id", *CELL_FIELDS):
+        cell_elections.setdefault(tuple(cell), election_id)
+    election_ids = list(cell_elections.values())
+    for start in range(0, len(election_ids), batch_size):
+        refresh_rule_property_cube(election_ids[start:start + batch_size], database)
+    if election_names is None:
+        RulePropertyCubeState.objects.using(database).filter(id=1).update(built=True)
+    print_if_verbose(f"Refreshed the rule property aggregates of {len(election_ids)} cells", 1, verbosity, persist=True)
+
+
+class Command(BaseCommand):
+    help = (
+        "rebuilds the cube of the aggregated rule result properties used by the api, which answers from it once "
+        "it is built whole, for the cells of no write left to refresh"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-e",
+            "--election_names",
+            nargs="*",
+            type=str,
+            default=None,
+            help="Give a list of election names whose cells you want to rebuild, all elections if not given.",
+        )
+        parser.add_argument(
+            "--database",
+            type=str,
+            default="default",
+            help="name of the database to work on",
+        )
+
+    def handle(self, *args, **options):
+        refresh_all_rule_property_cube(
+            election_names=options["election_names"],
+            database=options["database"],
+            verbosity=options["verbosity"],
+        )
@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand
+
+from pb_visualizer.management.commands.refresh_rule_property_cube import refresh_all_rule_property_cube
+from pb_visualizer.management.commands.utils import print_if_verbose
+from pb_visualizer.models import *
+from pb_visualizer.rule_property_cube import mark_rule_property_cells_stale
+
+
+def refresh_rule_result_typed_values(
+    election_names: list[str] | None = None,
+    database: str = "default",
+    batch_size: int = 1000,
+    verbosity=1,
+):
+    """
+    Sets the typed fields of the RuleResultDataProperty objects of the elections, all of them by
+    default, from their text value, batch_size at a time, then rebuilds the cube of their cells.
+    """
+    data_property_query = RuleResultDataProperty.objects.using(database).all()
+    if election_names is not None:
+        data_property_query = data_property_query.filter(rule_result__election__name__in=election_names)
+    data_property_ids = list(data_property_query.values_list("id", flat=True))
+    # the aggregates are computed from the typed values, they are refreshed once these are set
+    if election_names is None:
+        RulePropertyCubeState.objects.using(database).filter(id=1).update(built=False)
+    else:
+        mark_rule_property_cells_stale(
+            list(Election.objects.using(database).filter(name__in=election_names).values_list("id", flat=True)),
+            database,
+        )
+    for start in range(0, len(data_property_ids), batch_size):
+        data_property_objs = [
+            RuleResultDataProperty(id=data_property_id, **RuleResultDataProperty.typed_values(value))
+            for data_property_id, value in RuleResultDataProperty.objects.using(database)
+            .filter(id__in=data_property_ids[start:start + batch_size])
+            .values_list("id", "value")
+        ]
+        RuleResultDataProperty.objects.using(database).bulk_update(
+            data_property_objs, RuleResultDataProperty.TYPED_FIELDS
+        )
+    print_if_verbose(
+        f"Refreshed the typed values of {len(data_property_ids)} rule result properties", 1, verbosity, persist=True
+    )
+    refresh_all_rule_property_cube(election_names, database, verbosity=verbosity)
+
+
+class Command(BaseCommand):
+    help = "sets the typed values of the rule result properties used by the api from their text values"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-e",
+            "--election_names",
+            nargs="*",
+            type=str,
+            default=None,
+            help="Give a list of election names for which you want to refresh the values, all elections if not given.",
+        )
+        parser.add_argument(
+            "--database",
+            type=str,
+            default="default",
+            help="name of the database to work on",
+        )
+
+    def handle(self, *args, **options):
+        refresh_rule_result_typed_values(
+            election_names=options["election_names"],
+            database=options["database"],
+            verbosity=options["verbosity"],
+        )
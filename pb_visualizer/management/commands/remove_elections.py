@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 
 from pb_visualizer.models import *
+from pb_visualizer.management.commands.utils import delete_elections
 
 
 def remove_elections(election_ids=None, database="default"):
@@ -8,10 +9,10 @@ def remove_elections(election_ids=None, database="default"):
         print("removing all elections...")
         election_query = Election.objects.using(database).all()
     else:
-        election_query = Election.objects.using(database).get(id__in=election_ids)
+        election_query = Election.objects.using(database).filter(id__in=election_ids)
     for e in election_query:
         print(f"deleting {e}")
-        e.delete()
+    delete_elections(election_query, database=database)
 
 
 class Command(BaseCommand):
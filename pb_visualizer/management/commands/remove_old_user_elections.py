@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand, CommandError
 from pb_visualizer.models import Election
+from pb_visualizer.management.commands.utils import delete_elections
 from datetime import datetime, timedelta
 
 
@@ -8,7 +9,7 @@ def remove_old_user_elections():
     query = Election.objects.using("user_submitted").filter(modification_date__lte=datetime.now()-timedelta(days=2))
     for election in query:
         print(f"removing user submitted election {election}")
-        election.delete()
+    delete_elections(query, database="user_submitted")
 
 
 class Command(BaseCommand):
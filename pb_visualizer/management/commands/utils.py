@@ -1,11 +1,23 @@
 import os
+from collections import OrderedDict
 
 from django.contrib.staticfiles import finders
-from django.db.models import Model
+from django.db import connections, transaction
+from django.db.models import Model, QuerySet
 from pabutools.election import parse_pabulib
 
-from pb_visualizer.models import Election
-from pb_visualizer.pabutools import election_object_to_pabutools
+from pb_visualizer.compact_profile import CompactProfile
+from pb_visualizer.election_cache import (
+    clear_parsed_elections,
+    load_compact_profile,
+    load_parsed_election,
+    store_compact_profile,
+    store_parsed_election,
+)
+from pb_visualizer.models import *
+from pb_visualizer.pabutools import election_object_to_pabutools, project_object_to_pabutools
+from pb_visualizer.rule_property_cube import refresh_rule_property_cube
+from pb_visualizer.satisfaction import AllocationSatisfaction, SatisfactionEngine
 
 from rest_framework.exceptions import PermissionDenied
 from rest_framework import status
@@ -38,27 +50,235 @@ def exists_in_database(model_class: type[Model], database="default", **filters):
     return query.exists()
 
 
+class ComputationRegistry:
+    """
+    The rules and the metadata of the database with the ballot types they apply to, loaded with one
+    query per model the first time they are needed, so that planning the computations of a run does
+    not query the database for every election.
+    """
+
+    def __init__(self, database="default"):
+        self.database = database
+        self._rules = None
+        self._applying = {}
+
+    def rules(self) -> dict:
+        """The rule objects by abbreviation."""
+        if self._rules is None:
+            self._rules = {rule_obj.abbreviation: rule_obj for rule_obj in Rule.objects.using(self.database).all()}
+        return self._rules
+
+    def applying(self, model_class: type[Model], ballot_type: str) -> set:
+        """The primary keys of the objects of model_class (rule or metadata) applying to the ballot type."""
+        if model_class not in self._applying:
+            applying = {}
+            for key, ballot_type_name in model_class.objects.using(self.database).values_list("pk", "applies_to"):
+                applying.setdefault(ballot_type_name, set()).add(key)
+            self._applying[model_class] = applying
+        return self._applying[model_class].get(ballot_type, set())
+
+    def applies_to_election(self, model_class: type[Model], key: str, election_obj: Election) -> bool:
+        """Same as model_class.applies_to_election, without querying the database."""
+        return key in self.applying(model_class, election_obj.ballot_type_id)
+
+
+def bulk_upsert(
+    model_class: type[Model], objs: list, unique_fields: list[str], update_fields: list[str], database="default", batch_size=1000
+):
+    """
+    Inserts the objects, updating the update_fields of the rows already existing for the unique_fields,
+    with one statement per batch. MySQL finds the conflicting rows by itself and does not accept the
+    unique fields.
+    """
+    if not connections[database].features.supports_update_conflicts_with_target:
+        unique_fields = None
+    model_class.objects.using(database).bulk_create(
+        objs,
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=unique_fields,
+        update_fields=update_fields,
+    )
+
+
+def refresh_election_property_rows(election_ids: list[int], database="default"):
+    """
+    Rebuilds the ElectionPropertyRow of the elections from their ElectionDataProperty objects, with
+    two queries. To be called whenever election data properties are stored or deleted.
+    """
+    columns = ElectionPropertyRow.property_columns()
+    rows = {election_id: ElectionPropertyRow(election_id=election_id) for election_id in election_ids}
+    data_properties = (
+        ElectionDataProperty.objects.using(database)
+        .filter(election_id__in=election_ids, metadata_id__in=columns)
+        .values_list("election_id", "metadata_id", "value")
+    )
+    for election_id, short_name, value in data_properties:
+        setattr(rows[election_id], short_name, value)
+    bulk_upsert(ElectionPropertyRow, list(rows.values()), ["election"], columns, database)
+
+
+def raw_delete(query_set: QuerySet, database="default") -> int:
+    """
+    Deletes the rows of the query set with one DELETE statement and returns their number. Unlike
+    QuerySet.delete(), the cascade collector of Django is skipped: no row is loaded, no delete signal
+    is sent and the rows referring to the deleted ones are not deleted, the caller deletes them first.
+    QuerySet.delete() does the same by itself only for the models no foreign key refers to and
+    without delete receivers.
+    """
+    # the only use of the private QuerySet._raw_delete, its behaviour is pinned by test_raw_delete
+    return query_set.using(database)._raw_delete(database)
+
+
+def delete_rule_results(rule_result_query: QuerySet, database="default"):
+    """
+    Deletes the rule results of the query set with their selected projects and data properties,
+    with one DELETE statement per table.
+    """
+    rule_results = list(rule_result_query.using(database).values_list("id", "election_id", "rule_id"))
+    rule_result_ids = [rule_result_id for rule_result_id, _, _ in rule_results]
+    with transaction.atomic(using=database):
+        raw_delete(RuleResultDataProperty.objects.filter(rule_result_id__in=rule_result_ids), database)
+        raw_delete(RuleResult.selected_projects.through.objects.filter(ruleresult_id__in=rule_result_ids), database)
+        raw_delete(RuleResult.objects.filter(id__in=rule_result_ids), database)
+        if rule_results:
+            refresh_rule_property_cube(
+                list({election_id for _, election_id, _ in rule_results}),
+                database,
+                rule_ids=list({rule_id for _, _, rule_id in rule_results}),
+            )
+
+
+def delete_elections(election_query: QuerySet, database="default"):
+    """
+    Deletes the elections of the query set and everything referring to them with one DELETE
+    statement per table, in dependency order. Unlike election.delete(), which goes through the
+    cascade collector of Django, no voter or preference is loaded in memory.
+    """
+    election_ids = list(election_query.using(database).values_list("id", flat=True))
+    with transaction.atomic(using=database):
+        delete_rule_results(RuleResult.objects.filter(election_id__in=election_ids), database)
+        for query in [
+            ElectionDataProperty.objects.filter(election_id__in=election_ids),
+            ElectionPropertyRow.objects.filter(election_id__in=election_ids),
+            PreferenceInfo.objects.filter(voter__election_id__in=election_ids),
+            Voter.objects.filter(election_id__in=election_ids),
+            Project.categories.through.objects.filter(project__election_id__in=election_ids),
+            Project.targets.through.objects.filter(project__election_id__in=election_ids),
+            Project.objects.filter(election_id__in=election_ids),
+            Category.objects.filter(election_id__in=election_ids),
+            Target.objects.filter(election_id__in=election_ids),
+            VotingMethod.objects.filter(election_id__in=election_ids),
+            Neighborhood.objects.filter(election_id__in=election_ids),
+            Election.objects.filter(id__in=election_ids),
+        ]:
+            raw_delete(query, database)
+    clear_parsed_elections(election_ids, database)
+
+
 class LazyElectionParser:
-    def __init__(self, election_obj: Election, use_db, verbosity: int = 1):
+    def __init__(self, election_obj: Election, use_db, verbosity: int = 1, use_cache: bool = True):
         self.election_obj = election_obj
         self.instance = None
         self.profile = None
+        self.compact_profile = None
+        self.satisfaction_engine = None
         self.use_db = use_db
         self.verbosity = verbosity
+        self.use_cache = use_cache
 
     def get_election_obj(self):
         return self.election_obj
 
     def get_parsed_election(self):
         if not self.instance or not self.profile:
-            if self.use_db:
-                print_if_verbose("translating model...", 1, self.verbosity)
-                self.instance, self.profile = election_object_to_pabutools(
-                    self.election_obj
-                )
+            parsed_election = load_parsed_election(self.election_obj) if self.use_cache else None
+            if parsed_election is not None:
+                print_if_verbose("loading parsed election from the cache...", 1, self.verbosity)
+                self.instance, self.profile = parsed_election
             else:
-                file_path = finders.find(
-                    os.path.join("data", self.election_obj.file_name)
-                )
-                self.instance, self.profile = parse_pabulib(file_path)
+                if self.use_db:
+                    print_if_verbose("translating model...", 1, self.verbosity)
+                    self.instance, self.profile = election_object_to_pabutools(
+                        self.election_obj
+                    )
+                else:
+                    file_path = finders.find(
+                        os.path.join("data", self.election_obj.file_name)
+                    )
+                    self.instance, self.profile = parse_pabulib(file_path)
+                if self.use_cache:
+                    store_parsed_election(self.election_obj, self.instance, self.profile)
         return self.instance, self.profile
+
+    def get_compact_profile(self) -> CompactProfile:
+        """Returns the election as a CompactProfile, read without building the pabutools profile if possible."""
+        if self.compact_profile is None:
+            self.compact_profile = load_compact_profile(self.election_obj) if self.use_cache else None
+            if self.compact_profile is None:
+                ballot_type = self.election_obj.ballot_type_id
+                if self.instance and self.profile:
+                    self.compact_profile = CompactProfile.from_pabutools(self.instance, self.profile, ballot_type)
+                elif self.use_db:
+                    print_if_verbose("translating model...", 1, self.verbosity)
+                    self.compact_profile = CompactProfile.from_election(self.election_obj)
+                else:
+                    file_path = finders.find(
+                        os.path.join("data", self.election_obj.file_name)
+                    )
+                    self.compact_profile = CompactProfile.from_file(file_path, ballot_type)
+                if self.use_cache:
+                    store_compact_profile(self.election_obj, self.compact_profile)
+        return self.compact_profile
+
+    def get_satisfaction_engine(self) -> SatisfactionEngine:
+        """Returns the engine computing the satisfaction vectors, shared by all the rule results of the election."""
+        if self.satisfaction_engine is None:
+            self.satisfaction_engine = SatisfactionEngine(self.get_compact_profile())
+        return self.satisfaction_engine
+
+
+class ElectionParserCache:
+    """
+    The LazyElectionParser of the elections used last, so that the computations of an election
+    running one after the other parse it once.
+    """
+
+    def __init__(self, use_db, verbosity: int = 1, size: int = 2):
+        self.use_db = use_db
+        self.verbosity = verbosity
+        self.size = size
+        self._election_parsers = OrderedDict()
+
+    def get(self, election_obj: Election) -> LazyElectionParser:
+        if election_obj.id not in self._election_parsers:
+            if len(self._election_parsers) >= self.size:
+                self._election_parsers.popitem(last=False)
+            self._election_parsers[election_obj.id] = LazyElectionParser(election_obj, self.use_db, self.verbosity)
+        self._election_parsers.move_to_end(election_obj.id)
+        return self._election_parsers[election_obj.id]
+
+
+class LazyBudgetAllocation:
+    """The selected projects of a rule result, converted to what the property computations need only once."""
+
+    def __init__(self, election_parser: LazyElectionParser, rule_result_obj: RuleResult):
+        self.election_parser = election_parser
+        self.rule_result_obj = rule_result_obj
+        self.budget_allocation = None
+        self.allocation_satisfaction = None
+
+    def get_budget_allocation(self) -> list:
+        if self.budget_allocation is None:
+            self.budget_allocation = [
+                project_object_to_pabutools(project)
+                for project in self.rule_result_obj.selected_projects.prefetch_related("categories", "targets")
+            ]
+        return self.budget_allocation
+
+    def get_allocation_satisfaction(self) -> AllocationSatisfaction:
+        if self.allocation_satisfaction is None:
+            self.allocation_satisfaction = self.election_parser.get_satisfaction_engine().allocation(
+                self.rule_result_obj.selected_projects.values_list("project_id", flat=True)
+            )
+        return self.allocation_satisfaction
@@ -1,5 +1,10 @@
+import json
+import struct
+
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 
 from .choices import *
 
@@ -183,6 +188,12 @@ class Election(models.Model):
 
     file_name = models.CharField(max_length=150, blank=True, null=True, unique=True)
     file_size = models.FloatField(default=0)
+    file_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        verbose_name="file hash",
+        help_text="sha256 of the content of the file the election was imported from",
+    )
 
     public_fields = [
         "name",
@@ -206,7 +217,7 @@ class Election(models.Model):
 
     def get_meta_property(self, short_name):
         try:
-            data_property = self.election_data_properties.get(
+            data_property = self.data_properties.get(
                 metadata__short_name=short_name
             )
             return data_property.value
@@ -376,6 +387,68 @@ class ElectionDataProperty(models.Model):
         ordering = ("metadata",)
 
 
+class ElectionPropertyRow(models.Model):
+    """
+    The ElectionDataProperty values of an election as one row, with one indexed column per
+    ElectionMetadata, named after its short name. The elections are filtered and their properties
+    read from it without joining the data properties once per property. The rows are rebuilt from
+    the data properties by refresh_election_property_rows whenever they are stored, a missing
+    property being null.
+    """
+
+    election = models.OneToOneField(
+        Election, on_delete=models.CASCADE, primary_key=True, related_name="property_row"
+    )
+    max_length = models.FloatField(null=True, db_index=True)
+    min_length = models.FloatField(null=True, db_index=True)
+    max_sum_cost = models.FloatField(null=True, db_index=True)
+    min_sum_cost = models.FloatField(null=True, db_index=True)
+    max_sum_points = models.FloatField(null=True, db_index=True)
+    min_sum_points = models.FloatField(null=True, db_index=True)
+    max_points = models.FloatField(null=True, db_index=True)
+    min_points = models.FloatField(null=True, db_index=True)
+    default_score = models.FloatField(null=True, db_index=True)
+    sum_proj_cost = models.FloatField(null=True, db_index=True)
+    fund_scarc = models.FloatField(null=True, db_index=True)
+    avg_proj_cost = models.FloatField(null=True, db_index=True)
+    med_proj_cost = models.FloatField(null=True, db_index=True)
+    sd_proj_cost = models.FloatField(null=True, db_index=True)
+    avg_ballot_len = models.FloatField(null=True, db_index=True)
+    med_ballot_len = models.FloatField(null=True, db_index=True)
+    avg_ballot_cost = models.FloatField(null=True, db_index=True)
+    med_ballot_cost = models.FloatField(null=True, db_index=True)
+    avg_app_score = models.FloatField(null=True, db_index=True)
+    med_app_score = models.FloatField(null=True, db_index=True)
+    avg_total_score = models.FloatField(null=True, db_index=True)
+    med_total_score = models.FloatField(null=True, db_index=True)
+
+    @classmethod
+    def property_columns(cls) -> list[str]:
+        """The short names of the ElectionMetadata having a column."""
+        return [field.name for field in cls._meta.concrete_fields if field.name != "election"]
+
+    def __str__(self):
+        return "Election property row. Election: " + self.election.name
+
+
+# the rows follow the data properties saved or deleted one by one, the bulk writes call
+# refresh_election_property_rows instead
+@receiver(post_save, sender=ElectionDataProperty)
+def update_election_property_row(sender, instance, using, **kwargs):
+    if instance.metadata_id in ElectionPropertyRow.property_columns():
+        ElectionPropertyRow.objects.using(using).update_or_create(
+            election_id=instance.election_id, defaults={instance.metadata_id: instance.value}
+        )
+
+
+@receiver(post_delete, sender=ElectionDataProperty)
+def clear_election_property_row(sender, instance, using, **kwargs):
+    if instance.metadata_id in ElectionPropertyRow.property_columns():
+        ElectionPropertyRow.objects.using(using).filter(election_id=instance.election_id).update(
+            **{instance.metadata_id: None}
+        )
+
+
 class RuleResult(models.Model):
     election = models.ForeignKey(
         Election, on_delete=models.CASCADE, related_name="rule_results"
@@ -387,6 +460,12 @@ class RuleResult(models.Model):
     selected_projects = models.ManyToManyField(
         Project, related_name="rule_results_selected_by"
     )
+    fingerprint = models.CharField(
+        max_length=64,
+        blank=True,
+        default="",
+        help_text="hash of the inputs the result was computed from, see pb_visualizer.fingerprints",
+    )
 
     def __str__(self):
         return (
@@ -425,6 +504,58 @@ class RuleResultDataProperty(models.Model):
         RuleResultMetadata, on_delete=models.CASCADE, related_name="data_properties"
     )
     value = models.TextField()
+    # the value in typed form, float_value for the scalar properties and array_value, the packed
+    # little-endian doubles, for the list[float] ones, set from value on save, see typed_values
+    float_value = models.FloatField(null=True, blank=True)
+    array_value = models.BinaryField(null=True, blank=True)
+    fingerprint = models.CharField(
+        max_length=64,
+        blank=True,
+        default="",
+        help_text="hash of the inputs the property was computed from, see pb_visualizer.fingerprints",
+    )
+
+    TYPED_FIELDS = ["float_value", "array_value"]
+
+    @staticmethod
+    def typed_values(value: str) -> dict:
+        """
+        The typed fields of the text value: a number is stored in float_value, a JSON list of numbers
+        in array_value, anything else in neither.
+        """
+        try:
+            return {"float_value": float(value), "array_value": None}
+        except ValueError:
+            pass
+        try:
+            values = json.loads(value)
+            return {"float_value": None, "array_value": struct.pack(f"<{len(values)}d", *values)}
+        except (ValueError, TypeError, struct.error):
+            return {"float_value": None, "array_value": None}
+
+    @staticmethod
+    def untyped_value() -> models.Case:
+        """
+        The expression of the text value of the rows whose typed fields are both NULL, stored before
+        the typed fields and not refreshed since, and of NULL for the other rows.
+        """
+        return models.Case(
+            models.When(float_value__isnull=True, array_value__isnull=True, then="value"),
+            default=None,
+            output_field=models.TextField(),
+        )
+
+    @staticmethod
+    def unpack_array(array_value: bytes) -> tuple[float]:
+        return struct.unpack(f"<{len(array_value) // 8}d", array_value)
+
+    def save(self, *args, update_fields=None, **kwargs):
+        # the bulk writes bypass save and set the typed fields themselves
+        for field, typed_value in self.typed_values(self.value).items():
+            setattr(self, field, typed_value)
+        if update_fields is not None and "value" in update_fields:
+            update_fields = set(update_fields).union(self.TYPED_FIELDS)
+        super().save(*args, update_fields=update_fields, **kwargs)
 
     def __str__(self):
         return (
@@ -439,6 +570,84 @@ class RuleResultDataProperty(models.Model):
     class Meta:
         unique_together = [["rule_result", "metadata"]]
         ordering = ("metadata",)
+        indexes = [models.Index(fields=["metadata", "rule_result"])]
+
+
+class RulePropertyAggregate(models.Model):
+    """
+    The aggregates of the values of a rule result property over the elections of one cell of the
+    election dimensions: ballot type, country, year of date_begin and size bucket of num_votes, see
+    pb_visualizer.rule_property_cube. get_rule_result_average_data_properties answers the filters
+    aligned with the dimensions from it, without reading the RuleResultDataProperty rows.
+    """
+
+    rule = models.ForeignKey(Rule, on_delete=models.CASCADE, related_name="property_aggregates")
+    metadata = models.ForeignKey(RuleResultMetadata, on_delete=models.CASCADE, related_name="aggregates")
+    ballot_type = models.ForeignKey(BallotType, on_delete=models.CASCADE, related_name="rule_property_aggregates")
+    country = models.CharField(max_length=50, blank=True)
+    year = models.IntegerField(null=True)
+    size_bucket = models.IntegerField(help_text="number of digits of num_votes minus one")
+    # count is the number of data properties, num_values the number of them with a typed value
+    count = models.IntegerField(default=0)
+    num_values = models.IntegerField(default=0)
+    sum = models.FloatField(default=0)
+    sum_squares = models.FloatField(default=0)
+    vector_sum = models.BinaryField(null=True, blank=True)
+
+    def __str__(self):
+        return (
+            f"Aggregate of {self.metadata_id} for {self.rule_id} over {self.ballot_type_id}, "
+            f"{self.country}, {self.year}, size {self.size_bucket}: {self.count} values"
+        )
+
+    class Meta:
+        unique_together = [["rule", "metadata", "ballot_type", "country", "year", "size_bucket"]]
+        indexes = [models.Index(fields=["ballot_type", "rule", "metadata"])]
+
+
+class RulePropertyCubeState(models.Model):
+    """
+    The state of the RulePropertyAggregate cube, a single row set built once the whole cube is built,
+    see refresh_all_rule_property_cube. The cells left to refresh are StaleRulePropertyCell objects.
+    """
+
+    built = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f"Rule property cube: {'built' if self.built else 'not built'}"
+
+
+class StaleRulePropertyCell(models.Model):
+    """
+    A cell of the RulePropertyAggregate cube whose aggregates of the rule, or of every rule if it is
+    null, miss some stored rule result properties. It is written in the transaction storing the
+    properties and removed by the refresh of the cell, the api answering from the cube only for the
+    cells and rules without one, see pb_visualizer.rule_property_cube.
+    """
+
+    rule = models.ForeignKey(Rule, on_delete=models.CASCADE, null=True, related_name="stale_property_cells")
+    ballot_type = models.ForeignKey(BallotType, on_delete=models.CASCADE, related_name="stale_rule_property_cells")
+    country = models.CharField(max_length=50, blank=True)
+    year = models.IntegerField(null=True)
+    size_bucket = models.IntegerField()
+
+    def __str__(self):
+        return (
+            f"Stale cell of {self.rule_id or 'every rule'} over {self.ballot_type_id}, "
+            f"{self.country}, {self.year}, size {self.size_bucket}"
+        )
+
+    class Meta:
+        unique_together = [["rule", "ballot_type", "country", "year", "size_bucket"]]
+
+
+@receiver(post_delete, sender=Election)
+def refresh_deleted_election_cells(sender, instance, using, **kwargs):
+    # the properties of the election are deleted with it, before this signal and in the same
+    # transaction, the elections deleted in bulk refresh their cells themselves, see delete_elections
+    from pb_visualizer.rule_property_cube import election_cell, refresh_rule_property_cells
+
+    refresh_rule_property_cells([election_cell(instance)], using)
 
 
 # ==============================
@@ -0,0 +1,124 @@
+import math
+from contextlib import contextmanager
+from numbers import Real
+
+from pabutools.election import Instance
+
+# the relative difference under which two compared floats are considered tied
+NEAR_TIE_TOLERANCE = 1e-9
+
+
+class NearTieMonitor:
+    """Counts the comparisons of TrackedFloat values that were closer than the tolerance."""
+
+    def __init__(self, tolerance: float):
+        self.tolerance = tolerance
+        self.near_ties = 0
+
+
+_monitor = None
+
+
+def _check(a: float, b) -> None:
+    if _monitor is None or not isinstance(b, Real):
+        return
+    # equal floats are not counted: they are mostly computed the same way, as the equal budget shares
+    # of the voters in MES, and counting them would run almost every rule again exactly. The floats
+    # that differ by a rounding error are the near ties.
+    a, b = float(a), float(b)
+    if 0 < abs(a - b) <= _monitor.tolerance * max(abs(a), abs(b)) and math.isfinite(a) and math.isfinite(b):
+        _monitor.near_ties += 1
+
+
+def _tracked(result):
+    return TrackedFloat(result) if type(result) is float else result
+
+
+class TrackedFloat(float):
+    """
+    A float whose comparisons report to the current NearTieMonitor when the compared values are
+    closer than its tolerance, float rounding possibly deciding them. The arithmetic with a
+    TrackedFloat returns a TrackedFloat, so the values computed by a rule from the costs and the
+    budget limit are tracked.
+    """
+
+    __slots__ = ()
+
+    def __add__(self, other):
+        return _tracked(float.__add__(self, other))
+
+    def __radd__(self, other):
+        return _tracked(float.__radd__(self, other))
+
+    def __sub__(self, other):
+        return _tracked(float.__sub__(self, other))
+
+    def __rsub__(self, other):
+        return _tracked(float.__rsub__(self, other))
+
+    def __mul__(self, other):
+        return _tracked(float.__mul__(self, other))
+
+    def __rmul__(self, other):
+        return _tracked(float.__rmul__(self, other))
+
+    def __truediv__(self, other):
+        return _tracked(float.__truediv__(self, other))
+
+    def __rtruediv__(self, other):
+        return _tracked(float.__rtruediv__(self, other))
+
+    def __neg__(self):
+        return TrackedFloat(float.__neg__(self))
+
+    def __abs__(self):
+        return TrackedFloat(float.__abs__(self))
+
+    def __lt__(self, other):
+        _check(self, other)
+        return float.__lt__(self, other)
+
+    def __le__(self, other):
+        _check(self, other)
+        return float.__le__(self, other)
+
+    def __gt__(self, other):
+        _check(self, other)
+        return float.__gt__(self, other)
+
+    def __ge__(self, other):
+        _check(self, other)
+        return float.__ge__(self, other)
+
+    def __eq__(self, other):
+        _check(self, other)
+        return float.__eq__(self, other)
+
+    def __ne__(self, other):
+        _check(self, other)
+        return float.__ne__(self, other)
+
+    __hash__ = float.__hash__
+
+
+@contextmanager
+def track_near_ties(instance: Instance, tolerance: float = NEAR_TIE_TOLERANCE):
+    """
+    Tracks the near ties of the rules run in the block on the float instance, and yields the
+    NearTieMonitor counting them. The costs of the projects, shared with the profile, and the budget
+    limit are replaced by TrackedFloat values in the block.
+    """
+    global _monitor
+    costs = {project: project.cost for project in instance}
+    budget_limit = instance.budget_limit
+    for project in instance:
+        project.cost = TrackedFloat(project.cost)
+    instance.budget_limit = TrackedFloat(budget_limit)
+    _monitor = NearTieMonitor(tolerance)
+    try:
+        yield _monitor
+    finally:
+        _monitor = None
+        for project, cost in costs.items():
+            project.cost = cost
+        instance.budget_limit = budget_limit
@@ -0,0 +1,102 @@
+import csv
+from collections.abc import Iterator
+
+from pabutools.election import Instance, Project
+from pabutools.fractions import str_as_frac
+
+
+def _read_rows(file_path: str) -> Iterator[tuple[str, list[str], list[str]]]:
+    """
+    Reads a pabulib file line by line and yields (section, header, row) for every data row.
+    Mirrors the way pabutools parses the file, without keeping anything in memory.
+    """
+    with open(file_path, "r", newline="", encoding="utf-8-sig") as csvfile:
+        reader = csv.reader(csvfile, delimiter=";")
+        section = ""
+        header = []
+        for row in reader:
+            if len(row) == 0 or (len(row) == 1 and len(row[0].strip()) == 0):
+                continue
+            if str(row[0]).strip().lower() in ["meta", "projects", "votes"]:
+                section = str(row[0]).strip().lower()
+                header = [key.strip() for key in next(reader)]
+            else:
+                yield section, header, row
+
+
+def read_pabulib_instance(file_path: str) -> Instance:
+    """
+    Parses the META and PROJECTS sections of a pabulib file into a pabutools Instance. The VOTES
+    section is skipped, use iter_pabulib_votes to go through it.
+    """
+    instance = Instance()
+    categories, targets = set(), set()
+    for section, header, row in _read_rows(file_path):
+        if section == "meta":
+            instance.meta[row[0].strip()] = row[1].strip()
+        elif section == "projects":
+            project = Project(name=row[0].strip())
+            project_meta = dict()
+            for key, entry in zip(header, row):
+                if entry.strip().lower() == "none":
+                    continue
+                if key in ["category", "categories"]:
+                    project_meta["categories"] = {e.strip() for e in entry.split(",")}
+                    project.categories = set(project_meta["categories"])
+                    categories.update(project_meta["categories"])
+                elif key in ["target", "targets"]:
+                    project_meta["targets"] = {e.strip() for e in entry.split(",")}
+                    project.targets = set(project_meta["targets"])
+                    targets.update(project_meta["targets"])
+                else:
+                    project_meta[key] = entry.strip()
+            project.cost = str_as_frac(project_meta["cost"].replace(",", "."))
+            instance.add(project)
+            instance.project_meta[project] = project_meta
+        elif section == "votes":
+            break
+
+    if "budget" in instance.meta:
+        instance.budget_limit = str_as_frac(instance.meta["budget"].replace(",", "."))
+    instance.categories = categories
+    instance.targets = targets
+    instance.file_path = file_path
+    return instance
+
+
+def iter_pabulib_votes(file_path: str) -> Iterator[dict[str, str]]:
+    """
+    Yields the rows of the VOTES section of a pabulib file one at a time, as dictionaries from the
+    header keys to the (stripped) values. Entries equal to "none" are left out, as pabutools does.
+    """
+    for section, header, row in _read_rows(file_path):
+        if section == "votes":
+            yield {
+                key: entry.strip()
+                for key, entry in zip(header, row)
+                if entry.strip().lower() != "none"
+            }
+
+
+def ballot_preferences(voter_row: dict[str, str], ballot_type: str) -> dict[str, float]:
+    """
+    Returns the preference strength of every project appearing in the vote of a voter row.
+    Approval votes get 1, ordinal votes the length of the ballot minus the position, and
+    cumulative/cardinal votes the points given.
+    """
+    preferences = {}
+    vote = [p.strip() for p in voter_row.get("vote", "").split(",") if p.strip()]
+    if ballot_type == "approval":
+        for project_id in vote:
+            preferences[project_id] = 1
+    elif ballot_type == "ordinal":
+        # a project listed twice keeps its first position
+        ranking = list(dict.fromkeys(vote))
+        for index, project_id in enumerate(ranking):
+            preferences[project_id] = len(ranking) - index
+    elif ballot_type in ["cumulative", "cardinal"]:
+        if "points" in voter_row:
+            points = voter_row["points"].split(",")
+            for index, project_id in enumerate(vote):
+                preferences[project_id] = float(str_as_frac(points[index].strip()))
+    return preferences
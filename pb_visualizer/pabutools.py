@@ -1,3 +1,4 @@
+import numpy as np
 import pabutools.fractions as fractions
 from pabutools import election as pbelection, rules
 from pabutools.analysis import (
@@ -22,7 +23,9 @@ from pabutools.election import (
     Additive_Cardinal_Relative_Sat,
 )
 
+from pb_visualizer.compact_profile import CompactProfile
 from pb_visualizer.models import *
+from pb_visualizer.satisfaction import AllocationSatisfaction
 
 
 instance_property_mapping = {
@@ -44,6 +47,44 @@ profile_property_mapping = {
     "med_total_score": profileproperties.median_total_score,
 }
 
+
+def _mean(values: np.ndarray) -> float:
+    return float(np.mean(values)) if len(values) > 0 else 0
+
+
+def _median(values: np.ndarray) -> float:
+    return float(np.median(values)) if len(values) > 0 else 0
+
+
+def _funding_scarcity(compact_profile: CompactProfile) -> float:
+    if compact_profile.budget_limit > 0:
+        return float(compact_profile.costs.sum()) / compact_profile.budget_limit
+    raise ValueError(
+        "funding scarcity can only be calculated for instances with budget limit > 0"
+    )
+
+
+# float versions of the instance and profile properties computed on a CompactProfile
+compact_instance_property_mapping = {
+    "sum_proj_cost": lambda cp: float(cp.costs.sum()),
+    "fund_scarc": _funding_scarcity,
+    "avg_proj_cost": lambda cp: _mean(cp.costs),
+    "med_proj_cost": lambda cp: _median(cp.costs),
+    "sd_proj_cost": lambda cp: float(np.std(cp.costs)),
+}
+
+compact_profile_property_mapping = {
+    "avg_ballot_len": lambda cp: _mean(cp.ballot_lengths()),
+    "med_ballot_len": lambda cp: int(_median(cp.ballot_lengths())),
+    "avg_ballot_cost": lambda cp: _mean(cp.voter_sums(cp.costs[cp.indices])),
+    "med_ballot_cost": lambda cp: _median(cp.voter_sums(cp.costs[cp.indices])),
+    "avg_app_score": lambda cp: _mean(cp.project_sums(np.ones(len(cp.indices)))),
+    "med_app_score": lambda cp: _median(cp.project_sums(np.ones(len(cp.indices)))),
+    "avg_total_score": lambda cp: _mean(cp.project_sums(cp.strengths)),
+    "med_total_score": lambda cp: _median(cp.project_sums(cp.strengths)),
+}
+
+
 satisfaction_property_mapping = {
     "avg_card_sat": {"sat_class": Cardinality_Sat},
     "avg_cost_sat": {"sat_class": Cost_Sat},
@@ -117,6 +158,32 @@ for abb, params in satisfaction_property_mapping.items():
         )
 
 
+def _normalised_average(alloc_sat: AllocationSatisfaction, family: str, normaliser: float) -> float:
+    return alloc_sat.average(family) / normaliser
+
+
+# float versions of the rule result properties computed on the satisfaction vectors of an
+# AllocationSatisfaction, the properties missing here are computed with pabutools
+compact_rule_result_property_mapping = {
+    "inverted_cost_gini": lambda sat: sat.inverted_gini("cost"),
+    "inverted_cardbal_gini": lambda sat: sat.inverted_gini("cardinal"),
+    "inverted_borda_gini": lambda sat: sat.inverted_gini("borda"),
+    "prop_pos_sat": lambda sat: sat.positive_share("cc"),
+    "prop_pos_sat_ord": lambda sat: sat.positive_share("borda"),
+    "med_select_cost": lambda sat: float(np.median(sat.selected_costs())),
+    "agg_nrmcost_sat": lambda sat: sat.histogram("cost", sat.engine.max_budget_allocation_cost(), num_bins=21),
+    "avg_card_sat": lambda sat: sat.average("card"),
+    "avg_cost_sat": lambda sat: sat.average("cost"),
+    "avg_nrmcard_sat": lambda sat: _normalised_average(sat, "card", sat.engine.max_budget_allocation_cardinality()),
+    "avg_nrmcost_sat": lambda sat: _normalised_average(sat, "cost", sat.engine.max_budget_allocation_cost()),
+    "avg_relcard_sat": lambda sat: sat.average("relcard"),
+    "avg_relcost_sat": lambda sat: sat.average("relcost"),
+    "avg_sat_cardbal": lambda sat: sat.average("cardinal"),
+    "avg_relsat_cardbal": lambda sat: sat.average("relcardinal"),
+    "avg_borda_sat": lambda sat: sat.average("borda"),
+}
+
+
 def rule_mapping(budget):
     """Given a budget limit, returns a dictionary containing the short names of the rules in the db as keys
     and the method and parameters to compute it using the pabutools as values."""
@@ -290,12 +357,33 @@ def project_object_to_pabutools(project: Project):
 def election_object_to_pabutools(
         election: Election,
 ) -> tuple[pbelection.Instance, pbelection.Profile]:
-    """Takes a django Election object and returns corresponding pabutools Instance and Profile."""
-    categories = {cat.name for cat in election.categories.all()}
-    targets = {tar.name for tar in election.targets.all()}
+    """
+    Takes a django Election object and returns corresponding pabutools Instance and Profile.
+    The whole election is read with a constant number of queries, the preferences of all voters
+    are fetched at once and split per voter with NumPy.
+    """
+    database = election._state.db or "default"
+    categories = set(election.categories.values_list("name", flat=True))
+    targets = set(election.targets.values_list("name", flat=True))
+
+    project_categories, project_targets = {}, {}
+    for project_id, name in Project.categories.through.objects.using(database).filter(
+        project__election=election
+    ).values_list("project_id", "category__name"):
+        project_categories.setdefault(project_id, []).append(name)
+    for project_id, name in Project.targets.through.objects.using(database).filter(
+        project__election=election
+    ).values_list("project_id", "target__name"):
+        project_targets.setdefault(project_id, []).append(name)
+    # the pabutools projects indexed by the primary key of the django projects
     projects = {
-        project.project_id: project_object_to_pabutools(project)
-        for project in election.projects.all()
+        id: pbelection.Project(
+            project_id,
+            fractions.str_as_frac(str(cost)),
+            sorted(project_categories.get(id, [])),
+            sorted(project_targets.get(id, [])),
+        )
+        for id, project_id, cost in election.projects.values_list("id", "project_id", "cost")
     }
 
     instance = pbelection.Instance(
@@ -305,67 +393,68 @@ def election_object_to_pabutools(
     )
     instance.update(projects.values())
 
+    meta_properties = dict(election.data_properties.values_list("metadata__short_name", "value"))
+
+    def meta_property(short_name, cast=None):
+        value = meta_properties.get(short_name)
+        return value if value is None or cast is None else cast(value)
+
+    # one row per preference, sorted by voter and, within a voter, from the most to the least preferred
+    voter_ids = np.fromiter(election.voters.order_by("id").values_list("id", flat=True), dtype=np.int64)
+    preferences = list(
+        PreferenceInfo.objects.using(database)
+        .filter(voter__election=election)
+        .order_by("voter_id", "-preference_strength", "id")
+        .values_list("voter_id", "project_id", "preference_strength")
+    )
+    preference_voter_ids = np.fromiter((row[0] for row in preferences), dtype=np.int64, count=len(preferences))
+    # the preferences of the i-th voter are the rows bounds[i] to bounds[i + 1]
+    bounds = np.append(np.searchsorted(preference_voter_ids, voter_ids, side="left"), len(preferences))
+
+    def voter_preferences():
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            yield [(projects[project_id], strength) for _, project_id, strength in preferences[start:end]]
+
     profile = None
     if election.ballot_type.name == "approval":
         profile = pbelection.ApprovalMultiProfile(
-            legal_min_length=election.get_meta_property("min_length"),
-            legal_max_length=election.get_meta_property("max_length"),
-            legal_min_cost=election.get_meta_property("min_cost"),
-            legal_max_cost=election.get_meta_property("max_cost"),
+            legal_min_length=meta_property("min_length", int),
+            legal_max_length=meta_property("max_length", int),
+            legal_min_cost=meta_property("min_sum_cost"),
+            legal_max_cost=meta_property("max_sum_cost"),
         )
-        for voter in election.voters.all():
+        for ballot in voter_preferences():
             profile.append(
-                pbelection.FrozenApprovalBallot(
-                    [projects[project.project_id] for project in voter.votes.all()]
-                )
+                pbelection.FrozenApprovalBallot([project for project, _ in ballot])
             )
     elif election.ballot_type.name == "ordinal":
         profile = pbelection.OrdinalProfile(
-            legal_min_length=election.get_meta_property("min_length"),
-            legal_max_length=election.get_meta_property("max_length"),
+            legal_min_length=meta_property("min_length", int),
+            legal_max_length=meta_property("max_length", int),
         )
-        for voter in election.voters.all():
+        for ballot in voter_preferences():
             profile.append(
-                pbelection.OrdinalBallot(
-                    [
-                        projects[pref.project.project_id]
-                        for pref in voter.preference_infos.all()
-                    ]
-                )
+                pbelection.OrdinalBallot([project for project, _ in ballot])
             )
     elif election.ballot_type.name == "cumulative":
         profile = pbelection.CumulativeProfile(
-            legal_min_length=election.get_meta_property("min_length"),
-            legal_max_length=election.get_meta_property("max_length"),
-            legal_min_score=election.get_meta_property("min_points"),
-            legal_max_score=election.get_meta_property("max_points"),
-            legal_min_total_score=election.get_meta_property("min_sum_points"),
-            legal_max_total_score=election.get_meta_property("max_sum_points"),
+            legal_min_length=meta_property("min_length", int),
+            legal_max_length=meta_property("max_length", int),
+            legal_min_score=meta_property("min_points"),
+            legal_max_score=meta_property("max_points"),
+            legal_min_total_score=meta_property("min_sum_points"),
+            legal_max_total_score=meta_property("max_sum_points"),
         )
-        for voter in election.voters.all():
-            profile.append(
-                pbelection.CumulativeBallot(
-                    {
-                        projects[pref.project.project_id]: pref.preference_strength
-                        for pref in voter.preference_infos.all()
-                    }
-                )
-            )
+        for ballot in voter_preferences():
+            profile.append(pbelection.CumulativeBallot(dict(ballot)))
     elif election.ballot_type.name == "cardinal":
         profile = pbelection.CardinalProfile(
-            legal_min_length=election.get_meta_property("min_length"),
-            legal_max_length=election.get_meta_property("max_length"),
-            legal_min_score=election.get_meta_property("min_points"),
-            legal_max_score=election.get_meta_property("max_points"),
+            legal_min_length=meta_property("min_length", int),
+            legal_max_length=meta_property("max_length", int),
+            legal_min_score=meta_property("min_points"),
+            legal_max_score=meta_property("max_points"),
         )
-        for voter in election.voters.all():
-            profile.append(
-                pbelection.CardinalBallot(
-                    {
-                        projects[pref.project.project_id]: pref.preference_strength
-                        for pref in voter.preference_infos.all()
-                    }
-                )
-            )
+        for ballot in voter_preferences():
+            profile.append(pbelection.CardinalBallot(dict(ballot)))
 
     return instance, profile
@@ -0,0 +1,91 @@
+import numpy as np
+from pabutools.election import (
+    AbstractProfile,
+    Additive_Borda_Sat,
+    Additive_Cardinal_Sat,
+    AdditiveSatisfaction,
+    CC_Sat,
+    Cardinality_Sat,
+    Cost_Sat,
+    Instance,
+)
+from pabutools.rules import greedy_utilitarian_welfare
+
+from pb_visualizer.compact_profile import CompactProfile
+
+# the satisfaction every entry of the voter x project matrix gives, per satisfaction class
+SAT_ENTRY_VALUES = {
+    Cardinality_Sat: lambda cp: np.ones(len(cp.indices)),
+    Cost_Sat: lambda cp: cp.costs[cp.indices],
+    Additive_Cardinal_Sat: lambda cp: cp.strengths.astype(np.float64),
+    # the strength of an ordinal vote is the length of the ballot minus the position
+    Additive_Borda_Sat: lambda cp: cp.strengths.astype(np.float64) - 1,
+    CC_Sat: lambda cp: cp.strengths.astype(np.float64),
+}
+
+
+class CompactSatProfile:
+    """
+    Stand-in for the satisfaction profiles of pabutools, as used by the greedy and the max welfare
+    rules, computed from a CompactProfile. The total satisfaction of every project is computed
+    once. For the Chamberlin-Courant satisfaction a voter only counts the preferred selected project,
+    which is the first selected entry of its ballot as the entries are sorted by preference.
+    """
+
+    def __init__(self, compact_profile: CompactProfile, project_numbers: dict, entry_values: np.ndarray, additive: bool):
+        self.compact_profile = compact_profile
+        self.project_numbers = project_numbers
+        self.entry_values = entry_values
+        self.additive = additive
+        self.project_totals = compact_profile.project_sums(entry_values)
+        self._totals = {}
+
+    def total_satisfaction_project(self, project) -> float:
+        return float(self.project_totals[self.project_numbers[project.name]])
+
+    def total_satisfaction(self, projects) -> float:
+        key = frozenset(self.project_numbers[project.name] for project in projects)
+        if key not in self._totals:
+            if self.additive:
+                self._totals[key] = float(self.project_totals[list(key)].sum())
+            else:
+                cp = self.compact_profile
+                selected = np.zeros(cp.num_projects, dtype=bool)
+                selected[list(key)] = True
+                selected_entries = np.flatnonzero(selected[cp.indices])
+                _, first_entries = np.unique(cp.voter_index[selected_entries], return_index=True)
+                self._totals[key] = float(self.entry_values[selected_entries[first_entries]].sum())
+        return self._totals[key]
+
+
+def is_welfare_rule(rule_definition: dict) -> bool:
+    """Whether the rule is a greedy or max welfare rule whose satisfaction CompactSatProfile supports."""
+    return rule_definition["params"].get("sat_class") in SAT_ENTRY_VALUES
+
+
+def run_welfare_rules(
+    instance: Instance, profile: AbstractProfile, compact_profile: CompactProfile, rule_definitions: dict, rules: list[str]
+) -> dict:
+    """
+    Computes greedy and max welfare rules of rule_mapping with the pabutools rules, the satisfaction
+    profiles being replaced by CompactSatProfile. The profile is thus scanned once for all the rules
+    sharing a satisfaction, instead of once per rule and per project. Returns the outcome of every rule.
+    """
+    project_numbers = {name: index for index, name in enumerate(compact_profile.project_names)}
+    sat_profiles = {}
+    res = {}
+    for rule in rules:
+        params = dict(rule_definitions[rule]["params"])
+        sat_class = params.pop("sat_class")
+        if sat_class not in sat_profiles:
+            sat_profiles[sat_class] = CompactSatProfile(
+                compact_profile,
+                project_numbers,
+                SAT_ENTRY_VALUES[sat_class](compact_profile),
+                sat_class is not CC_Sat,
+            )
+        if rule_definitions[rule]["func"] is greedy_utilitarian_welfare and "is_sat_additive" not in params:
+            # the default of pabutools, which is only known from the satisfaction class
+            params["is_sat_additive"] = issubclass(sat_class, AdditiveSatisfaction)
+        res[rule] = rule_definitions[rule]["func"](instance, profile, sat_profile=sat_profiles[sat_class], **params)
+    return res
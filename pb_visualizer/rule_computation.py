@@ -0,0 +1,263 @@
+import resource
+import signal
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from contextlib import contextmanager
+from functools import cache, partial
+
+import django
+import pabutools.fractions as fractions
+from pabutools.election import AbstractApprovalProfile, AbstractOrdinalProfile, AbstractProfile, Instance
+
+from pb_visualizer.compact_profile import CompactProfile
+from pb_visualizer.incremental_mes import mes_variant, run_mes_variants
+from pb_visualizer.near_ties import NEAR_TIE_TOLERANCE, track_near_ties
+from pb_visualizer.rule_bundle import is_welfare_rule, run_welfare_rules
+
+# this module is imported by the worker processes before django is set up, so the models are
+# imported inside the functions
+
+# the elections kept parsed by a worker process, the tasks of an election being mostly consecutive
+_WORKER_CACHE_SIZE = 2
+_worker_election_parsers = OrderedDict()
+
+
+class RuleTimeout(Exception):
+    """Raised when a rule runs longer than its time limit."""
+
+
+# the estimated number of operations of the rules, relative to the size (voters x projects) of the election
+RULE_FAMILY_COST_FACTORS = {
+    "greedy": lambda num_projects: 1,
+    "phragmen": lambda num_projects: num_projects,
+    "mes": lambda num_projects: num_projects,
+    # the exhaustion runs MES again for every budget step, see mes_budget_steps
+    "mes_exhaustion": lambda num_projects: num_projects,
+    # the knapsack solved by an ILP, which is the most likely to explode
+    "max": lambda num_projects: num_projects**2,
+}
+
+
+def rule_family(rule: str) -> str:
+    """Returns the family of a rule of rule_mapping, see RULE_FAMILY_COST_FACTORS."""
+    if rule.startswith("max_"):
+        return "max"
+    if rule == "seq_phragmen":
+        return "phragmen"
+    variant = mes_variant(rule)
+    if variant:
+        return "mes_exhaustion" if variant[1] == "exhaustion" else "mes"
+    return "greedy"
+
+
+@cache
+def mes_budget_steps(rule: str) -> int:
+    """
+    The estimated number of MES runs of the exhaustion of a MES rule of rule_mapping: one per budget
+    step, the budget limit being about doubled before the outcome is exhaustive or infeasible on the
+    pabulib elections, so about the budget limit divided by the step.
+    """
+    from pb_visualizer.pabutools import rule_mapping
+
+    budget_step = rule_mapping(1)[rule]["params"]["rule_params"][0]["budget_step"]
+    return max(1, round(1 / budget_step))
+
+
+def estimate_rule_cost(num_votes: int, num_projects: int, rule: str) -> float:
+    """Estimates the cost of running a rule on an election, to run the largest tasks first."""
+    family = rule_family(rule)
+    cost = num_votes * num_projects * RULE_FAMILY_COST_FACTORS[family](num_projects)
+    if family == "mes_exhaustion":
+        cost *= mes_budget_steps(rule)
+    return cost
+
+
+@contextmanager
+def time_limit(seconds: float | None):
+    """Raises RuleTimeout in the block after the given number of seconds, only in the main thread."""
+    if not seconds:
+        yield
+        return
+
+    def on_alarm(signum, frame):
+        raise RuleTimeout(f"time limit of {seconds}s exceeded")
+
+    previous_handler = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+def bundle_rules(rules: list[str]) -> list[list[str]]:
+    """
+    Groups the rules computed together because they share work: the MES rules with the same
+    satisfaction, the greedy rules and the max welfare rules. The other rules are computed alone.
+    The greedy and the max rules are not bundled together so that a slow max rule does not hold the
+    greedy ones back.
+    """
+    bundles = {}
+    for rule in rules:
+        variant = mes_variant(rule)
+        if variant:
+            key = ("mes", variant[0])
+        elif rule_family(rule) in ("greedy", "max"):
+            key = rule_family(rule)
+        else:
+            key = rule
+        bundles.setdefault(key, []).append(rule)
+    return list(bundles.values())
+
+
+def _ballot_type(profile: AbstractProfile) -> str:
+    if isinstance(profile, AbstractApprovalProfile):
+        return "approval"
+    if isinstance(profile, AbstractOrdinalProfile):
+        return "ordinal"
+    return "cardinal"
+
+
+def run_rules(
+    instance: Instance,
+    profile: AbstractProfile,
+    budget,
+    rules: list[str],
+    get_compact_profile: Callable[[], CompactProfile] | None = None,
+) -> dict[str, list[str]]:
+    """
+    Runs a bundle of rules of rule_mapping, see bundle_rules, on the election. In float mode the
+    welfare rules use the CompactProfile returned by get_compact_profile, which is converted from
+    the profile if it is not given. Returns the names of the selected projects for every rule.
+    """
+    from pb_visualizer.pabutools import rule_mapping
+
+    rule_definitions = rule_mapping(budget)
+    if mes_variant(rules[0]):
+        outcomes = run_mes_variants(instance, profile, rule_definitions, rules)
+    elif fractions.FRACTION == "float" and all(is_welfare_rule(rule_definitions[rule]) for rule in rules):
+        if get_compact_profile is None:
+            compact_profile = CompactProfile.from_pabutools(instance, profile, _ballot_type(profile))
+        else:
+            compact_profile = get_compact_profile()
+        outcomes = run_welfare_rules(instance, profile, compact_profile, rule_definitions, rules)
+    else:
+        outcomes = {
+            rule: rule_definitions[rule]["func"](instance, profile, **rule_definitions[rule]["params"])
+            for rule in rules
+        }
+    return {rule: [project.name for project in outcome] for rule, outcome in outcomes.items()}
+
+
+def run_rules_with_exact_ties(
+    instance: Instance,
+    profile: AbstractProfile,
+    budget,
+    rules: list[str],
+    get_exact_election: Callable[[], tuple[Instance, AbstractProfile]],
+    get_compact_profile: Callable[[], CompactProfile] | None = None,
+    tolerance: float = NEAR_TIE_TOLERANCE,
+) -> tuple[dict[str, list[str]], list[str]]:
+    """
+    Runs a bundle of rules, see run_rules, on the election parsed with floats, and runs again with
+    exact fractions the rules whose outcome depends on a near tie: two floats compared while closer
+    than the relative tolerance, see track_near_ties. The MES rules of the bundle are tracked and
+    run again together, as they share their computation. The max welfare rules are not, their ILP
+    being solved with floats in both modes. get_exact_election returns the election parsed in exact
+    mode. Returns the outcomes with the rules run again.
+    """
+    tracked_units = [rules] if mes_variant(rules[0]) else [[rule] for rule in rules if rule_family(rule) != "max"]
+    untracked_rules = [rule for rule in rules if rule_family(rule) == "max"]
+    outcomes = run_rules(instance, profile, budget, untracked_rules, get_compact_profile) if untracked_rules else {}
+    near_tie_rules = []
+    for unit in tracked_units:
+        with track_near_ties(instance, tolerance) as monitor:
+            outcomes.update(run_rules(instance, profile, budget, unit, get_compact_profile))
+        if monitor.near_ties:
+            near_tie_rules.extend(unit)
+
+    if near_tie_rules:
+        fraction_mode = fractions.FRACTION
+        fractions.FRACTION = "gmpy2"
+        try:
+            exact_instance, exact_profile = get_exact_election()
+            outcomes.update(run_rules(exact_instance, exact_profile, budget, near_tie_rules))
+        finally:
+            fractions.FRACTION = fraction_mode
+    return outcomes, near_tie_rules
+
+
+def run_rule(instance: Instance, profile: AbstractProfile, budget, rule: str) -> list[str]:
+    """Runs the rule of rule_mapping on the election and returns the names of the selected projects."""
+    return run_rules(instance, profile, budget, [rule])[rule]
+
+
+def init_worker(exact: bool, memory_limit: int | None = None):
+    """
+    Initializer of the worker processes computing rule results. With a memory limit, in bytes, a
+    rule allocating more memory fails with a MemoryError instead of exhausting the machine.
+    """
+    django.setup()
+    if not exact:
+        fractions.FRACTION = "float"
+    if memory_limit:
+        _, hard_limit = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard_limit))
+
+
+def _worker_election_parser(election_id: int, database: str, use_db: bool):
+    from pb_visualizer.management.commands.utils import LazyElectionParser
+    from pb_visualizer.models import Election
+
+    key = (database, election_id)
+    if key not in _worker_election_parsers:
+        if len(_worker_election_parsers) >= _WORKER_CACHE_SIZE:
+            _worker_election_parsers.popitem(last=False)
+        election_obj = Election.objects.using(database).get(id=election_id)
+        # the parent process stores the parsed election in the cache before submitting its tasks
+        _worker_election_parsers[key] = LazyElectionParser(election_obj, use_db, verbosity=0)
+    _worker_election_parsers.move_to_end(key)
+    return _worker_election_parsers[key]
+
+
+def exact_election(election_obj, use_db: bool) -> tuple[Instance, AbstractProfile]:
+    """Parses the election for the exact runs of run_rules_with_exact_ties, in exact mode."""
+    from pb_visualizer.management.commands.utils import LazyElectionParser
+
+    return LazyElectionParser(election_obj, use_db, verbosity=0).get_parsed_election()
+
+
+def compute_rule_task(
+    election_id: int,
+    database: str,
+    use_db: bool,
+    rules: list[str],
+    timeout: float | None = None,
+    exact_ties: float | None = None,
+) -> tuple[dict[str, list[str]], float, list[str]]:
+    """
+    Computes a bundle of rules on one election in a worker process, see run_rules, or
+    run_rules_with_exact_ties with exact_ties as tolerance if it is given. Returns the outcomes with
+    the number of seconds the rules took and the rules run again exactly.
+    """
+    election_parser = _worker_election_parser(election_id, database, use_db)
+    election_obj = election_parser.get_election_obj()
+    instance, profile = election_parser.get_parsed_election()
+    start = time.perf_counter()
+    near_tie_rules = []
+    with time_limit(timeout):
+        if exact_ties is None:
+            outcomes = run_rules(instance, profile, election_obj.budget, rules, election_parser.get_compact_profile)
+        else:
+            outcomes, near_tie_rules = run_rules_with_exact_ties(
+                instance,
+                profile,
+                election_obj.budget,
+                rules,
+                partial(exact_election, election_obj, use_db),
+                election_parser.get_compact_profile,
+                exact_ties,
+            )
+    return outcomes, time.perf_counter() - start, near_tie_rules
@@ -0,0 +1,264 @@
+import datetime
+from functools import reduce
+from operator import or_
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Case, IntegerField, Q, QuerySet, Value, When
+from django.db.models.functions import ExtractYear
+
+from pb_visualizer.models import (
+    Election,
+    RulePropertyAggregate,
+    RulePropertyCubeState,
+    RuleResultDataProperty,
+    StaleRulePropertyCell,
+)
+
+# the dimensions of the cube, the fields of RulePropertyAggregate and the annotations of the elections
+CELL_FIELDS = ("ballot_type", "country", "year", "size_bucket")
+# the elections with 10**MAX_SIZE_BUCKET votes or more share the last size bucket
+MAX_SIZE_BUCKET = 9
+# the bounds of the num_votes filters aligned with the size buckets, and the bucket they start or end
+SIZE_BUCKET_MINS = {0: 0, **{10**bucket: bucket for bucket in range(1, MAX_SIZE_BUCKET + 1)}}
+SIZE_BUCKET_MAXS = {10 ** (bucket + 1) - 1: bucket for bucket in range(MAX_SIZE_BUCKET)}
+
+
+def annotate_cells(election_query_set: QuerySet) -> QuerySet:
+    """Annotates the elections with the year and size_bucket dimensions of their cell."""
+    return election_query_set.annotate(
+        year=ExtractYear("date_begin"),
+        size_bucket=Case(
+            *[When(num_votes__lt=10 ** (bucket + 1), then=Value(bucket)) for bucket in range(MAX_SIZE_BUCKET)],
+            default=Value(MAX_SIZE_BUCKET),
+            output_field=IntegerField(),
+        ),
+    )
+
+
+def cells_query(cells) -> Q:
+    """The Q object selecting the given cells, tuples of values of CELL_FIELDS."""
+    return reduce(or_, (Q(**dict(zip(CELL_FIELDS, cell))) for cell in cells))
+
+
+def election_cell(election_obj: Election) -> tuple:
+    """The cell of the election, as annotate_cells computes it, without querying the database."""
+    num_votes = election_obj.num_votes
+    size_bucket = next(
+        (bucket for bucket in range(MAX_SIZE_BUCKET) if num_votes is not None and num_votes < 10 ** (bucket + 1)),
+        MAX_SIZE_BUCKET,
+    )
+    year = None if election_obj.date_begin is None else election_obj.date_begin.year
+    return election_obj.ballot_type_id, election_obj.country, year, size_bucket
+
+
+def mark_rule_property_cells_stale(
+    election_ids: list[int], database: str = "default", rule_ids: list[str] | None = None
+):
+    """
+    Marks the cells of the elections stale for the rules, every rule if not given, in the transaction
+    writing rule result properties whose cells are refreshed after it. The api does not answer from
+    these cells until refresh_rule_property_cube, refresh_stale_rule_property_cells or
+    refresh_all_rule_property_cube rebuilds them.
+    """
+    cells = set(annotate_cells(Election.objects.using(database).filter(id__in=election_ids)).values_list(*CELL_FIELDS))
+    StaleRulePropertyCell.objects.using(database).bulk_create(
+        [
+            StaleRulePropertyCell(
+                rule_id=rule_id, ballot_type_id=ballot_type_id, country=country, year=year, size_bucket=size_bucket
+            )
+            for ballot_type_id, country, year, size_bucket in cells
+            for rule_id in (rule_ids if rule_ids is not None else [None])
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def rule_property_cube_is_fresh(
+    cell_filter: Q | None = None, rule_ids: list[str] | None = None, database: str = "default"
+) -> bool:
+    """
+    Whether the cube was built and none of its cells, the ones selected by cell_filter if given, is
+    stale for the rules, every rule if not given.
+    """
+    stale_query = StaleRulePropertyCell.objects.using(database).all()
+    if cell_filter is not None:
+        stale_query = stale_query.filter(cell_filter)
+    if rule_ids is not None:
+        stale_query = stale_query.filter(Q(rule__isnull=True) | Q(rule_id__in=rule_ids))
+    return RulePropertyCubeState.objects.using(database).filter(built=True).exists() and not stale_query.exists()
+
+
+def refresh_stale_rule_property_cells(database: str = "default") -> int:
+    """
+    Rebuilds the stale cells, left by the writes whose refresh did not happen, a crash of compute_all
+    for instance, for the rules they are stale for. Returns the number of cells.
+    """
+    stale_cells = {}
+    for rule_id, *cell in StaleRulePropertyCell.objects.using(database).values_list("rule_id", *CELL_FIELDS):
+        stale_cells.setdefault(tuple(cell), set()).add(rule_id)
+    for cell, rule_ids in stale_cells.items():
+        refresh_rule_property_cells([cell], database, rule_ids=None if None in rule_ids else list(rule_ids))
+    return len(stale_cells)
+
+
+def refresh_rule_property_cube(
+    election_ids: list[int],
+    database: str = "default",
+    rule_ids: list[str] | None = None,
+    metadata_ids: list[str] | None = None,
+):
+    """
+    Rebuilds the RulePropertyAggregate objects of the cells of the elections, see
+    refresh_rule_property_cells. To be called in the transaction storing or deleting rule result
+    properties, the elections still existing, or after the one marking their cells stale, see
+    mark_rule_property_cells_stale.
+    """
+    cells = set(annotate_cells(Election.objects.using(database).filter(id__in=election_ids)).values_list(*CELL_FIELDS))
+    refresh_rule_property_cells(cells, database, rule_ids, metadata_ids)
+
+
+def refresh_rule_property_cells(
+    cells,
+    database: str = "default",
+    rule_ids: list[str] | None = None,
+    metadata_ids: list[str] | None = None,
+):
+    """
+    Rebuilds the RulePropertyAggregate objects of the cells, tuples of values of CELL_FIELDS, from the
+    RuleResultDataProperty objects of all the elections of these cells, for the given rules and
+    properties only if given. The stale marks of the cells for the rebuilt rules are removed when
+    all the properties are.
+    """
+    if not cells:
+        return
+    cell_query = cells_query(cells)
+    election_cells = {
+        election_id: cell
+        for election_id, *cell in annotate_cells(Election.objects.using(database).all())
+        .filter(cell_query)
+        .values_list("id", *CELL_FIELDS)
+    }
+
+    data_property_query = RuleResultDataProperty.objects.using(database).filter(
+        rule_result__election_id__in=election_cells
+    )
+    aggregate_query = RulePropertyAggregate.objects.using(database).filter(cell_query)
+    if rule_ids is not None:
+        data_property_query = data_property_query.filter(rule_result__rule_id__in=rule_ids)
+        aggregate_query = aggregate_query.filter(rule_id__in=rule_ids)
+    if metadata_ids is not None:
+        data_property_query = data_property_query.filter(metadata_id__in=metadata_ids)
+        aggregate_query = aggregate_query.filter(metadata_id__in=metadata_ids)
+
+    aggregates = {}
+    vector_sums = {}
+    mixed_lengths = set()
+    for election_id, rule_id, metadata_id, float_value, array_value, untyped_value in data_property_query.values_list(
+        "rule_result__election_id",
+        "rule_result__rule_id",
+        "metadata_id",
+        "float_value",
+        "array_value",
+        RuleResultDataProperty.untyped_value(),
+    ):
+        if untyped_value is not None:
+            # the typed values are not set yet, see refresh_rule_result_typed_values
+            typed_values = RuleResultDataProperty.typed_values(untyped_value)
+            float_value, array_value = typed_values["float_value"], typed_values["array_value"]
+        ballot_type_id, country, year, size_bucket = election_cells[election_id]
+        key = (ballot_type_id, country, year, size_bucket, rule_id, metadata_id)
+        if key not in aggregates:
+            aggregates[key] = RulePropertyAggregate(
+                rule_id=rule_id,
+                metadata_id=metadata_id,
+                ballot_type_id=ballot_type_id,
+                country=country,
+                year=year,
+                size_bucket=size_bucket,
+            )
+        aggregate = aggregates[key]
+        aggregate.count += 1
+        if float_value is not None:
+            aggregate.num_values += 1
+            aggregate.sum += float_value
+            aggregate.sum_squares += float_value * float_value
+        elif array_value is not None:
+            aggregate.num_values += 1
+            vector = np.frombuffer(array_value, dtype="<f8")
+            if key in mixed_lengths:
+                continue
+            if key in vector_sums and len(vector_sums[key]) != len(vector):
+                # the arrays of different lengths have no entrywise sum, the api averages them from the
+                # properties when it finds an aggregate with values but no vector_sum
+                del vector_sums[key]
+                mixed_lengths.add(key)
+                continue
+            vector_sums[key] = vector_sums[key] + vector if key in vector_sums else vector.copy()
+    for key, vector_sum in vector_sums.items():
+        aggregates[key].vector_sum = vector_sum.astype("<f8").tobytes()
+
+    with transaction.atomic(using=database):
+        aggregate_query.delete()
+        RulePropertyAggregate.objects.using(database).bulk_create(aggregates.values(), batch_size=1000)
+        if metadata_ids is None:
+            stale_query = StaleRulePropertyCell.objects.using(database).filter(cell_query)
+            if rule_ids is not None:
+                stale_query = stale_query.filter(rule_id__in=rule_ids)
+            stale_query.delete()
+
+
+def cube_cell_filter(election_filters: dict) -> Q | None:
+    """
+    Translates the election filters to a Q object on the cells of the cube, or returns None if some
+    filter does not align with the dimensions: the filters on the ballot type and the country, the
+    filters on date_begin from the first to the last day of years, and the filters on num_votes
+    between powers of ten.
+    """
+    cell_filter = Q()
+    for election_property, election_property_filter in election_filters.items():
+        if election_property == "ballot_type":
+            if isinstance(election_property_filter, str):
+                cell_filter &= Q(ballot_type=election_property_filter)
+            elif isinstance(election_property_filter, list) and all(
+                isinstance(item, str) for item in election_property_filter
+            ):
+                cell_filter &= Q(ballot_type__in=election_property_filter)
+            else:
+                return None
+            continue
+        if not isinstance(election_property_filter, dict):
+            return None
+        bounds = {key: value for key, value in election_property_filter.items() if value is not None}
+        if election_property == "country" and set(bounds) <= {"contains", "equals"}:
+            if "contains" in bounds:
+                cell_filter &= Q(country__icontains=bounds["contains"])
+            if "equals" in bounds:
+                cell_filter &= Q(country=bounds["equals"])
+        elif election_property == "date_begin" and set(bounds) <= {"min", "max"}:
+            try:
+                dates = {key: datetime.date.fromisoformat(value) for key, value in bounds.items()}
+            except (TypeError, ValueError):
+                return None
+            if "min" in dates:
+                if (dates["min"].month, dates["min"].day) != (1, 1):
+                    return None
+                cell_filter &= Q(year__gte=dates["min"].year)
+            if "max" in dates:
+                if (dates["max"].month, dates["max"].day) != (12, 31):
+                    return None
+                cell_filter &= Q(year__lte=dates["max"].year)
+        elif election_property == "num_votes" and set(bounds) <= {"min", "max"}:
+            if not all(isinstance(value, (int, float)) for value in bounds.values()):
+                return None
+            if "min" in bounds:
+                if bounds["min"] not in SIZE_BUCKET_MINS:
+                    return None
+                cell_filter &= Q(size_bucket__gte=SIZE_BUCKET_MINS[bounds["min"]])
+            if "max" in bounds:
+                if bounds["max"] not in SIZE_BUCKET_MAXS:
+                    return None
+                cell_filter &= Q(size_bucket__lte=SIZE_BUCKET_MAXS[bounds["max"]])
+        else:
+            return None
+    return cell_filter
@@ -0,0 +1,169 @@
+import datetime
+import json
+import os
+import uuid
+
+from django.conf import settings
+
+import pb_visualizer
+from pb_visualizer.models import Election, Rule
+
+
+def run_dir_path() -> str:
+    """Returns the folder of the run journals, COMPUTE_RUN_DIR if it is set."""
+    return getattr(
+        settings,
+        "COMPUTE_RUN_DIR",
+        os.path.join(os.path.dirname(pb_visualizer.__file__), "cache", "runs"),
+    )
+
+
+def _now() -> str:
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+class RunJournal:
+    """
+    The journal of a compute run, a JSON lines file: the options of the run, its (election, rules)
+    tasks in the order they are run, then one line per rule result stored or failed, with the time
+    its task took, and for compute_all one line per election whose other nodes were stored. The lines
+    are appended as the run goes, so a run that crashed or was killed can be resumed from its journal,
+    see remaining_tasks.
+    """
+
+    def __init__(
+        self,
+        run_id: str,
+        command: str,
+        options: dict,
+        tasks: list[dict],
+        completed: set,
+        failed: dict,
+        completed_elections: set | None = None,
+    ):
+        self.run_id = run_id
+        self.command = command
+        self.options = options
+        self.tasks = tasks
+        self.completed = completed
+        self.failed = failed
+        self.completed_elections = completed_elections if completed_elections is not None else set()
+
+    @staticmethod
+    def file_path(run_id: str) -> str:
+        return os.path.join(run_dir_path(), f"{run_id}.jsonl")
+
+    def _append(self, *entries: dict):
+        with open(self.file_path(self.run_id), "a") as file:
+            for entry in entries:
+                file.write(json.dumps(entry) + "\n")
+
+    @classmethod
+    def create(cls, command: str, options: dict, tasks: list) -> "RunJournal":
+        """Starts the journal of a new run of the given (election, rule objects) tasks."""
+        run_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+        task_entries = [
+            {
+                "election_id": election_obj.id,
+                "election_name": election_obj.name,
+                "rules": [rule_obj.abbreviation for rule_obj in rule_objs],
+            }
+            for election_obj, rule_objs in tasks
+        ]
+        journal = cls(run_id, command, options, task_entries, set(), {})
+        os.makedirs(run_dir_path(), exist_ok=True)
+        journal._append(
+            {"type": "run", "command": command, "options": options, "time": _now()},
+            {"type": "tasks", "tasks": task_entries},
+        )
+        return journal
+
+    @classmethod
+    def open(cls, run_id: str) -> "RunJournal":
+        """Reads the journal of a previous run to resume it."""
+        file_path = cls.file_path(run_id)
+        if not os.path.exists(file_path):
+            raise ValueError(f"No journal found for the run {run_id} in {run_dir_path()}")
+        with open(file_path) as file:
+            lines = file.read().split("\n")
+        # the last line is incomplete if the run was killed while writing it, it is ended so that the
+        # lines appended now can be read
+        if lines[-1]:
+            with open(file_path, "a") as file:
+                file.write("\n")
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+        if len(entries) < 2:
+            raise ValueError(f"The journal of the run {run_id} has no tasks")
+        completed, failed, completed_elections = set(), {}, set()
+        for entry in entries[2:]:
+            key = (entry.get("election_id"), entry.get("rule"))
+            if entry["type"] == "done":
+                completed.add(key)
+                failed.pop(key, None)
+            elif entry["type"] == "failed":
+                failed[key] = entry["reason"]
+            elif entry["type"] == "election":
+                completed_elections.add(entry["election_id"])
+        journal = cls(
+            run_id,
+            entries[0]["command"],
+            entries[0]["options"],
+            entries[1]["tasks"],
+            completed,
+            failed,
+            completed_elections,
+        )
+        journal._append({"type": "resumed", "time": _now()})
+        return journal
+
+    def remaining_tasks(self, database: str = "default") -> list:
+        """
+        The (election, rule objects) tasks of the run whose results were not stored, in their order.
+        The failed rules are run again.
+        """
+        elections = Election.objects.using(database).in_bulk({task["election_id"] for task in self.tasks})
+        rule_objs = Rule.objects.using(database).in_bulk()
+        tasks = []
+        for task in self.tasks:
+            election_obj = elections.get(task["election_id"])
+            rules = [rule for rule in task["rules"] if (task["election_id"], rule) not in self.completed]
+            # the elections removed since the run started are skipped
+            if election_obj is not None and rules:
+                tasks.append((election_obj, [rule_objs[rule] for rule in rules]))
+        return tasks
+
+    def record_done(self, done: list):
+        """Records the (election, rule, seconds) results that were stored."""
+        self._append(
+            *(
+                {"type": "done", "election_id": election_obj.id, "rule": rule_obj.abbreviation, "seconds": seconds}
+                for election_obj, rule_obj, seconds in done
+            )
+        )
+        self.completed.update((election_obj.id, rule_obj.abbreviation) for election_obj, rule_obj, _ in done)
+
+    def record_failed(self, election_obj: Election, rule_obj: Rule, error: Exception, seconds: float | None):
+        reason = f"{type(error).__name__}: {error}"
+        self._append(
+            {
+                "type": "failed",
+                "election_id": election_obj.id,
+                "rule": rule_obj.abbreviation,
+                "reason": reason,
+                "seconds": seconds,
+            }
+        )
+        self.failed[(election_obj.id, rule_obj.abbreviation)] = reason
+
+    def record_election_done(self, election_obj: Election):
+        """Records that the nodes of the election not depending on the rules of the run were stored."""
+        self._append({"type": "election", "election_id": election_obj.id})
+        self.completed_elections.add(election_obj.id)
+
+    def record_finished(self):
+        self._append({"type": "finished", "time": _now()})
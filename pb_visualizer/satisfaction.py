@@ -0,0 +1,191 @@
+import math
+
+import numpy as np
+from pabutools.election import Project as PabutoolsProject, max_budget_allocation_cost
+from pulp import LpBinary, LpMaximize, LpProblem, LpVariable, PULP_CBC_CMD, lpSum, value
+
+from pb_visualizer.compact_profile import CompactProfile
+
+
+def _safe_divide(values: np.ndarray, normalisers: np.ndarray) -> np.ndarray:
+    """Divides the values by the normalisers, the voters with a normaliser of 0 get 0."""
+    res = np.zeros(len(values))
+    np.divide(values, normalisers, out=res, where=normalisers != 0)
+    return res
+
+
+def gini_coefficient(values: np.ndarray) -> float:
+    """Same formula as pabutools.utils.gini_coefficient, on a NumPy vector."""
+    if np.any(values < 0):
+        raise ValueError("Negative values not supported by gini coefficient implementation.")
+    total = float(values.sum())
+    if total == 0:
+        return 0
+    num_values = len(values)
+    sorted_values = np.sort(values)
+    total_cum_sum = float(np.dot(sorted_values, np.arange(num_values, 0, -1)))
+    return (num_values + 1 - 2 * total_cum_sum / total) / num_values
+
+
+def histogram(values: np.ndarray, max_value: float, num_bins: int = 21) -> list[float]:
+    """Same binning as pabutools.analysis.satisfaction_histogram, on a NumPy vector."""
+    hist_data = [0.0 for _ in range(num_bins)]
+    for value_, count in zip(*np.unique(values, return_counts=True)):
+        if value_ >= max_value:
+            hist_data[-1] += int(count)
+        else:
+            hist_data[math.ceil(value_ * (num_bins - 1) / max_value)] += int(count)
+    return [count / len(values) for count in hist_data]
+
+
+class SatisfactionEngine:
+    """
+    Computes the satisfaction of every voter of a CompactProfile for budget allocations. The
+    normalisers that only depend on the election are computed once and reused for every allocation.
+    """
+
+    def __init__(self, compact_profile: CompactProfile):
+        self.compact_profile = compact_profile
+        self.project_numbers = {name: index for index, name in enumerate(compact_profile.project_names)}
+        self._cache = {}
+
+    def _cached(self, key: str, compute):
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
+    def entry_costs(self) -> np.ndarray:
+        return self._cached("entry_costs", lambda: self.compact_profile.costs[self.compact_profile.indices])
+
+    def borda_scores(self) -> np.ndarray:
+        # the strength of an ordinal vote is the length of the ballot minus the position
+        return self._cached("borda_scores", lambda: self.compact_profile.strengths - 1)
+
+    def max_budget_allocation_cardinality(self) -> int:
+        def compute():
+            cumulative_costs = np.cumsum(np.sort(self.compact_profile.costs))
+            return int(np.searchsorted(cumulative_costs, self.compact_profile.budget_limit, side="right"))
+
+        return self._cached("max_card", compute)
+
+    def max_budget_allocation_cost(self) -> float:
+        def compute():
+            projects = [PabutoolsProject(str(i), cost) for i, cost in enumerate(self.compact_profile.costs)]
+            return float(max_budget_allocation_cost(projects, self.compact_profile.budget_limit))
+
+        return self._cached("max_cost", compute)
+
+    def ballot_max_cardinalities(self) -> np.ndarray:
+        """Per voter, the largest number of projects of the ballot fitting in the budget."""
+
+        def compute():
+            cp = self.compact_profile
+            # the entries sorted by voter and, within a ballot, from the cheapest to the most expensive
+            order = np.lexsort((self.entry_costs(), cp.voter_index))
+            cumulative_costs = np.cumsum(self.entry_costs()[order])
+            ballot_starts = np.repeat(np.concatenate(([0], cumulative_costs))[cp.indptr[:-1]], cp.ballot_lengths())
+            fits = cumulative_costs - ballot_starts <= cp.budget_limit
+            return np.bincount(cp.voter_index[order], weights=fits, minlength=cp.num_voters)
+
+        return self._cached("ballot_max_card", compute)
+
+    def ballot_cost_normalisers(self) -> np.ndarray:
+        """Per voter, the minimum of the total cost of the ballot and the budget limit."""
+        return self._cached(
+            "ballot_cost_normalisers",
+            lambda: np.minimum(self.compact_profile.voter_sums(self.entry_costs()), self.compact_profile.budget_limit),
+        )
+
+    def ballot_max_scores(self) -> np.ndarray:
+        """Per voter, the highest total score of a feasible budget allocation, solved once per distinct ballot."""
+
+        def compute():
+            cp = self.compact_profile
+            res = np.zeros(cp.num_voters)
+            solved = {}
+            for voter in range(cp.num_voters):
+                start, end = cp.indptr[voter], cp.indptr[voter + 1]
+                key = (cp.indices[start:end].tobytes(), cp.strengths[start:end].tobytes())
+                if key not in solved:
+                    solved[key] = self._max_score(cp.indices[start:end], cp.strengths[start:end])
+                res[voter] = solved[key]
+            return res
+
+        return self._cached("ballot_max_scores", compute)
+
+    def _max_score(self, projects: np.ndarray, scores: np.ndarray) -> float:
+        # only the projects with a positive score can increase the total score
+        positive = [(int(p), float(s)) for p, s in zip(projects, scores) if s > 0]
+        if not positive:
+            return 0
+        mip_model = LpProblem("MaxBudgetAllocationScore", LpMaximize)
+        p_vars = {p: LpVariable(f"x_{p}", cat=LpBinary) for p, _ in positive}
+        mip_model += lpSum(p_vars[p] * s for p, s in positive)
+        mip_model += lpSum(p_vars[p] * float(self.compact_profile.costs[p]) for p, _ in positive) <= self.compact_profile.budget_limit
+        mip_model.solve(PULP_CBC_CMD(msg=False))
+        return value(mip_model.objective) or 0
+
+    def allocation(self, selected_project_names) -> "AllocationSatisfaction":
+        selected = np.zeros(self.compact_profile.num_projects, dtype=bool)
+        selected[[self.project_numbers[name] for name in selected_project_names]] = True
+        return AllocationSatisfaction(self, selected)
+
+
+class AllocationSatisfaction:
+    """
+    The satisfaction vectors of the voters for one budget allocation, each family of satisfaction
+    being computed once however many properties are derived from it.
+    """
+
+    def __init__(self, engine: SatisfactionEngine, selected: np.ndarray):
+        self.engine = engine
+        self.compact_profile = engine.compact_profile
+        self.selected = selected
+        self.entry_selected = selected[self.compact_profile.indices]
+        self._vectors = {}
+
+    def selected_costs(self) -> np.ndarray:
+        return self.compact_profile.costs[self.selected]
+
+    def _selected_sums(self, entry_values: np.ndarray) -> np.ndarray:
+        return self.compact_profile.voter_sums(np.where(self.entry_selected, entry_values, 0))
+
+    def vector(self, family: str) -> np.ndarray:
+        """Returns the satisfaction of every voter for the given family, see vector_functions."""
+        if family not in self._vectors:
+            self._vectors[family] = self.vector_functions[family](self)
+        return self._vectors[family]
+
+    def _cc(self) -> np.ndarray:
+        # the highest strength of a selected project, 1 for approval ballots
+        cp = self.compact_profile
+        values = np.where(self.entry_selected, cp.strengths, 0)
+        res = np.zeros(cp.num_voters)
+        np.maximum.at(res, cp.voter_index, values)
+        return res
+
+    vector_functions = {
+        "card": lambda self: self._selected_sums(np.ones(len(self.entry_selected))),
+        "cost": lambda self: self._selected_sums(self.engine.entry_costs()),
+        "cardinal": lambda self: self._selected_sums(self.compact_profile.strengths),
+        "borda": lambda self: self._selected_sums(self.engine.borda_scores()),
+        "cc": _cc,
+        "relcard": lambda self: _safe_divide(self.vector("card"), self.engine.ballot_max_cardinalities()),
+        "relcost": lambda self: _safe_divide(self.vector("cost"), self.engine.ballot_cost_normalisers()),
+        "relcardinal": lambda self: _safe_divide(self.vector("cardinal"), self.engine.ballot_max_scores()),
+    }
+
+    def average(self, family: str) -> float:
+        return float(np.mean(self.vector(family)))
+
+    def positive_share(self, family: str) -> float:
+        # no voter has a positive satisfaction in an election without voters
+        if self.compact_profile.num_voters == 0:
+            return 0.0
+        return float(np.count_nonzero(self.vector(family) > 0)) / self.compact_profile.num_voters
+
+    def inverted_gini(self, family: str) -> float:
+        return 1 - gini_coefficient(self.vector(family))
+
+    def histogram(self, family: str, max_value: float, num_bins: int = 21) -> list[float]:
+        return histogram(self.vector(family), max_value, num_bins)
@@ -1,8 +1,14 @@
+from django.db.models.signals import post_delete
+from django.core.management import call_command
 from django.test import TestCase
 from pb_visualizer.management.commands.add_election import add_election
 from pb_visualizer.management.commands.initialize_db import initialize_db
+from pb_visualizer.management.commands.utils import delete_elections, raw_delete
 from pb_visualizer.models import *
+import contextlib
+import io
 import os
+import tempfile
 
 
 # Create your tests here.
@@ -64,5 +70,150 @@ class AddElectionTestCase(TestCase):
             == 2
         )
 
+    def test_reimport(self):
+        """re-importing a file only applies its differences, an unchanged file is skipped"""
+        file_path = "pb_visualizer/tests/test_files/test_file_non_integral_data.pb"
+        election = add_election(file_path, None, verbosity=0)
+        kept_voter_id = Voter.objects.get(election=election, voter_id="1330").id
+
+        # the same file is skipped even without override
+        add_election(file_path, None, verbosity=0)
+
+        with open(file_path, encoding="utf-8") as file:
+            content = file.read()
+        content = (
+            content.replace("P8;2000;", "P8;2500;")
+            .replace("tar2;cat2,cat3", "tar2;cat2")
+            .replace("1256;P8;", "1256;P28;")
+            .replace("1793;P00;neigh1;meth3", "2000;P00;neigh1;meth1")
+        )
+        with tempfile.TemporaryDirectory() as dir_path:
+            changed_file_path = os.path.join(dir_path, os.path.basename(file_path))
+            with open(changed_file_path, "w", encoding="utf-8") as file:
+                file.write(content)
+            self.assertRaises(Exception, lambda: add_election(changed_file_path, False, verbosity=0))
+            election = add_election(changed_file_path, True, verbosity=0)
+
+        assert Election.objects.filter(name="election1").count() == 1
+        assert Project.objects.get(election=election, project_id="P8").cost == 2500
+        assert not Category.objects.filter(election=election, name="cat3").exists()
+        assert not VotingMethod.objects.filter(election=election, name="meth3").exists()
+        assert not Voter.objects.filter(election=election, voter_id="1793").exists()
+        assert Voter.objects.get(election=election, voter_id="1330").id == kept_voter_id
+        assert list(
+            Voter.objects.get(election=election, voter_id="1256").votes.values_list("project_id", flat=True)
+        ) == ["P28"]
+        assert Voter.objects.get(election=election, voter_id="2000").votes.count() == 1
+        assert election.num_votes == election.voters.count()
+
+    def test_delete_elections(self):
+        """deleting an election removes everything referring to it and nothing else"""
+        election = add_election(
+            "pb_visualizer/tests/test_files/test_file_non_integral_data.pb", None, verbosity=0
+        )
+        other_election = add_election(
+            "pb_visualizer/tests/test_files/test_file_ordinal.pb", None, verbosity=0
+        )
+        rule_result = RuleResult.objects.create(election=election, rule=Rule.objects.first())
+        rule_result.selected_projects.set(election.projects.all())
+        num_other_preferences = PreferenceInfo.objects.filter(voter__election=other_election).count()
+
+        delete_elections(Election.objects.filter(id=election.id))
+
+        assert not Election.objects.filter(id=election.id).exists()
+        for model_class in [Voter, Project, Category, Target, VotingMethod, Neighborhood, RuleResult]:
+            assert not model_class.objects.filter(election_id=election.id).exists()
+        assert not PreferenceInfo.objects.filter(voter__election_id=election.id).exists()
+        assert not RuleResult.selected_projects.through.objects.filter(ruleresult_id=rule_result.id).exists()
+        assert PreferenceInfo.objects.filter(voter__election=other_election).count() == num_other_preferences
+
     # def tearDown(self) -> None:
     #     return super().tearDown()
+
+    def test_raw_delete(self):
+        """raw_delete runs one DELETE statement, without loading the rows, sending signals or cascading"""
+        election = add_election(
+            "pb_visualizer/tests/test_files/test_file_non_integral_data.pb", None, verbosity=0
+        )
+        rule_result = RuleResult.objects.create(election=election, rule=Rule.objects.first())
+        RuleResultDataProperty.objects.create(rule_result=rule_result, metadata_id="avg_card_sat", value="1")
+        ElectionDataProperty.objects.create(election=election, metadata_id="fund_scarc", value="1")
+        deleted = []
+
+        def on_delete(sender, instance, **kwargs):
+            deleted.append(instance)
+
+        post_delete.connect(on_delete, sender=ElectionDataProperty)
+        try:
+            num_preferences = PreferenceInfo.objects.filter(voter__election=election).count()
+            with self.assertNumQueries(1):
+                assert raw_delete(PreferenceInfo.objects.filter(voter__election=election)) == num_preferences
+            with self.assertNumQueries(1):
+                assert raw_delete(ElectionDataProperty.objects.filter(election=election)) == 1
+        finally:
+            post_delete.disconnect(on_delete, sender=ElectionDataProperty)
+        assert deleted == []
+        assert not PreferenceInfo.objects.filter(voter__election=election).exists()
+        assert Voter.objects.filter(election=election).count() == election.num_votes
+
+        # the result properties and the cube have no dependents nor delete receivers, QuerySet.delete()
+        # is one statement for them too
+        with self.assertNumQueries(1):
+            RuleResultDataProperty.objects.filter(rule_result=rule_result).delete()
+        with self.assertNumQueries(1):
+            RuleResult.selected_projects.through.objects.filter(ruleresult=rule_result).delete()
+        with self.assertNumQueries(1):
+            RulePropertyAggregate.objects.all().delete()
+
+    def test_parallel_import(self):
+        """the files parsed by several processes are stored as by the serial import, the failing ones skipped"""
+        file_paths = [
+            os.path.join("pb_visualizer/tests/test_files", file_name)
+            for file_name in [
+                "test_file_approval.pb",
+                "test_file_missing_budget.pb",
+                "test_file_cumulative.pb",
+                "test_file_ordinal.pb",
+                "test_file_non_integral_data.pb",
+            ]
+        ]
+        # the last vote of this file is only found invalid once its first voters are written
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        with open("pb_visualizer/tests/test_files/test_file_approval.pb") as file:
+            content = file.read().replace("name;approval_election", "name;invalid_vote_election")
+        file_paths.insert(1, os.path.join(tmp_dir.name, "test_file_invalid_vote.pb"))
+        with open(file_paths[1], "w") as file:
+            file.write(content + "\n99;99;paper")
+
+        def stored_elections():
+            return {
+                election.name: (
+                    {
+                        field: value
+                        for field, value in Election.objects.filter(id=election.id).values().get().items()
+                        if field != "id"
+                    },
+                    sorted(election.projects.values_list("project_id", "name", "cost")),
+                    sorted(
+                        election.voters.values_list(
+                            "voter_id", "age", "gender", "voting_method__name", "neighborhood__name"
+                        )
+                    ),
+                    sorted(
+                        PreferenceInfo.objects.filter(voter__election=election).values_list(
+                            "voter__voter_id", "project__project_id", "preference_strength"
+                        )
+                    ),
+                )
+                for election in Election.objects.all()
+            }
+
+        # the voters are sent by the workers one per batch, the tracebacks of the failing files are printed
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_command("add_election", f=file_paths, batch_size=1, verbosity=0)
+            serial_elections = stored_elections()
+            delete_elections(Election.objects.all())
+            call_command("add_election", f=file_paths, jobs=2, batch_size=1, verbosity=0)
+        assert stored_elections() == serial_elections
+        assert len(serial_elections) == len(file_paths) - 2
@@ -1,8 +1,18 @@
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from pb_visualizer.management.commands.add_election import add_election
 from pb_visualizer.management.commands.initialize_db import initialize_db
+from pb_visualizer.management.commands.refresh_rule_property_cube import refresh_all_rule_property_cube
+from pb_visualizer.management.commands.refresh_rule_result_typed_values import refresh_rule_result_typed_values
+from pb_visualizer.management.commands.utils import delete_rule_results, refresh_election_property_rows
 from pb_visualizer.models import *
 from pb_visualizer.api import *
+from pb_visualizer.rule_property_cube import (
+    mark_rule_property_cells_stale,
+    refresh_rule_property_cube,
+    rule_property_cube_is_fresh,
+)
 import numpy as np
 
 # Create your tests here.
@@ -265,6 +275,243 @@ class TestApi(TestCase):
         assert np.all(hist_data["data"]["mes_cost"]["hist_data"] == [0.5, 0.25, 0.25])
         assert hist_data["meta_data"]["num_elections"] == 2
 
+        # the spread of the histograms of the elections around their average
+        hist_data = get_satisfaction_histogram(rule_list, with_spread=True)
+        assert hist_data["data"]["greedy_cost"]["hist_data"] == [0.25, 0.25, 0.5]
+        assert hist_data["data"]["greedy_cost"]["hist_std"] == [0.25, 0.25, 0.5]
+        assert hist_data["data"]["mes_cost"]["hist_quantiles"]["0.25"] == [0.375, 0.25, 0.125]
+        assert hist_data["data"]["mes_cost"]["hist_quantiles"]["0.75"] == [0.625, 0.25, 0.375]
+        assert "spread" not in hist_data
+        avg_values = get_rule_result_average_data_properties(
+            rule_list, ["agg_nrmcost_sat", "avg_nrmcost_sat"], with_spread=True, quantiles=[0.5]
+        )
+        assert avg_values["spread"]["mes_cost"] == {
+            "agg_nrmcost_sat": {"std": [0.25, 0, 0.25], "quantiles": {"0.5": [0.5, 0.25, 0.25]}}
+        }
+
+    def test_rule_result_typed_values(self):
+        election_obj = Election.objects.create(id=0, name="e0", budget=1, ballot_type_id="approval")
+        rule_result_obj = RuleResult.objects.create(rule_id="greedy_cost", election=election_obj)
+        scalar_obj = RuleResultDataProperty.objects.create(
+            rule_result=rule_result_obj, metadata_id="avg_card_sat", value="0.25"
+        )
+        list_obj = RuleResultDataProperty.objects.create(
+            rule_result=rule_result_obj, metadata_id="agg_nrmcost_sat", value=json.dumps([0.5, 0, 1.5])
+        )
+        scalar_obj.refresh_from_db()
+        list_obj.refresh_from_db()
+        assert scalar_obj.float_value == 0.25 and scalar_obj.array_value is None
+        assert list_obj.float_value is None
+        assert RuleResultDataProperty.unpack_array(list_obj.array_value) == (0.5, 0, 1.5)
+
+        # the typed values follow the value saved
+        list_obj.value = json.dumps([1, 2])
+        list_obj.save(update_fields=["value"])
+        list_obj.refresh_from_db()
+        assert RuleResultDataProperty.unpack_array(list_obj.array_value) == (1, 2)
+
+        # the bulk writes do not go through save, the command sets the typed values from the text
+        RuleResultDataProperty.objects.filter(id=scalar_obj.id).update(float_value=None)
+        refresh_rule_result_typed_values(verbosity=0)
+        scalar_obj.refresh_from_db()
+        assert scalar_obj.float_value == 0.25
+
+        # the averages take a constant number of queries, the budget filter is not answered by the cube
+        with self.assertNumQueries(4):
+            avg_values = get_rule_result_average_data_properties(
+                ["greedy_cost"],
+                ["avg_card_sat", "agg_nrmcost_sat"],
+                election_filters={"budget": {"min": 0}},
+                include_incomplete_elections=True,
+            )
+        assert avg_values["data"] == {"greedy_cost": {"avg_card_sat": 0.25, "agg_nrmcost_sat": [1, 2]}}
+
+        # the rows stored before the typed fields are averaged from their text value, by the cube too
+        RuleResultDataProperty.objects.update(float_value=None, array_value=None)
+        for election_filters in [{"budget": {"min": 0}}, {}]:
+            refresh_all_rule_property_cube(verbosity=0)
+            avg_values = get_rule_result_average_data_properties(
+                ["greedy_cost"],
+                ["avg_card_sat", "agg_nrmcost_sat"],
+                election_filters=election_filters,
+                include_incomplete_elections=True,
+            )
+            assert avg_values["data"] == {"greedy_cost": {"avg_card_sat": 0.25, "agg_nrmcost_sat": [1, 2]}}
+
+    def test_rule_property_cube(self):
+        def rounded(value):
+            # the cube sums the values in another order
+            if isinstance(value, dict):
+                return {key: rounded(item) for key, item in value.items()}
+            if isinstance(value, list):
+                return [rounded(item) for item in value]
+            return round(value, 9) if isinstance(value, float) else value
+
+        for i in range(6):
+            election_obj = Election.objects.create(
+                id=i,
+                name="e" + str(i),
+                budget=1,
+                ballot_type_id="approval" if i < 4 else "ordinal",
+                country="Poland" if i % 2 == 0 else "France",
+                date_begin=datetime.date(2020 + i % 3, 6, 1),
+                num_votes=10**i,
+            )
+            for rule in ["greedy_cost", "mes_cost"]:
+                rule_result_obj = RuleResult.objects.create(rule_id=rule, election=election_obj)
+                RuleResultDataProperty.objects.create(
+                    rule_result=rule_result_obj, metadata_id="avg_card_sat", value=str(i + len(rule))
+                )
+                # the results of e1 miss the histogram, the one of e5 for mes_cost only
+                if i != 1 and (i, rule) != (5, "mes_cost"):
+                    RuleResultDataProperty.objects.create(
+                        rule_result=rule_result_obj,
+                        metadata_id="agg_nrmcost_sat",
+                        value=json.dumps([i / 10, 1 - i / 10]),
+                    )
+
+        requests = [
+            (["greedy_cost", "mes_cost"], ["avg_card_sat", "agg_nrmcost_sat"], {}, False),
+            (["greedy_cost", "mes_cost"], ["avg_card_sat", "agg_nrmcost_sat"], {}, True),
+            (["greedy_cost"], ["avg_card_sat"], {"ballot_type": "approval", "country": {"equals": "Poland"}}, False),
+            (["mes_cost"], ["agg_nrmcost_sat"], {"date_begin": {"min": "2021-01-01", "max": "2022-12-31"}}, False),
+            (["greedy_cost"], ["avg_card_sat"], {"num_votes": {"min": 10, "max": 9999}}, True),
+            (["greedy_cost"], ["avg_card_sat"], {"num_votes": {"min": 5}}, True),
+            (["greedy_cost", "mes_cost"], ["agg_nrmcost_sat"], {"ballot_type": ["ordinal"]}, False),
+        ]
+        # the cube is used once built, until properties are written without refreshing their cells
+        refresh_all_rule_property_cube(verbosity=0)
+        cube_results = [get_rule_result_average_data_properties(*request) for request in requests]
+        # the aligned filters are answered from the cube, without reading the properties
+        with CaptureQueriesContext(connection) as queries:
+            get_rule_result_average_data_properties(*requests[2])
+        assert not any("ruleresultdataproperty" in query["sql"] for query in queries.captured_queries)
+        assert cube_results[2] == {"data": {"greedy_cost": {"avg_card_sat": 12}}, "meta_data": {"num_elections": 2}}
+
+        def raw_results():
+            RulePropertyCubeState.objects.update(built=False)
+            results = [get_rule_result_average_data_properties(*request) for request in requests]
+            RulePropertyCubeState.objects.update(built=True)
+            return results
+
+        assert rounded(cube_results) == rounded(raw_results())
+        data_property_obj = RuleResultDataProperty.objects.get(
+            rule_result__election_id=2, rule_result__rule_id="greedy_cost", metadata_id="avg_card_sat"
+        )
+        data_property_obj.value = "100"
+        data_property_obj.save()
+        mark_rule_property_cells_stale([2], rule_ids=["greedy_cost"])
+        assert not rule_property_cube_is_fresh()
+        assert get_rule_result_average_data_properties(*requests[2]) == {
+            "data": {"greedy_cost": {"avg_card_sat": 55.5}},
+            "meta_data": {"num_elections": 2},
+        }
+        # the other cells and rules are still answered from the cube
+        assert rule_property_cube_is_fresh(Q(country="France"), ["greedy_cost"])
+        assert rule_property_cube_is_fresh(rule_ids=["mes_cost"])
+        refresh_rule_property_cube([2], rule_ids=["greedy_cost"])
+        assert rule_property_cube_is_fresh()
+        assert rounded([get_rule_result_average_data_properties(*request) for request in requests]) == rounded(raw_results())
+
+        # the aggregates follow the deleted rule results and elections
+        delete_rule_results(RuleResult.objects.filter(election_id=0))
+        assert rounded([get_rule_result_average_data_properties(*request) for request in requests]) == rounded(raw_results())
+        Election.objects.get(id=2).delete()
+        assert rule_property_cube_is_fresh()
+        assert rounded([get_rule_result_average_data_properties(*request) for request in requests]) == rounded(raw_results())
+        refresh_all_rule_property_cube(verbosity=0)
+        assert rule_property_cube_is_fresh()
+        assert rounded([get_rule_result_average_data_properties(*request) for request in requests]) == rounded(raw_results())
+
+    def test_list_properties_of_different_lengths(self):
+        """the arrays of another length than the most common one are skipped, with or without the cube"""
+        arrays = [[0.5, 0.5], [1, 0], [1, 2, 3], [4]]
+        for i, array in enumerate(arrays):
+            election_obj = Election.objects.create(
+                id=i, name="e" + str(i), budget=1, ballot_type_id="approval", country="France" if i == 2 else "Poland"
+            )
+            rule_result_obj = RuleResult.objects.create(rule_id="greedy_cost", election=election_obj)
+            RuleResultDataProperty.objects.create(
+                rule_result=rule_result_obj, metadata_id="agg_nrmcost_sat", value=json.dumps(array)
+            )
+        refresh_all_rule_property_cube(verbosity=0)
+        # the arrays differ within the cell of Poland and across the cells
+        for election_filters in [{}, {"country": {"equals": "Poland"}}, {"budget": {"min": 0}}]:
+            avg_values = get_rule_result_average_data_properties(
+                ["greedy_cost"], ["agg_nrmcost_sat"], election_filters, with_spread=bool(election_filters)
+            )
+            assert avg_values["data"] == {"greedy_cost": {"agg_nrmcost_sat": [0.75, 0.25]}}
+        assert avg_values["spread"]["greedy_cost"]["agg_nrmcost_sat"]["std"] == [0.25, 0.25]
+        RuleResultDataProperty.objects.filter(rule_result__election_id=3).delete()
+        refresh_all_rule_property_cube(verbosity=0)
+        avg_values = get_rule_result_average_data_properties(["greedy_cost"], ["agg_nrmcost_sat"], {})
+        assert avg_values["data"] == {"greedy_cost": {"agg_nrmcost_sat": [0.75, 0.25]}}
+
+    def test_get_election_details(self):
+        avg_ballot_len_obj = ElectionMetadata.objects.get(short_name="avg_ballot_len")
+        fund_scarc_obj = ElectionMetadata.objects.get(short_name="fund_scarc")
+
+        def add_elections(ids):
+            for i in ids:
+                election_obj = Election.objects.create(
+                    id=i,
+                    name="e" + str(i),
+                    budget=100 * i,
+                    ballot_type_id="approval",
+                    num_votes=20 * i,
+                    date_begin=datetime.date(2020, 1, i + 1),
+                )
+                ElectionDataProperty.objects.create(election=election_obj, metadata=avg_ballot_len_obj, value=i)
+                if i % 2 == 0:
+                    ElectionDataProperty.objects.create(election=election_obj, metadata=fund_scarc_obj, value=2 * i)
+
+        property_short_names = ["budget", "ballot_type", "date_begin", "avg_ballot_len", "fund_scarc"]
+        add_elections(range(3))
+        details = get_election_details(property_short_names, "approval", {})
+        assert details["data"]["e1"] == {
+            "budget": 100,
+            "ballot_type": "approval",
+            "date_begin": "2020-01-02",
+            "avg_ballot_len": 1,
+            "user_submitted": False,
+        }
+        assert details["data"]["e2"]["fund_scarc"] == 4
+        assert "fund_scarc" not in details["data"]["e1"]
+        assert set(get_election_details(["num_votes"], "approval", {"num_votes": {"min": 20}})["data"]) == {"e1", "e2"}
+
+        # the number of queries does not depend on the number of elections
+        with CaptureQueriesContext(connection) as queries:
+            get_election_details(property_short_names, "approval", {})
+        add_elections(range(3, 10))
+        with self.assertNumQueries(len(queries.captured_queries)):
+            details = get_election_details(property_short_names, "approval", {})
+        assert len(details["data"]) == 10
+
+    def test_election_property_row(self):
+        avg_ballot_len_obj = ElectionMetadata.objects.get(short_name="avg_ballot_len")
+        fund_scarc_obj = ElectionMetadata.objects.get(short_name="fund_scarc")
+        for i in range(3):
+            election_obj = Election.objects.create(id=i, name="e" + str(i), budget=100, ballot_type_id="approval")
+            ElectionDataProperty.objects.create(election=election_obj, metadata=avg_ballot_len_obj, value=i)
+
+        # the rows follow the data properties saved and deleted
+        assert ElectionPropertyRow.objects.get(election_id=2).avg_ballot_len == 2
+        assert ElectionPropertyRow.objects.get(election_id=2).fund_scarc is None
+        ElectionDataProperty.objects.filter(election_id=2, metadata=avg_ballot_len_obj).delete()
+        assert ElectionPropertyRow.objects.get(election_id=2).avg_ballot_len is None
+        filters = {"avg_ballot_len": {"min": 1}}
+        assert set(filter_elections(**filters).values_list("name", flat=True)) == {"e1"}
+
+        # the bulk writes do not send signals, the rows are refreshed from the data properties
+        ElectionDataProperty.objects.bulk_create(
+            [ElectionDataProperty(election_id=i, metadata=fund_scarc_obj, value=10 * i) for i in range(3)]
+        )
+        assert ElectionPropertyRow.objects.get(election_id=1).fund_scarc is None
+        refresh_election_property_rows([0, 1, 2], "default")
+        assert ElectionPropertyRow.objects.get(election_id=1).fund_scarc == 10
+        assert ElectionPropertyRow.objects.get(election_id=1).avg_ballot_len == 1
+        assert set(filter_elections(fund_scarc={"max": 10}).values_list("name", flat=True)) == {"e0", "e1"}
+
     def test_get_election_property_histogram(self):
         for i in range(4):
             election_obj = Election.objects.create(
@@ -0,0 +1,117 @@
+from unittest import mock
+
+import pabutools.fractions as fractions
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from pb_visualizer.management.commands.add_election import add_election
+from pb_visualizer.management.commands.compute_all import compute_all
+from pb_visualizer.management.commands.compute_election_properties import compute_election_properties
+from pb_visualizer.management.commands.compute_rule_result_properties import compute_rule_result_properties
+from pb_visualizer.management.commands.compute_rule_results import compute_rule_results
+from pb_visualizer.management.commands.initialize_db import initialize_db
+from pb_visualizer.management.commands.refresh_rule_property_cube import refresh_all_rule_property_cube
+from pb_visualizer.models import *
+from pb_visualizer.rule_property_cube import rule_property_cube_is_fresh
+
+RULES = ["greedy_cost", "max_cost", "seq_phragmen"]
+RULE_PROPERTIES = ["avg_card_sat", "avg_cost_sat", "inverted_cost_gini"]
+
+
+def computed_data(election_name: str) -> tuple:
+    election = Election.objects.get(name=election_name)
+    election_properties = dict(election.data_properties.values_list("metadata_id", "value"))
+    rule_results = {
+        rule_result.rule_id: sorted(rule_result.selected_projects.values_list("project_id", flat=True))
+        for rule_result in election.rule_results.all()
+    }
+    rule_result_properties = {
+        (rule_id, metadata_id): (value, float_value)
+        for rule_id, metadata_id, value, float_value in RuleResultDataProperty.objects.filter(
+            rule_result__election=election
+        ).values_list("rule_result__rule_id", "metadata_id", "value", "float_value")
+    }
+    return election_properties, rule_results, rule_result_properties
+
+
+def write_queries(queries) -> list:
+    # the queries other than reads and transaction handling
+    return [
+        query["sql"]
+        for query in queries
+        if not query["sql"].lstrip().upper().startswith(("SELECT", "SAVEPOINT", "RELEASE"))
+    ]
+
+
+class ComputeAllTestCase(TestCase):
+    def setUp(self):
+        initialize_db(database="default")
+        add_election("pb_visualizer/tests/test_files/test_file_approval.pb", None, verbosity=0)
+        self.fraction_mode = fractions.FRACTION
+
+    def tearDown(self):
+        fractions.FRACTION = self.fraction_mode
+
+    def test_compute_all(self):
+        """compute_all stores the same data as the three compute commands"""
+        compute_election_properties(["approval_election"], verbosity=0)
+        compute_rule_results(["approval_election"], RULES, verbosity=0)
+        compute_rule_result_properties(["approval_election"], RULE_PROPERTIES, verbosity=0)
+        expected = computed_data("approval_election")
+        ElectionDataProperty.objects.all().delete()
+        RuleResult.objects.all().delete()
+
+        compute_all(["approval_election"], RULES, RULE_PROPERTIES, verbosity=0)
+        assert computed_data("approval_election") == expected
+        assert len(expected[1]) == len(RULES)
+
+    def test_only_missing_nodes(self):
+        """only the missing nodes and the ones depending on a recomputed node are computed"""
+        refresh_all_rule_property_cube(verbosity=0)
+        compute_all(None, RULES, RULE_PROPERTIES, verbosity=0)
+        with CaptureQueriesContext(connection) as queries:
+            compute_all(None, RULES, RULE_PROPERTIES, verbosity=0)
+        assert write_queries(queries.captured_queries) == []
+
+        # a missing rule result is computed with its properties, the other results are kept
+        RuleResult.objects.filter(rule="greedy_cost").delete()
+        RuleResultDataProperty.objects.filter(rule_result__rule="max_cost", metadata="avg_card_sat").delete()
+        kept_ids = set(RuleResult.objects.values_list("id", flat=True))
+        with CaptureQueriesContext(connection) as queries:
+            compute_all(None, RULES, RULE_PROPERTIES, verbosity=0)
+        assert set(RuleResult.objects.exclude(rule="greedy_cost").values_list("id", flat=True)) == kept_ids
+        assert RuleResultDataProperty.objects.filter(rule_result__rule="greedy_cost").count() == len(RULE_PROPERTIES)
+        assert RuleResultDataProperty.objects.filter(rule_result__rule="max_cost").count() == len(RULE_PROPERTIES)
+        assert not any("electiondataproperty" in query.lower() for query in write_queries(queries.captured_queries))
+
+        # adding an election only computes its nodes
+        approval_data = computed_data("approval_election")
+        add_election("pb_visualizer/tests/test_files/test_file_cumulative.pb", None, verbosity=0)
+        compute_all(None, RULES, RULE_PROPERTIES, verbosity=0)
+        assert computed_data("approval_election") == approval_data
+        cumulative_election = Election.objects.exclude(name="approval_election").get()
+        assert cumulative_election.data_properties.exists()
+        assert cumulative_election.rule_results.count() == Rule.objects.filter(
+            abbreviation__in=RULES, applies_to=cumulative_election.ballot_type
+        ).count()
+        # the rule property aggregates follow the stored and replaced properties, once per election
+        assert sum(RulePropertyAggregate.objects.values_list("count", flat=True)) == RuleResultDataProperty.objects.count()
+        assert rule_property_cube_is_fresh()
+
+    def test_interrupted_cube_refresh(self):
+        """the cells of the writes of a run stopped before refreshing them are refreshed by the next run"""
+        refresh_all_rule_property_cube(verbosity=0)
+        with mock.patch(
+            "pb_visualizer.management.commands.compute_all.refresh_rule_property_cube",
+            side_effect=KeyboardInterrupt,
+        ):
+            with self.assertRaises(KeyboardInterrupt):
+                compute_all(None, RULES, RULE_PROPERTIES, verbosity=0)
+        assert RuleResultDataProperty.objects.exists()
+        assert not rule_property_cube_is_fresh(rule_ids=RULES[:1])
+        # the stale cells only hide the cube for their rules
+        assert rule_property_cube_is_fresh(rule_ids=["mes_cost"])
+        compute_all(None, RULES, RULE_PROPERTIES, verbosity=0)
+        assert rule_property_cube_is_fresh()
+        assert sum(RulePropertyAggregate.objects.values_list("count", flat=True)) == RuleResultDataProperty.objects.count()
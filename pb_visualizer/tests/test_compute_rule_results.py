@@ -0,0 +1,373 @@
+import csv
+import os
+import tempfile
+import time
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
+
+import pabutools.fractions as fractions
+from django.test import TestCase, override_settings
+from pabutools.election import Cardinality_Sat, Cost_Sat, parse_pabulib
+from pabutools.fractions import frac
+from pabutools.rules import exhaustion_by_budget_increase, method_of_equal_shares
+
+from pb_visualizer.management.commands.add_election import add_election
+from pb_visualizer.management.commands.compute_rule_result_properties import compute_rule_result_properties
+from pb_visualizer.management.commands.compute_rule_results import (
+    bundle_rule_tasks,
+    compute_rule_results,
+    iter_rule_tasks,
+    read_rule_tasks,
+    schedule_rule_tasks,
+    write_failed_tasks,
+    write_rule_results,
+)
+from pb_visualizer.management.commands.initialize_db import initialize_db
+from pb_visualizer.management.commands.utils import ComputationRegistry
+from pb_visualizer.incremental_mes import IncrementalMES
+from pb_visualizer.fingerprints import rule_result_fingerprint, rule_result_property_fingerprint
+from pb_visualizer.models import *
+from pb_visualizer.pabutools import rule_mapping
+from pb_visualizer.near_ties import TrackedFloat, track_near_ties
+from pb_visualizer.rule_computation import (
+    RuleTimeout,
+    bundle_rules,
+    run_rule,
+    run_rules,
+    run_rules_with_exact_ties,
+    time_limit,
+)
+from pb_visualizer.run_journal import RunJournal
+
+
+def failing_rule_task(election_id, database, use_db, rules, timeout=None, exact_ties=None):
+    """Replaces compute_rule_task in the workers: the greedy rules select nothing, seq_phragmen kills its worker."""
+    if rules[0].startswith("greedy"):
+        return {rule: [] for rule in rules}, 0.1, []
+    if rules == ["seq_phragmen"]:
+        os._exit(1)
+    raise ValueError("corrupt election")
+
+
+class ComputeRuleResultsTestCase(TestCase):
+    def setUp(self):
+        initialize_db(database="default")
+        add_election(
+            "pb_visualizer/tests/test_files/test_file_approval.pb", None, verbosity=0
+        )
+
+    def test_compute_rule_results(self):
+        """the rule results are stored with the projects selected by pabutools"""
+        fraction_mode = fractions.FRACTION
+        try:
+            with tempfile.TemporaryDirectory() as cache_dir, override_settings(PARSED_ELECTION_CACHE_DIR=cache_dir):
+                failed_tasks = compute_rule_results(
+                    ["approval_election"], ["greedy_cost", "seq_phragmen"], use_db=True, verbosity=0, batch_size=1
+                )
+        finally:
+            fractions.FRACTION = fraction_mode
+        assert failed_tasks == []
+        election = Election.objects.get(name="approval_election")
+        instance, profile = parse_pabulib("pb_visualizer/tests/test_files/test_file_approval.pb")
+        assert election.rule_results.count() == 2
+        for rule_result in election.rule_results.all():
+            expected = run_rule(instance, profile, instance.budget_limit, rule_result.rule.abbreviation)
+            assert sorted(rule_result.selected_projects.values_list("project_id", flat=True)) == sorted(expected)
+
+    def test_write_rule_results(self):
+        """storing results again replaces their selected projects and properties, and only theirs"""
+        election = Election.objects.get(name="approval_election")
+        greedy_cost, greedy_card = Rule.objects.get(abbreviation="greedy_cost"), Rule.objects.get(abbreviation="greedy_card")
+        project_ids = list(election.projects.order_by("project_id").values_list("project_id", flat=True))
+        write_rule_results([(election, greedy_cost, project_ids[:2]), (election, greedy_card, project_ids[:1])])
+        write_rule_results([(election, greedy_cost, project_ids[1:3])])
+
+        def selected(rule):
+            return sorted(RuleResult.objects.get(election=election, rule=rule).selected_projects.values_list("project_id", flat=True))
+
+        assert election.rule_results.count() == 2
+        assert selected(greedy_cost) == project_ids[1:3]
+        assert selected(greedy_card) == project_ids[:1]
+
+        fraction_mode = fractions.FRACTION
+        try:
+            compute_rule_result_properties(["approval_election"], ["avg_card_sat"], verbosity=0)
+            write_rule_results([(election, greedy_cost, project_ids[:1])])
+            compute_rule_result_properties(["approval_election"], ["avg_card_sat"], override=True, verbosity=0)
+        finally:
+            fractions.FRACTION = fraction_mode
+        data_properties = RuleResultDataProperty.objects.filter(rule_result__election=election, metadata="avg_card_sat")
+        assert data_properties.count() == 2
+        # both results now select the same project, the property of greedy_cost has been updated
+        assert float(data_properties.get(rule_result__rule=greedy_cost).value) == float(
+            data_properties.get(rule_result__rule=greedy_card).value
+        )
+
+    def test_stale_only(self):
+        """with stale_only, the results and properties computed from other inputs are computed again"""
+        fraction_mode = fractions.FRACTION
+        try:
+            compute_rule_results(["approval_election"], ["greedy_cost", "greedy_card"], verbosity=0)
+            compute_rule_result_properties(["approval_election"], ["avg_card_sat"], verbosity=0)
+            rule_result = RuleResult.objects.get(rule="greedy_cost")
+            fingerprint = rule_result.fingerprint
+            assert fingerprint == rule_result_fingerprint(rule_result.election, "greedy_cost")
+            property_fingerprint = rule_result.data_properties.get().fingerprint
+            assert property_fingerprint == rule_result_property_fingerprint(rule_result, "avg_card_sat")
+
+            # e.g. computed with another pabutools version
+            RuleResult.objects.filter(rule="greedy_cost").update(fingerprint="outdated")
+            RuleResultDataProperty.objects.filter(rule_result__rule="greedy_card").update(fingerprint="outdated")
+            election = Election.objects.get(name="approval_election")
+            assert list(iter_rule_tasks([election], ["greedy_cost", "greedy_card"])) == []
+            assert [rule_obj.abbreviation for _, rule_obj in iter_rule_tasks(
+                [election], ["greedy_cost", "greedy_card"], stale_only=True
+            )] == ["greedy_cost"]
+
+            compute_rule_results(["approval_election"], ["greedy_cost", "greedy_card"], verbosity=0, stale_only=True)
+            compute_rule_result_properties(["approval_election"], ["avg_card_sat"], verbosity=0, stale_only=True)
+        finally:
+            fractions.FRACTION = fraction_mode
+        assert RuleResult.objects.get(rule="greedy_cost").fingerprint == fingerprint
+        assert not RuleResultDataProperty.objects.filter(fingerprint="outdated").exists()
+        # the result was computed again from the same inputs, its property is not stale
+        assert RuleResult.objects.get(rule="greedy_cost").data_properties.get().fingerprint == property_fingerprint
+
+    def test_computation_registry(self):
+        """the registry agrees with applies_to_election and plans the tasks with a few queries"""
+        election = Election.objects.get(name="approval_election")
+        registry = ComputationRegistry()
+        for model_class in [Rule, ElectionMetadata, RuleResultMetadata]:
+            for obj in model_class.objects.all():
+                assert registry.applies_to_election(model_class, obj.pk, election) == obj.applies_to_election(election)
+
+        write_rule_results([(election, Rule.objects.get(abbreviation="greedy_cost"), [])])
+        # the rules, their ballot types, the elections and the computed rules of the election
+        with self.assertNumQueries(4):
+            tasks = list(iter_rule_tasks(Election.objects.all()))
+        assert len(tasks) == Rule.objects.filter(applies_to=election.ballot_type).count() - 1
+        assert "greedy_cost" not in [rule_obj.abbreviation for _, rule_obj in tasks]
+
+    def test_schedule_rule_tasks(self):
+        """the most expensive rules are scheduled first"""
+        tasks = schedule_rule_tasks(
+            bundle_rule_tasks(iter_rule_tasks(Election.objects.all(), ["greedy_cost", "mes_cost", "seq_phragmen"]))
+        )
+        assert [[rule_obj.abbreviation for rule_obj in rule_objs] for _, rule_objs in tasks] == [
+            ["mes_cost"], ["seq_phragmen"], ["greedy_cost"]
+        ]
+
+    def test_mes_variants(self):
+        """the MES variants computed together match the rules of pabutools"""
+        # the budget steps of rule_mapping are floats, the MES completions are computed in float mode
+        fraction_mode = fractions.FRACTION
+        fractions.FRACTION = "float"
+        try:
+            instance, profile = parse_pabulib("pb_visualizer/tests/test_files/test_file_approval.pb")
+            rules = rule_mapping(instance.budget_limit)
+            for sat in ["cost", "card", "effort", "sqrt"]:
+                bundle = [f"mes_{sat}", f"mes_{sat}_uncompleted", f"mes_{sat}_greedy"]
+                assert bundle_rules(bundle) == [bundle]
+                outcomes = run_rules(instance, profile, instance.budget_limit, bundle)
+                for rule in bundle:
+                    expected = rules[rule]["func"](instance, profile, **rules[rule]["params"])
+                    assert sorted(outcomes[rule]) == sorted(p.name for p in expected)
+        finally:
+            fractions.FRACTION = fraction_mode
+
+    def test_mes_budget_steps(self):
+        """the budget increase of IncrementalMES stops at the same step as exhaustion_by_budget_increase"""
+        for file_name in ["test_file_approval.pb", "test_file_cumulative.pb"]:
+            instance, profile = parse_pabulib(f"pb_visualizer/tests/test_files/{file_name}")
+            for sat_class in [Cost_Sat, Cardinality_Sat]:
+                mes = IncrementalMES(instance, profile, sat_class)
+                for budget_step in [frac(instance.budget_limit, 100), frac(instance.budget_limit, 7)]:
+                    expected = exhaustion_by_budget_increase(
+                        instance,
+                        profile,
+                        method_of_equal_shares,
+                        {"sat_class": sat_class},
+                        budget_step=budget_step,
+                    )
+                    assert sorted(mes.run_budget_steps(budget_step)) == sorted(expected)
+                    first_outcome = mes.run(instance.budget_limit)
+                    assert sorted(mes.run_budget_steps(budget_step, first_outcome)) == sorted(expected)
+
+    def test_exact_ties(self):
+        """the rules depending on a near tie in float mode are computed again exactly"""
+        instance, profile = parse_pabulib("pb_visualizer/tests/test_files/test_file_approval.pb")
+        with track_near_ties(instance) as monitor:
+            assert TrackedFloat(2.0) < float("inf")
+            assert monitor.near_ties == 0
+            assert (TrackedFloat(0.1) + 0.2) > 0.3
+            assert monitor.near_ties == 1
+            # equal floats are not near ties
+            assert not TrackedFloat(0.5) < 0.5
+            assert (TrackedFloat(0.3) + 0.2 + 0.1) <= 0.6
+            assert monitor.near_ties == 1
+
+        fraction_mode = fractions.FRACTION
+        try:
+            # the exhaustion is computed in exact mode too
+            exact_outcomes = run_rules(instance, profile, instance.budget_limit, ["mes_card", "mes_card_uncompleted"])
+            fractions.FRACTION = "float"
+            float_instance, float_profile = parse_pabulib("pb_visualizer/tests/test_files/test_file_approval.pb")
+
+            def exact_election():
+                return parse_pabulib("pb_visualizer/tests/test_files/test_file_approval.pb")
+
+            for rules in [["mes_card", "mes_card_uncompleted"], ["greedy_cost", "max_cost"], ["seq_phragmen"]]:
+                outcomes, near_tie_rules = run_rules_with_exact_ties(
+                    float_instance, float_profile, float_instance.budget_limit, rules, exact_election
+                )
+                assert outcomes == run_rules(float_instance, float_profile, float_instance.budget_limit, rules)
+                # with a tolerance of 1, every comparison is a near tie, the max rules are not computed again
+                outcomes, near_tie_rules = run_rules_with_exact_ties(
+                    float_instance, float_profile, float_instance.budget_limit, rules, exact_election, tolerance=1
+                )
+                assert near_tie_rules == [rule for rule in rules if rule != "max_cost"]
+                assert fractions.FRACTION == "float"
+            assert outcomes == {"seq_phragmen": run_rule(instance, profile, instance.budget_limit, "seq_phragmen")}
+            rules = ["mes_card", "mes_card_uncompleted"]
+            outcomes, _ = run_rules_with_exact_ties(
+                float_instance, float_profile, float_instance.budget_limit, rules, exact_election, tolerance=1
+            )
+            assert outcomes == exact_outcomes
+            assert all(type(project.cost) is float for project in float_instance)
+        finally:
+            fractions.FRACTION = fraction_mode
+
+    def test_exact_ties_equal_shares(self):
+        """MES, whose voters start with equal budget shares, is not run again exactly without a near tie"""
+        fraction_mode = fractions.FRACTION
+        fractions.FRACTION = "float"
+        try:
+            instance, profile = parse_pabulib("pb_visualizer/tests/test_files/test_file_approval.pb")
+            with track_near_ties(instance) as monitor:
+                run_rules(instance, profile, instance.budget_limit, ["mes_card_uncompleted"])
+            assert monitor.near_ties == 0
+            outcomes, near_tie_rules = run_rules_with_exact_ties(
+                instance,
+                profile,
+                instance.budget_limit,
+                ["mes_card_uncompleted"],
+                lambda: parse_pabulib("pb_visualizer/tests/test_files/test_file_approval.pb"),
+            )
+            assert near_tie_rules == []
+            assert outcomes == run_rules(instance, profile, instance.budget_limit, ["mes_card_uncompleted"])
+        finally:
+            fractions.FRACTION = fraction_mode
+
+    def test_welfare_rules(self):
+        """the greedy and max rules computed together on a CompactProfile match the rules of pabutools"""
+        fraction_mode = fractions.FRACTION
+        fractions.FRACTION = "float"
+        try:
+            bundles = {
+                "test_file_approval.pb": [
+                    ["greedy_card", "greedy_cost", "greedy_cc"],
+                    ["max_card", "max_cost"],
+                ],
+                "test_file_cumulative.pb": [
+                    ["greedy_card", "greedy_cost", "greedy_cardbal", "greedy_cardbal_cc"],
+                    ["max_card", "max_cost", "max_add_card"],
+                ],
+            }
+            for file_name, file_bundles in bundles.items():
+                instance, profile = parse_pabulib(os.path.join("pb_visualizer/tests/test_files", file_name))
+                rules = rule_mapping(instance.budget_limit)
+                assert bundle_rules(sum(file_bundles, [])) == file_bundles
+                for bundle in file_bundles:
+                    outcomes = run_rules(instance, profile, instance.budget_limit, bundle)
+                    for rule in bundle:
+                        expected = rules[rule]["func"](instance, profile, **rules[rule]["params"])
+                        assert sorted(outcomes[rule]) == sorted(p.name for p in expected)
+        finally:
+            fractions.FRACTION = fraction_mode
+
+    def test_failed_tasks(self):
+        """a rule running out of time is stopped and can be retried from the failed tasks file"""
+        with self.assertRaises(RuleTimeout):
+            with time_limit(0.05):
+                while True:
+                    time.sleep(0.001)
+
+        election = Election.objects.get(name="approval_election")
+        rule_obj = Rule.objects.get(abbreviation="max_cost")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            failed_tasks_file = os.path.join(tmp_dir, "failed_tasks.csv")
+            write_failed_tasks(failed_tasks_file, [(election, rule_obj, RuleTimeout("time limit of 1s exceeded"))])
+            assert list(read_rule_tasks(failed_tasks_file)) == [(election, rule_obj)]
+
+    def test_resume(self):
+        """a run resumed from its journal computes the rule results it did not store, the failed ones included"""
+        election = Election.objects.get(name="approval_election")
+        rules = ["greedy_cost", "greedy_card", "max_cost"]
+        rule_objs = {rule_obj.abbreviation: rule_obj for rule_obj in Rule.objects.filter(abbreviation__in=rules)}
+        fraction_mode = fractions.FRACTION
+        try:
+            with tempfile.TemporaryDirectory() as run_dir, override_settings(COMPUTE_RUN_DIR=run_dir):
+                # a run stopped after storing greedy_cost, with max_cost running out of time
+                compute_rule_results(["approval_election"], ["greedy_cost"], verbosity=0)
+                journal = RunJournal.create(
+                    "compute_rule_results",
+                    {"exact": False, "use_db": False, "database": "default"},
+                    [(election, [rule_objs[rule] for rule in rules])],
+                )
+                journal.record_done([(election, rule_objs["greedy_cost"], 0.1)])
+                journal.record_failed(election, rule_objs["max_cost"], RuleTimeout("time limit of 1s exceeded"), None)
+                with open(RunJournal.file_path(journal.run_id), "a") as file:
+                    file.write('{"type": "done", "elect')
+
+                resumed = RunJournal.open(journal.run_id)
+                assert resumed.failed == {(election.id, "max_cost"): "RuleTimeout: time limit of 1s exceeded"}
+                assert resumed.remaining_tasks() == [(election, [rule_objs["greedy_card"], rule_objs["max_cost"]])]
+                greedy_cost_id = RuleResult.objects.get(rule="greedy_cost").id
+                assert compute_rule_results(resume=journal.run_id, verbosity=0) == []
+                assert RunJournal.open(journal.run_id).remaining_tasks() == []
+        finally:
+            fractions.FRACTION = fraction_mode
+        assert set(election.rule_results.values_list("rule_id", flat=True)) == set(rules)
+        assert RuleResult.objects.get(rule="greedy_cost").id == greedy_cost_id
+
+    def test_failed_workers(self):
+        """the tasks failing in the workers, or killing them, are reported as failed and the run goes on"""
+        add_election("pb_visualizer/tests/test_files/test_file_cumulative.pb", None, verbosity=0)
+        rules = ["greedy_cost", "greedy_card", "seq_phragmen", "max_cost", "mes_card", "greedy_cardbal", "mes_cardbal"]
+        tasks = {
+            (election_obj.name, rule_obj.abbreviation)
+            for election_obj, rule_obj in iter_rule_tasks(Election.objects.all(), rules)
+        }
+        fraction_mode = fractions.FRACTION
+        try:
+            with (
+                tempfile.TemporaryDirectory() as cache_dir,
+                tempfile.TemporaryDirectory() as run_dir,
+                override_settings(PARSED_ELECTION_CACHE_DIR=cache_dir, COMPUTE_RUN_DIR=run_dir),
+                mock.patch(
+                    "pb_visualizer.management.commands.compute_rule_results.compute_rule_task", failing_rule_task
+                ),
+            ):
+                failed_tasks_file = os.path.join(cache_dir, "failed_tasks.csv")
+                failed_tasks = compute_rule_results(
+                    rule_list=rules, verbosity=0, workers=2, failed_tasks_file=failed_tasks_file, journal=True
+                )
+                with open(failed_tasks_file, newline="") as f:
+                    failed_rows = list(csv.reader(f, delimiter=";"))[1:]
+                [journal_file] = os.listdir(run_dir)
+                journal = RunJournal.open(journal_file.removesuffix(".jsonl"))
+        finally:
+            fractions.FRACTION = fraction_mode
+        errors = {(election_obj.name, rule_obj.abbreviation): error for election_obj, rule_obj, error in failed_tasks}
+        stored = set(RuleResult.objects.values_list("election__name", "rule_id"))
+        # the greedy tasks sharing the pool killed by seq_phragmen may fail with it
+        assert stored | set(errors) == tasks and not stored & set(errors)
+        assert {(row[0], row[1]) for row in failed_rows} == set(errors)
+        assert set(journal.failed) == {(election_obj.id, rule_obj.abbreviation) for election_obj, rule_obj, _ in failed_tasks}
+        for (election_name, rule), error in errors.items():
+            if rule == "seq_phragmen":
+                assert isinstance(error, BrokenProcessPool)
+            else:
+                assert isinstance(error, (ValueError, BrokenProcessPool))
+        assert len({election_name for election_name, _ in tasks}) == 2
+        assert {rule for _, rule in errors} >= {"seq_phragmen", "max_cost", "mes_card", "mes_cardbal"}
@@ -1,9 +1,27 @@
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+import pabutools.fractions as fractions
+from pabutools.election import ApprovalProfile, parse_pabulib
 from pb_visualizer.management.commands.add_election import add_election
 from pb_visualizer.management.commands.initialize_db import initialize_db
-from pb_visualizer.pabutools import election_object_to_pabutools
+from pb_visualizer import election_cache
+from pb_visualizer.compact_profile import CompactProfile
+from pb_visualizer.pabutools import (
+    compact_instance_property_mapping,
+    compact_profile_property_mapping,
+    election_object_to_pabutools,
+    instance_property_mapping,
+    profile_property_mapping,
+    compact_rule_result_property_mapping,
+    rule_result_property_mapping,
+)
+from pb_visualizer.satisfaction import SatisfactionEngine
 from pb_visualizer.models import *
+from pb_visualizer.management.commands.utils import LazyElectionParser
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 
 class BuildElectionTestCase(TestCase):
@@ -14,5 +32,131 @@ class BuildElectionTestCase(TestCase):
         )
 
     def test_election_object_to_pabutools(self):
-        return
-        # TODO
+        """the election built from the database matches the one parsed from the file"""
+        election = Election.objects.get(name="approval_election")
+        with CaptureQueriesContext(connection) as queries:
+            instance, profile = election_object_to_pabutools(election)
+        assert len(queries) <= 10
+
+        file_instance, file_profile = parse_pabulib(
+            "pb_visualizer/tests/test_files/test_file_approval.pb"
+        )
+        assert instance.budget_limit == file_instance.budget_limit
+        assert sorted((p.name, p.cost) for p in instance) == sorted(
+            (p.name, p.cost) for p in file_instance
+        )
+        assert len(profile) == len(file_profile)
+        assert sorted(sorted(p.name for p in ballot) for ballot in profile) == sorted(
+            sorted(p.name for p in ballot) for ballot in file_profile
+        )
+
+    def test_parsed_election_cache(self):
+        """a parsed election is read back from the cache until its file changes"""
+        election = Election.objects.get(name="approval_election")
+        with tempfile.TemporaryDirectory() as cache_dir, override_settings(PARSED_ELECTION_CACHE_DIR=cache_dir):
+            instance, profile = LazyElectionParser(election, True, verbosity=0).get_parsed_election()
+            assert len(os.listdir(cache_dir)) == 1
+
+            with CaptureQueriesContext(connection) as queries:
+                cached_instance, cached_profile = LazyElectionParser(election, True, verbosity=0).get_parsed_election()
+            assert len(queries) == 0
+            assert type(cached_profile) == type(profile)
+            assert len(cached_profile) == len(profile)
+            assert cached_profile.total() == profile.total()
+            assert {p.name for p in cached_instance} == {p.name for p in instance}
+            assert all(p in cached_instance for ballot in cached_profile for p in ballot)
+
+            election.file_hash = "changed"
+            LazyElectionParser(election, True, verbosity=0).get_parsed_election()
+            assert len(os.listdir(cache_dir)) == 1
+            assert "changed" in os.listdir(cache_dir)[0]
+
+    def test_concurrent_cache_stores(self):
+        """the writers storing the same election at once do not mix their files"""
+        election = Election.objects.get(name="approval_election")
+        contents = [[writer] * 200000 for writer in range(8)]
+        with tempfile.TemporaryDirectory() as cache_dir, override_settings(PARSED_ELECTION_CACHE_DIR=cache_dir):
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(lambda content: election_cache._store(election, "test", content), contents))
+            assert election_cache._load(election, "test") in contents
+            assert len(os.listdir(cache_dir)) == 1
+
+    def test_failed_cache_store(self):
+        """a failed store leaves no temporary file, and the ones of killed writers are removed later"""
+        election = Election.objects.get(name="approval_election")
+        with tempfile.TemporaryDirectory() as cache_dir, override_settings(PARSED_ELECTION_CACHE_DIR=cache_dir):
+            with self.assertRaises(Exception):
+                election_cache._store(election, "test", lambda: None)
+            assert os.listdir(cache_dir) == []
+
+            prefix = os.path.basename(election_cache._cache_file_prefix(election.id, "default"))
+            killed_writer_file = os.path.join(cache_dir, prefix + "killed.tmp")
+            running_writer_file = os.path.join(cache_dir, prefix + "running.tmp")
+            for file_path in [killed_writer_file, running_writer_file]:
+                open(file_path, "wb").close()
+            os.utime(killed_writer_file, (0, 0))
+            election_cache._store(election, "test", [1])
+            assert sorted(os.listdir(cache_dir)) == sorted(
+                [os.path.basename(running_writer_file), os.path.basename(election_cache._cache_file_path(election, "test"))]
+            )
+
+    def test_compact_profile_strengths(self):
+        """the strengths of the compact profile are not rounded"""
+        strengths = [2**24 + 1, 0.1, 1 / 3]
+        compact_profile = CompactProfile.from_rows(
+            "cumulative", ["p1", "p2", "p3"], [1, 1, 1], 3, [[(index, strength) for index, strength in enumerate(strengths)]]
+        )
+        assert compact_profile.strengths.tolist() == strengths
+        assert compact_profile.project_sums().tolist() == strengths
+
+    def test_compact_profile(self):
+        """the properties computed on the compact profile match the pabutools ones"""
+        election = Election.objects.get(name="approval_election")
+        file_path = "pb_visualizer/tests/test_files/test_file_approval.pb"
+        instance, profile = parse_pabulib(file_path)
+        for compact_profile in [
+            CompactProfile.from_election(election),
+            CompactProfile.from_file(file_path, "approval"),
+        ]:
+            assert compact_profile.num_voters == len(profile)
+            assert compact_profile.data is None
+            for property, prop_func in instance_property_mapping.items():
+                assert abs(float(prop_func(instance)) - compact_instance_property_mapping[property](compact_profile)) < 1e-6
+            for property in ["avg_ballot_len", "med_ballot_len", "avg_ballot_cost", "med_ballot_cost", "avg_app_score", "med_app_score"]:
+                assert abs(
+                    float(profile_property_mapping[property](instance, profile))
+                    - compact_profile_property_mapping[property](compact_profile)
+                ) < 1e-6
+
+    def test_satisfaction_engine(self):
+        """the rule result properties computed on the satisfaction vectors match the pabutools ones"""
+        fraction_mode = fractions.FRACTION
+        fractions.FRACTION = "float"
+        try:
+            for file_name, ballot_type in [("test_file_approval.pb", "approval"), ("test_file_ordinal.pb", "ordinal")]:
+                instance, profile = parse_pabulib(f"pb_visualizer/tests/test_files/{file_name}")
+                engine = SatisfactionEngine(CompactProfile.from_pabutools(instance, profile, ballot_type))
+                projects = sorted(instance, key=lambda p: p.name)
+                for budget_allocation in [projects[:1], projects[::2], projects]:
+                    allocation_satisfaction = engine.allocation([p.name for p in budget_allocation])
+                    for property, prop_func in compact_rule_result_property_mapping.items():
+                        try:
+                            expected = rule_result_property_mapping[property](instance, profile, budget_allocation)
+                        except Exception:
+                            # the property does not apply to this type of ballots
+                            continue
+                        prop_func_value = prop_func(allocation_satisfaction)
+                        if isinstance(expected, list):
+                            assert len(prop_func_value) == len(expected)
+                            assert all(abs(a - b) < 1e-6 for a, b in zip(prop_func_value, expected))
+                        else:
+                            assert abs(prop_func_value - float(expected)) < 1e-6, property
+            # the share of the voters with a positive satisfaction is 0 without voters
+            instance, _ = parse_pabulib("pb_visualizer/tests/test_files/test_file_approval.pb")
+            engine = SatisfactionEngine(
+                CompactProfile.from_pabutools(instance, ApprovalProfile(instance=instance), "approval")
+            )
+            allocation_satisfaction = engine.allocation([p.name for p in instance])
+            assert compact_rule_result_property_mapping["prop_pos_sat"](allocation_satisfaction) == 0.0
+        finally:
+            fractions.FRACTION = fraction_mode
@@ -113,6 +113,7 @@ def rule_result_data_property(request):
         property_short_names = json.loads(request.GET.get("property_short_names", "[]"))
         election_filters = json.loads(request.GET.get("election_filters", "{}"))
         include_incomplete_elections = json.loads(request.GET.get("include_incomplete_elections", "false"))
+        with_spread = json.loads(request.GET.get("with_spread", "false"))
         user_submitted = json.loads(request.GET.get("user_submitted", "null"))
         database =  "user_submitted" if user_submitted else "default"  
         data_dict = get_rule_result_average_data_properties(
@@ -120,7 +121,8 @@ def rule_result_data_property(request):
             property_short_names=property_short_names,
             election_filters=election_filters,
             include_incomplete_elections=include_incomplete_elections,
-            database=database
+            database=database,
+            with_spread=with_spread,
         )
 
         return Response(data_dict, headers=caching_parameters)
@@ -132,13 +134,15 @@ def voter_satisfaction_histogram(request):
         rule_abbr_list = json.loads(request.GET.get("rule_abbr_list", "[]"))
         election_filters = json.loads(request.GET.get("election_filters", "{}"))
         include_incomplete_elections = json.loads(request.GET.get("include_incomplete_elections", "false"))
+        with_spread = json.loads(request.GET.get("with_spread", "false"))
         user_submitted = json.loads(request.GET.get("user_submitted", "null"))
         database =  "user_submitted" if user_submitted else "default"  
         data_dict = get_satisfaction_histogram(
             rule_abbr_list=rule_abbr_list,
             election_filters=election_filters,
             include_incomplete_elections=include_incomplete_elections,
-            database=database
+            database=database,
+            with_spread=with_spread,
         )
         return Response(data_dict, headers=caching_parameters)
 